@@ -653,8 +653,7 @@ class AggregatedTimeSerie(TimeSerie):
         if data:
             if cls.is_compressed(data):
                 # Compressed format
-                uncompressed = lz4.block.decompress(
-                    memoryview(data)[1:].tobytes())
+                uncompressed = lz4.block.decompress(memoryview(data)[1:])
                 nb_points = len(uncompressed) // cls.COMPRESSED_SERIAL_LEN
 
                 try:
@@ -760,10 +759,10 @@ class AggregatedTimeSerie(TimeSerie):
         agg_func = getattr(grouped_serie, agg_name)
         return agg_func(q) if agg_name == 'quantile' else agg_func()
 
-    def fetch(self, from_timestamp=None, to_timestamp=None):
-        """Fetch aggregated time value.
+    def fetch_points(self, from_timestamp=None, to_timestamp=None):
+        """Fetch aggregated points.
 
-        Returns a sorted list of tuples (timestamp, granularity, value).
+        Returns the structured array of timestamps and values in the range.
         """
         # Round timestamp to our granularity so we're sure that if e.g. 17:02
         # is requested and we have points for 17:00 and 17:05 in a 5min
@@ -772,7 +771,14 @@ class AggregatedTimeSerie(TimeSerie):
             from_ = None
         else:
             from_ = round_timestamp(from_timestamp, self.sampling)
-        points = self[from_:to_timestamp]
+        return self[from_:to_timestamp]
+
+    def fetch(self, from_timestamp=None, to_timestamp=None):
+        """Fetch aggregated time value.
+
+        Returns a sorted list of tuples (timestamp, granularity, value).
+        """
+        points = self.fetch_points(from_timestamp, to_timestamp)
         return six.moves.zip(points['timestamps'],
                              itertools.repeat(self.sampling),
                              points['values'])
@@ -922,54 +928,12 @@ class AggregatedTimeSerie(TimeSerie):
             grouped = single_df.groupby(level=index)
         else:
             grouped = pandas.concat(dataframes).groupby(level=index)
-            maybe_next_timestamp_is_left_boundary = False
-
-            left_holes = 0
-            right_holes = 0
-            holes = 0
-            for (timestamp, __), group in grouped:
-                if group.count()['value'] != number_of_distinct_datasource:
-                    maybe_next_timestamp_is_left_boundary = True
-                    if left_boundary_ts is not None:
-                        right_holes += 1
-                    else:
-                        left_holes += 1
-                elif maybe_next_timestamp_is_left_boundary:
-                    left_boundary_ts = timestamp
-                    maybe_next_timestamp_is_left_boundary = False
-                else:
-                    right_boundary_ts = timestamp
-                    holes += right_holes
-                    right_holes = 0
-
-            if to_timestamp is not None:
-                holes += left_holes
-            if from_timestamp is not None:
-                holes += right_holes
-
-            if to_timestamp is not None or from_timestamp is not None:
-                maximum = len(grouped)
-                percent_of_overlap = (float(maximum - holes) * 100.0 /
-                                      float(maximum))
-                if percent_of_overlap < needed_percent_of_overlap:
-                    raise UnAggregableTimeseries(
-                        'Less than %f%% of datapoints overlap in this '
-                        'timespan (%.2f%%)' % (needed_percent_of_overlap,
-                                               percent_of_overlap))
-            if (needed_percent_of_overlap > 0 and
-                    (right_boundary_ts == left_boundary_ts or
-                     (right_boundary_ts is None
-                      and maybe_next_timestamp_is_left_boundary))):
-                LOG.debug("We didn't find points that overlap in those "
-                          "timeseries. "
-                          "right_boundary_ts=%(right_boundary_ts)s, "
-                          "left_boundary_ts=%(left_boundary_ts)s, "
-                          "groups=%(groups)s", {
-                              'right_boundary_ts': right_boundary_ts,
-                              'left_boundary_ts': left_boundary_ts,
-                              'groups': list(grouped)
-                          })
-                raise UnAggregableTimeseries('No overlap')
+            counts = grouped['value'].count()
+            left_boundary_ts, right_boundary_ts = (
+                AggregatedTimeSerie._get_overlap_boundaries(
+                    counts.index.get_level_values('timestamp'),
+                    counts.values, number_of_distinct_datasource,
+                    from_timestamp, to_timestamp, needed_percent_of_overlap))
 
         # NOTE(sileht): this call the aggregation method on already
         # aggregated values, for some kind of aggregation this can
@@ -980,6 +944,113 @@ class AggregatedTimeSerie(TimeSerie):
         agg_timeserie = getattr(grouped, aggregation)()
         agg_timeserie = agg_timeserie.dropna().reset_index()
 
+        return AggregatedTimeSerie._format_aggregated(
+            agg_timeserie, from_timestamp, to_timestamp,
+            left_boundary_ts, right_boundary_ts)
+
+    @staticmethod
+    def aggregated_from_counts(timeseries, counts, number_of_timeseries,
+                               from_timestamp=None, to_timestamp=None,
+                               needed_percent_of_overlap=100.0):
+        """Return the result of `aggregated` from already aggregated values.
+
+        :param timeseries: The aggregated timeseries, one per granularity.
+        :param counts: The timeseries of the number of values aggregated at
+                       each timestamp, one per granularity.
+        :param number_of_timeseries: The number of timeseries that were
+                                     aggregated.
+        """
+        columns = ['timestamp', 'granularity', 'value']
+
+        counts = pandas.DataFrame(
+            list(itertools.chain.from_iterable(
+                ts.fetch(from_timestamp, to_timestamp) for ts in counts)),
+            columns=columns)
+        if counts.empty:
+            return []
+        counts = counts.sort_values(by=['timestamp', 'granularity'])
+        left_boundary_ts, right_boundary_ts = (
+            AggregatedTimeSerie._get_overlap_boundaries(
+                counts['timestamp'], counts['value'].values,
+                number_of_timeseries, from_timestamp, to_timestamp,
+                needed_percent_of_overlap))
+
+        agg_timeserie = pandas.DataFrame(
+            list(itertools.chain.from_iterable(
+                ts.fetch(from_timestamp, to_timestamp) for ts in timeseries)),
+            columns=columns)
+
+        return AggregatedTimeSerie._format_aggregated(
+            agg_timeserie, from_timestamp, to_timestamp,
+            left_boundary_ts, right_boundary_ts)
+
+    @staticmethod
+    def _get_overlap_boundaries(timestamps, counts, number_of_datasource,
+                                from_timestamp, to_timestamp,
+                                needed_percent_of_overlap):
+        """Find the boundaries of the range where all timeseries overlap.
+
+        :param timestamps: The timestamps of each group, sorted by timestamp
+                           and granularity.
+        :param counts: The number of values in each group.
+        :return: A tuple (left_boundary_ts, right_boundary_ts).
+        """
+        left_boundary_ts = None
+        right_boundary_ts = None
+        maybe_next_timestamp_is_left_boundary = False
+
+        left_holes = 0
+        right_holes = 0
+        holes = 0
+        for timestamp, count in six.moves.zip(timestamps, counts):
+            if count != number_of_datasource:
+                maybe_next_timestamp_is_left_boundary = True
+                if left_boundary_ts is not None:
+                    right_holes += 1
+                else:
+                    left_holes += 1
+            elif maybe_next_timestamp_is_left_boundary:
+                left_boundary_ts = timestamp
+                maybe_next_timestamp_is_left_boundary = False
+            else:
+                right_boundary_ts = timestamp
+                holes += right_holes
+                right_holes = 0
+
+        if to_timestamp is not None:
+            holes += left_holes
+        if from_timestamp is not None:
+            holes += right_holes
+
+        if to_timestamp is not None or from_timestamp is not None:
+            maximum = len(counts)
+            percent_of_overlap = (float(maximum - holes) * 100.0 /
+                                  float(maximum))
+            if percent_of_overlap < needed_percent_of_overlap:
+                raise UnAggregableTimeseries(
+                    'Less than %f%% of datapoints overlap in this '
+                    'timespan (%.2f%%)' % (needed_percent_of_overlap,
+                                           percent_of_overlap))
+        if (needed_percent_of_overlap > 0 and
+                (right_boundary_ts == left_boundary_ts or
+                 (right_boundary_ts is None
+                  and maybe_next_timestamp_is_left_boundary))):
+            LOG.debug("We didn't find points that overlap in those "
+                      "timeseries. "
+                      "right_boundary_ts=%(right_boundary_ts)s, "
+                      "left_boundary_ts=%(left_boundary_ts)s, "
+                      "groups=%(groups)s", {
+                          'right_boundary_ts': right_boundary_ts,
+                          'left_boundary_ts': left_boundary_ts,
+                          'groups': list(six.moves.zip(timestamps, counts))
+                      })
+            raise UnAggregableTimeseries('No overlap')
+
+        return left_boundary_ts, right_boundary_ts
+
+    @staticmethod
+    def _format_aggregated(agg_timeserie, from_timestamp, to_timestamp,
+                           left_boundary_ts, right_boundary_ts):
         if from_timestamp is None and left_boundary_ts:
             agg_timeserie = agg_timeserie[
                 agg_timeserie['timestamp'] >= left_boundary_ts]
@@ -993,6 +1064,182 @@ class AggregatedTimeSerie(TimeSerie):
                              points.value)
 
 
+class SplitAggregation(object):
+    """Aggregate timeseries across metrics, one split at a time.
+
+    This computes the same result as `AggregatedTimeSerie.aggregated`, but
+    the timeseries are fed split by split with `add_split`. Only a compact
+    per-timestamp state is kept between splits, so the memory used does not
+    depend on the number of metrics times the number of splits.
+
+    For `DECOMPOSABLE_METHODS`, the timeseries of a split are also folded one
+    by one, so the memory does not depend on the number of metrics at all.
+    """
+
+    DECOMPOSABLE_METHODS = ("mean", "sum", "min", "max", "count")
+
+    def __init__(self, aggregation, number_of_metrics, from_timestamp=None,
+                 to_timestamp=None, needed_percent_of_overlap=100.0,
+                 fill=None):
+        self.aggregation = aggregation
+        self.number_of_metrics = number_of_metrics
+        self.from_timestamp = from_timestamp
+        self.to_timestamp = to_timestamp
+        self.needed_percent_of_overlap = needed_percent_of_overlap
+        self.fill = fill
+        self.decomposable = aggregation in self.DECOMPOSABLE_METHODS
+        self._non_empty_series = set()
+        self._groups = []
+
+    @classmethod
+    def supports(cls, aggregation, fill=None):
+        # NOTE(jd) With a numeric fill value, `aggregated' fills the missing
+        # values of each group with as many values as there are non-empty
+        # timeseries, which is only known once all the splits are read. This
+        # can only be computed afterward for decomposable methods.
+        return (fill is None or fill == 'null'
+                or aggregation in cls.DECOMPOSABLE_METHODS)
+
+    def add_split(self, key, timeseries):
+        """Aggregate the timeseries of a split.
+
+        :param key: The `SplitKey` of the split.
+        :param timeseries: An iterable of tuple (series_id, timeserie) with
+                           the `AggregatedTimeSerie` of each metric for this
+                           split, in metric order.
+        """
+        if self.decomposable:
+            groups = self._fold_split(key, timeseries)
+        else:
+            groups = self._group_split(timeseries)
+        if groups is not None and len(groups):
+            self._groups.append(groups)
+
+    def _fetch(self, series_id, timeserie):
+        points = timeserie.fetch_points(self.from_timestamp,
+                                        self.to_timestamp)
+        if len(points):
+            self._non_empty_series.add(series_id)
+        return points
+
+    def _fold_split(self, key, timeseries):
+        size = SplitKey.POINTS_PER_SPLIT
+        present = numpy.zeros(size, dtype=bool)
+        count = numpy.zeros(size, dtype=numpy.int64)
+        sum_ = numpy.zeros(size)
+        min_ = numpy.full(size, numpy.nan)
+        max_ = numpy.full(size, numpy.nan)
+        for series_id, timeserie in timeseries:
+            points = self._fetch(series_id, timeserie)
+            if not len(points):
+                continue
+            # NOTE(jd) Timestamps are unique in a timeserie so fancy indexing
+            # is enough to update each slot once.
+            idx = ((points['timestamps'] - key.key)
+                   // key.sampling).astype(int)
+            present[idx] = True
+            values = points['values']
+            valid = ~numpy.isnan(values)
+            idx, values = idx[valid], values[valid]
+            count[idx] += 1
+            sum_[idx] += values
+            min_[idx] = numpy.fmin(min_[idx], values)
+            max_[idx] = numpy.fmax(max_[idx], values)
+
+        idx = numpy.nonzero(present)[0]
+        if not len(idx):
+            return
+        return pandas.DataFrame({
+            'timestamp': key.key + idx * key.sampling,
+            'granularity': key.sampling,
+            'count': count[idx],
+            'sum': sum_[idx],
+            'min': min_[idx],
+            'max': max_[idx],
+        })
+
+    def _group_split(self, timeseries):
+        index = ['timestamp', 'granularity']
+        dataframes = []
+        for series_id, timeserie in timeseries:
+            points = self._fetch(series_id, timeserie)
+            if len(points):
+                dataframes.append(pandas.DataFrame({
+                    'timestamp': points['timestamps'],
+                    'granularity': timeserie.sampling,
+                    'value': points['values'],
+                }).set_index(index))
+        if not dataframes:
+            return
+        grouped = pandas.concat(dataframes).groupby(level=index)
+        return pandas.DataFrame({
+            'count': grouped['value'].count(),
+            'value': getattr(grouped, self.aggregation)()['value'],
+        }).reset_index()
+
+    def _compute_decomposable(self, groups):
+        count = groups['count'].values
+        sum_ = groups['sum'].values
+        min_ = groups['min'].values
+        max_ = groups['max'].values
+        if self.fill is not None and self.fill != 'null':
+            missing = len(self._non_empty_series) - count
+            has_missing = missing > 0
+            count = count + missing
+            sum_ = sum_ + self.fill * missing
+            min_ = numpy.where(has_missing, numpy.fmin(min_, self.fill), min_)
+            max_ = numpy.where(has_missing, numpy.fmax(max_, self.fill), max_)
+        if self.aggregation == "count":
+            return count
+        if self.aggregation == "sum":
+            return sum_
+        if self.aggregation == "min":
+            return min_
+        if self.aggregation == "max":
+            return max_
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            return sum_ / count
+
+    def result(self):
+        """Return the aggregated points like `AggregatedTimeSerie.aggregated`.
+        """
+        if not self._groups:
+            return []
+
+        groups = pandas.concat(self._groups, ignore_index=True)
+        groups = groups.sort_values(by=['timestamp', 'granularity'],
+                                    kind='mergesort')
+        self._groups = [groups]
+
+        left_boundary_ts = None
+        right_boundary_ts = None
+        if self.fill is None:
+            left_boundary_ts, right_boundary_ts = (
+                AggregatedTimeSerie._get_overlap_boundaries(
+                    groups['timestamp'].values, groups['count'].values,
+                    self.number_of_metrics,
+                    self.from_timestamp, self.to_timestamp,
+                    self.needed_percent_of_overlap))
+            if left_boundary_ts is not None:
+                left_boundary_ts = pandas.Timestamp(left_boundary_ts)
+            if right_boundary_ts is not None:
+                right_boundary_ts = pandas.Timestamp(right_boundary_ts)
+
+        if self.decomposable:
+            values = self._compute_decomposable(groups)
+        else:
+            values = groups['value'].values
+        agg_timeserie = pandas.DataFrame({
+            'timestamp': groups['timestamp'].values,
+            'granularity': groups['granularity'].values,
+            'value': values,
+        }).dropna()
+
+        return AggregatedTimeSerie._format_aggregated(
+            agg_timeserie, self.from_timestamp, self.to_timestamp,
+            left_boundary_ts, right_boundary_ts)
+
+
 if __name__ == '__main__':
     import sys
     args = sys.argv[1:]
@@ -13,10 +13,13 @@
 # implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import collections
 import copy
 from distutils import spawn
 import math
+import multiprocessing
 import os
+import random
 import sys
 import threading
 import time
@@ -24,12 +27,14 @@ import time
 import cotyledon
 from cotyledon import oslo_config_glue
 import daiquiri
+import monotonic
 from oslo_config import cfg
 import six
 import tenacity
 import tooz
 
 from gnocchi import archive_policy
+from gnocchi import exceptions
 from gnocchi import genconfig
 from gnocchi import incoming
 from gnocchi import indexer
@@ -93,7 +98,15 @@ def upgrade():
 
 def change_sack_size():
     conf = cfg.ConfigOpts()
-    conf.register_cli_opts([_SACK_NUMBER_OPT])
+    conf.register_cli_opts([
+        _SACK_NUMBER_OPT,
+        cfg.BoolOpt("online", default=False,
+                    help="Change the number of sacks while measures are "
+                    "being sent and processed. The measures of the "
+                    "current sacks are moved to the new sacks by "
+                    "gnocchi-metricd, which removes the current sacks once "
+                    "they are empty."),
+    ])
     conf = service.prepare_service(conf=conf, log_to_std=True)
     s = incoming.get_driver(conf)
     try:
@@ -101,13 +114,30 @@ def change_sack_size():
     except incoming.SackDetectionError:
         # issue is already logged by NUM_SACKS, abort.
         return
+    draining, __ = s.get_draining_group()
+    if draining is not None:
+        LOG.error('Cannot change sack while the measures of the previous %d '
+                  'sacks are being moved. %d measures remaining, try again '
+                  'once gnocchi-metricd has removed them',
+                  draining.NUM_SACKS,
+                  draining.measures_report(
+                      details=False)['summary']['measures'])
+        return
+    old_num_sacks = s.NUM_SACKS
+    if conf.online:
+        LOG.info("Changing sack size to %s, gnocchi-metricd moves the %s "
+                 "measures of the previous %d sacks",
+                 conf.sacks_number, report['summary']['measures'],
+                 old_num_sacks)
+        s.set_storage_settings(conf.sacks_number, old_num_sacks)
+        return
     remainder = report['summary']['measures']
     if remainder:
         LOG.error('Cannot change sack when non-empty backlog. Process '
-                  'remaining %s measures and try again', remainder)
+                  'remaining %s measures and try again, or use --online',
+                  remainder)
         return
     LOG.info("Changing sack size to: %s", conf.sacks_number)
-    old_num_sacks = s.get_storage_sacks()
     s.set_storage_settings(conf.sacks_number)
     s.remove_sack_group(old_num_sacks)
 
@@ -131,6 +161,7 @@ class MetricProcessBase(cotyledon.Service):
         self.interval_delay = interval_delay
         self._shutdown = threading.Event()
         self._shutdown_done = threading.Event()
+        self._wake_up = threading.Event()
 
     def _configure(self):
         self.store = retry_on_exception(storage.get_driver, self.conf)
@@ -143,13 +174,22 @@ class MetricProcessBase(cotyledon.Service):
         time.sleep(self.startup_delay)
 
         while not self._shutdown.is_set():
+            self._wake_up.clear()
             with utils.StopWatch() as timer:
                 self._run_job()
-            self._shutdown.wait(max(0, self.interval_delay - timer.elapsed()))
+            self._wake_up.wait(self._get_wait_delay(timer.elapsed()))
         self._shutdown_done.set()
 
+    def _get_wait_delay(self, elapsed):
+        return max(0, self.interval_delay - elapsed)
+
+    def wake_up(self):
+        """Run the next job without waiting for the interval delay."""
+        self._wake_up.set()
+
     def terminate(self):
         self._shutdown.set()
+        self.wake_up()
         LOG.info("Waiting ongoing metric processing to finish")
         self._shutdown_done.wait()
         self.close_services()
@@ -180,6 +220,15 @@ class MetricReporting(MetricProcessBase):
                      "metrics wait to be processed.",
                      report['summary']['measures'],
                      report['summary']['metrics'])
+            draining, since = self.incoming.get_draining_group()
+            if draining is not None:
+                report = draining.measures_report(details=False)
+                LOG.info("%d measurements bundles across %d metrics wait to "
+                         "be moved from the previous %d sacks, replaced "
+                         "%d seconds ago.",
+                         report['summary']['measures'],
+                         report['summary']['metrics'],
+                         draining.NUM_SACKS, since)
         except incoming.ReportGenerationError:
             LOG.warning("Unable to compute backlog. Retrying at next "
                         "interval.")
@@ -188,15 +237,107 @@ class MetricReporting(MetricProcessBase):
                       exc_info=True)
 
 
+class _SackScheduler(object):
+    """Order the sacks to process by how long their measures have waited.
+
+    A sack is known to have measures when the incoming driver notifies it,
+    or when measures were found the last time it was processed. Those sacks
+    are processed again right away, the oldest first, while the others are
+    only processed by full passes. Full passes run every `min_delay' seconds
+    while measures are found, and back off up to every `max_delay' seconds
+    when they are not.
+    """
+
+    def __init__(self, min_delay, max_delay):
+        self.min_delay = min(min_delay, max_delay)
+        self.max_delay = max_delay
+        self.delay = self.min_delay
+        self._lock = threading.Lock()
+        # Since when each sack is known to have measures
+        self._pending_since = {}
+        # Number of metrics found the last time each sack was processed
+        self._backlog = {}
+        self._last_processed = {}
+        self._full_pass_timer = None
+        self._found_measures = False
+        # Seconds the measures of each sack waited when last processed
+        self.lag = {}
+
+    def notify(self, sack):
+        """Record that a sack has new measures."""
+        with self._lock:
+            self._pending_since.setdefault(sack, monotonic.monotonic())
+
+    def get_sacks(self, tasks):
+        """Return the sacks to process and whether it is a full pass."""
+        full_pass = (self._full_pass_timer is None or
+                     self._full_pass_timer.elapsed() >= self.delay)
+        if full_pass:
+            self._full_pass_timer = utils.StopWatch().start()
+        self._found_measures = False
+        with self._lock:
+            pending = dict(self._pending_since)
+        if not full_pass:
+            tasks = [s for s in tasks if s in pending]
+        # NOTE(jd) The sort is stable, so the sacks without measures known
+        # keep the order of the tasks.
+        return sorted(tasks, key=lambda s: (
+            s not in pending, pending.get(s), -self._backlog.get(s, 0))
+        ), full_pass
+
+    def processed(self, sack, started_at, nb_metrics):
+        """Record that a sack has been processed.
+
+        :param started_at: When the processing of the sack started.
+        :param nb_metrics: The number of metrics with measures found.
+        :return: How many seconds the oldest measures waited, at most, or
+                 None if unknown.
+        """
+        with self._lock:
+            since = self._pending_since.get(
+                sack, self._last_processed.get(sack))
+            if nb_metrics:
+                # NOTE(jd) Measures may have been added while the sack was
+                # processed, so check it again right away.
+                self._pending_since[sack] = started_at
+            elif self._pending_since.get(sack, started_at) <= started_at:
+                self._pending_since.pop(sack, None)
+        self._last_processed[sack] = started_at
+        self._backlog[sack] = nb_metrics
+        if not nb_metrics:
+            self.lag.pop(sack, None)
+            return 0
+        self._found_measures = True
+        if since is None:
+            return
+        self.lag[sack] = started_at - since
+        return self.lag[sack]
+
+    def get_wait_delay(self, full_pass):
+        """Return how many seconds to wait before the next pass."""
+        if self._found_measures:
+            self.delay = self.min_delay
+            return 0
+        if full_pass:
+            self.delay = min(max(self.delay * 2, 1), self.max_delay)
+        # NOTE(jd) Sacks notified in the meantime wake the processor up.
+        return max(0, self.delay - self._full_pass_timer.elapsed())
+
+
 class MetricProcessor(MetricProcessBase):
     name = "processing"
     GROUP_ID = "gnocchi-processing"
 
-    def __init__(self, worker_id, conf):
+    def __init__(self, worker_id, conf, split_tasks=None):
         super(MetricProcessor, self).__init__(
             worker_id, conf, conf.metricd.metric_processing_delay)
         self._tasks = []
         self.group_state = None
+        self.split_tasks = split_tasks
+        self.scheduler = _SackScheduler(
+            conf.metricd.metric_processing_min_delay,
+            conf.metricd.metric_processing_delay)
+        self._full_pass = False
 
     @tenacity.retry(
         wait=_wait_exponential,
@@ -207,12 +348,13 @@ class MetricProcessor(MetricProcessBase):
                                         self.conf.storage.coordination_url)
         self.store = retry_on_exception(storage.get_driver,
                                         self.conf, self.coord)
+        self.store.split_tasks = self.split_tasks
         self.incoming = retry_on_exception(incoming.get_driver, self.conf)
         self.index = retry_on_exception(indexer.get_driver, self.conf)
 
         # create fallback in case paritioning fails or assigned no tasks
-        self.fallback_tasks = list(
-            six.moves.range(self.incoming.NUM_SACKS))
+        self.fallback_tasks = self._get_fallback_tasks(
+            self.incoming.NUM_SACKS)
         try:
             self.partitioner = self.coord.join_partitioned_group(
                 self.GROUP_ID, partitions=200)
@@ -225,44 +367,305 @@ class MetricProcessor(MetricProcessBase):
                       'partitioning. Retrying: %s', e)
             raise tenacity.TryAgain(e)
 
+        if self.conf.metricd.greedy:
+            listener = threading.Thread(target=self._listen_new_measures)
+            listener.daemon = True
+            listener.start()
+
+    def _listen_new_measures(self):
+        while not self._shutdown.is_set():
+            try:
+                for sack in self.incoming.iter_on_sacks_to_process():
+                    self.scheduler.notify(sack)
+                    self.wake_up()
+            except exceptions.NotImplementedError:
+                LOG.info("Incoming driver does not notify new measures, "
+                         "looking for them every %d to %d seconds",
+                         self.scheduler.min_delay, self.scheduler.max_delay)
+                return
+            except Exception:
+                LOG.error("Unexpected error listening for new measures",
+                          exc_info=True)
+                self._shutdown.wait(self.interval_delay)
+
+    def _get_sacks_to_process(self):
+        sacks, self._full_pass = self.scheduler.get_sacks(self._get_tasks())
+        return sacks
+
+    def _get_wait_delay(self, elapsed):
+        return self.scheduler.get_wait_delay(self._full_pass)
+
+    @staticmethod
+    def _get_fallback_tasks(num_sacks):
+        tasks = list(six.moves.range(num_sacks))
+        # NOTE(jd) Workers processing all the sacks do not start with the
+        # same ones, so they do not wait on each other's locks.
+        random.shuffle(tasks)
+        return tasks
+
+    def _get_sacks_owned(self, num_sacks):
+        if self.conf.metricd.sack_affinity:
+            replicas = 1
+        else:
+            replicas = self.conf.metricd.processing_replicas
+        return [i for i in six.moves.range(num_sacks)
+                if self.partitioner.belongs_to_self(i, replicas=replicas)]
+
     def _get_tasks(self):
+        num_sacks = self.incoming.NUM_SACKS
+        if num_sacks != len(self.fallback_tasks):
+            # NOTE(jd) The number of sacks has been changed online.
+            self.fallback_tasks = self._get_fallback_tasks(num_sacks)
+            self._tasks = []
         try:
             self.coord.run_watchers()
             if (not self._tasks or
                     self.group_state != self.partitioner.ring.nodes):
                 self.group_state = self.partitioner.ring.nodes.copy()
-                self._tasks = [
-                    i for i in six.moves.range(self.incoming.NUM_SACKS)
-                    if self.partitioner.belongs_to_self(
-                        i, replicas=self.conf.metricd.processing_replicas)]
+                self._tasks = self._get_sacks_owned(num_sacks)
         except Exception as e:
             LOG.error('Unexpected error updating the task partitioner: %s', e)
         finally:
             return self._tasks or self.fallback_tasks
 
+    def _drain_sacks(self):
+        """Move the measures of the sacks being drained to the new sacks.
+
+        :return: The number of metrics whose measures have been moved.
+        """
+        draining, __ = self.incoming.get_draining_group()
+        if draining is None:
+            return 0
+        try:
+            sacks = self._get_sacks_owned(draining.NUM_SACKS)
+        except Exception:
+            sacks = list(six.moves.range(draining.NUM_SACKS))
+        moved = 0
+        for s in sacks:
+            lock = draining.get_sack_lock(self.coord, s)
+            with self.store.lock_statistics.acquire(
+                    "sack", lock, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                try:
+                    moved += self._drain_sack(draining, s)
+                except Exception:
+                    LOG.error("Unexpected error moving measures of sack %s",
+                              draining.get_sack_name(s), exc_info=True)
+        if moved:
+            LOG.debug("Moved measures of %d metrics to the new sacks", moved)
+        elif self.incoming.remove_draining_group():
+            LOG.info("The previous %d sacks have been removed",
+                     draining.NUM_SACKS)
+        return moved
+
+    def _drain_sack(self, draining, sack):
+        # NOTE(jd) The measures are moved rather than processed: a metric can
+        # have measures in both its previous and its new sack, which are not
+        # protected by the same lock.
+        with draining.process_measures_for_sack(sack) as measures:
+            # NOTE(jd) The measures of deleted metrics are dropped.
+            metrics = self.index.list_metrics(ids=list(measures))
+            if metrics:
+                self.incoming.add_measures_batch(dict(
+                    (metric, measures[str(metric.id)]) for metric in metrics))
+            return len(measures)
+
     def _run_job(self):
         m_count = 0
         s_count = 0
-        for s in self._get_tasks():
+        max_lag = 0
+        for s in self._get_sacks_to_process():
             # TODO(gordc): support delay release lock so we don't
             # process a sack right after another process
             lock = self.incoming.get_sack_lock(self.coord, s)
-            if not lock.acquire(blocking=False):
-                continue
-            try:
-                metrics = self.incoming.list_metric_with_measures_to_process(s)
-                m_count += len(metrics)
-                self.store.process_background_tasks(
-                    self.index, self.incoming, metrics)
+            with self.store.lock_statistics.acquire(
+                    "sack", lock, blocking=False) as acquired:
+                if not acquired:
+                    continue
+                started_at = monotonic.monotonic()
+                try:
+                    count = self.store.process_new_measures_for_sack(
+                        self.index, self.incoming, s)
+                except Exception:
+                    LOG.error("Unexpected error processing assigned job",
+                              exc_info=True)
+                    continue
+                m_count += count
                 s_count += 1
+                lag = self.scheduler.processed(s, started_at, count)
+                if count:
+                    if lag is None:
+                        LOG.debug("%d metrics processed from sack %s",
+                                  count, s)
+                    elif lag > self.scheduler.max_delay:
+                        LOG.warning("%d metrics processed from sack %s, "
+                                    "measures waited up to %.2fs, more "
+                                    "than the %ds of "
+                                    "`metric_processing_delay'",
+                                    count, s, lag, self.scheduler.max_delay)
+                    else:
+                        LOG.debug("%d metrics processed from sack %s, "
+                                  "measures waited up to %.2fs",
+                                  count, s, lag)
+                    if lag is not None:
+                        max_lag = max(max_lag, lag)
+        LOG.debug("%d metrics processed from %d sacks, measures waited up "
+                  "to %.2fs", m_count, s_count, max_lag)
+        if self._full_pass:
+            self._drain_sacks()
+        for kind, stats in sorted(six.iteritems(
+                self.store.lock_statistics.report(reset=True))):
+            LOG.debug("%s locks: %d acquired, %d busy, waited %.3fs "
+                      "(max %.3fs), held %.3fs (max %.3fs)",
+                      kind, stats['acquired'], stats['busy'],
+                      stats['wait'], stats['max_wait'],
+                      stats['hold'], stats['max_hold'])
+
+    def close_services(self):
+        self.coord.stop()
+
+
+class MetricSplitTasksProcessor(MetricProcessBase):
+    name = "split-tasks"
+
+    def __init__(self, worker_id, conf, split_tasks):
+        super(MetricSplitTasksProcessor, self).__init__(worker_id, conf)
+        self.split_tasks = split_tasks
+        # NOTE(jd) Tasks to run again, kept here rather than in the queue,
+        # which may be full.
+        self._retry_tasks = []
+        self._rescan_marker = None
+        self._rescan_timer = None
+        # When the current rescan started
+        self._rescan_started = None
+        # Only the splits ending after this are looked at by the rescans
+        self._rescan_since = None
+
+    def _configure(self):
+        self.coord = retry_on_exception(utils.get_coordinator_and_start,
+                                        self.conf.storage.coordination_url)
+        self.store = retry_on_exception(storage.get_driver,
+                                        self.conf, self.coord)
+        self.incoming = retry_on_exception(incoming.get_driver, self.conf)
+        self.index = retry_on_exception(indexer.get_driver, self.conf)
+
+    def _get_batch(self):
+        batch_size = self.conf.metricd.split_tasks_batch_size
+        tasks = self._retry_tasks[:batch_size]
+        self._retry_tasks = self._retry_tasks[batch_size:]
+        if not tasks:
+            try:
+                tasks = [self.split_tasks.get(timeout=1)]
+            except six.moves.queue.Empty:
+                return []
+        while len(tasks) < batch_size:
+            try:
+                tasks.append(self.split_tasks.get_nowait())
+            except six.moves.queue.Empty:
+                break
+        return tasks
+
+    def _run_job(self):
+        tasks = self._get_batch()
+        if not tasks:
+            self._rescan_uncompressed_splits()
+            return
+        requeued = 0
+        with utils.StopWatch() as timer:
+            by_sack = collections.defaultdict(list)
+            for task in tasks:
+                by_sack[self.incoming.sack_for_metric(task.metric_id)].append(
+                    task)
+            for sack, sack_tasks in six.iteritems(by_sack):
+                # NOTE(jd) Hold the sack lock so splits are not modified or
+                # deleted by another worker while we rewrite them. Do not
+                # wait for a sack being processed, its tasks are run again
+                # with a next batch.
+                lock = self.incoming.get_sack_lock(self.coord, sack)
+                if not lock.acquire(blocking=False):
+                    LOG.debug("Sack %s is locked, retrying %d split tasks "
+                              "later", sack, len(sack_tasks))
+                    for task in sack_tasks:
+                        self._requeue(task)
+                    requeued += len(sack_tasks)
+                    continue
+                try:
+                    self.store.process_split_tasks(self.index, sack_tasks)
+                except Exception:
+                    LOG.error("Unexpected error running split tasks",
+                              exc_info=True)
+                finally:
+                    lock.release()
+        LOG.debug("%d split tasks run in %.2f seconds",
+                  len(tasks) - requeued, timer.elapsed())
+        if requeued == len(tasks):
+            # NOTE(jd) All the sacks were locked, do not retry right away.
+            self._shutdown.wait(1)
+            return
+        if self.conf.metricd.split_tasks_rate:
+            self._shutdown.wait(max(
+                0, len(tasks) / self.conf.metricd.split_tasks_rate
+                - timer.elapsed()))
+
+    def _requeue(self, task):
+        self._retry_tasks.append(task)
+
+    def _rescan_uncompressed_splits(self):
+        """Look for uncompressed splits in a batch of metrics.
+
+        The queue only lives in memory, so the compaction tasks are lost when
+        gnocchi-metricd stops. Once every `split_tasks_rescan_delay' seconds,
+        all the metrics are looked at, one batch each time the queue is
+        empty. The first rescan looks at all the splits, the next ones only
+        at the splits that ended at most `split_tasks_rescan_delay' seconds
+        before the previous complete rescan started.
+        """
+        delay = self.conf.metricd.split_tasks_rescan_delay
+        if not delay or self.store.WRITE_FULL:
+            return
+        if self._rescan_marker is None:
+            if (self._rescan_timer is not None
+                    and self._rescan_timer.elapsed() < delay):
+                return
+            self._rescan_timer = utils.StopWatch().start()
+            self._rescan_started = utils.to_timestamp(time.time())
+        try:
+            metrics = self.index.list_metrics(
+                limit=self.conf.metricd.split_tasks_batch_size,
+                marker=self._rescan_marker, sorts=["id:asc"])
+        except indexer.InvalidPagination:
+            # NOTE(jd) The marker metric has been deleted, start over.
+            self._rescan_marker = None
+            self._rescan_timer = None
+            return
+        if not metrics:
+            # NOTE(jd) Splits become immutable once newer measures are
+            # processed, which may have been sent late: look one more delay
+            # back next time.
+            self._rescan_marker = None
+            self._rescan_since = (self._rescan_started
+                                  - utils.to_timespan(delay))
+            return
+        self._rescan_marker = str(metrics[-1].id)
+        for metric in metrics:
+            try:
+                tasks = self.store.find_uncompressed_splits(
+                    metric, self._rescan_since)
             except Exception:
-                LOG.error("Unexpected error processing assigned job",
-                          exc_info=True)
-            finally:
-                lock.release()
-        LOG.debug("%d metrics processed from %d sacks", m_count, s_count)
+                LOG.error("Unable to look for uncompressed splits of metric "
+                          "%s", metric, exc_info=True)
+                continue
+            if tasks:
+                LOG.info("Compacting %d uncompressed splits of metric %s",
+                         len(tasks), metric)
+                self._retry_tasks.extend(tasks)
 
     def close_services(self):
+        if self._retry_tasks:
+            LOG.warning("%d split tasks have not been run, the splits to "
+                        "compact will be found again by the next rescan",
+                        len(self._retry_tasks))
         self.coord.stop()
 
 
@@ -281,18 +684,59 @@ class MetricJanitor(MetricProcessBase):
             LOG.error("Unexpected error during metric cleanup", exc_info=True)
 
 
+class MetricTierMigrator(MetricProcessBase):
+    name = "tier-migration"
+
+    def __init__(self, worker_id, conf):
+        super(MetricTierMigrator, self).__init__(
+            worker_id, conf, conf.metricd.tier_migration_delay)
+        self._marker = None
+
+    def _run_job(self):
+        try:
+            metrics = self.index.list_metrics(
+                limit=self.conf.metricd.tier_migration_batch_size,
+                marker=self._marker, sorts=["id:asc"])
+        except indexer.InvalidPagination:
+            # NOTE(jd) The marker metric has been deleted, start over.
+            self._marker = None
+            return
+        # NOTE(jd) Start over from the first metric once all have been seen.
+        self._marker = str(metrics[-1].id) if metrics else None
+        moved = 0
+        with utils.StopWatch() as timer:
+            for metric in metrics:
+                try:
+                    moved += self.store.migrate_metric(
+                        self.incoming, metric) or 0
+                except Exception:
+                    LOG.error("Unable to move splits of metric %s to the "
+                              "cold tier", metric, exc_info=True)
+        LOG.debug("%d splits of %d metrics moved to the cold tier in %.2f "
+                  "seconds", moved, len(metrics), timer.elapsed())
+
+
 class MetricdServiceManager(cotyledon.ServiceManager):
     def __init__(self, conf):
         super(MetricdServiceManager, self).__init__()
         oslo_config_glue.setup(self, conf)
 
         self.conf = conf
+        if conf.metricd.defer_split_tasks:
+            # NOTE(jd) The queue is inherited by the forked workers
+            split_tasks = multiprocessing.Queue(
+                conf.metricd.split_tasks_queue_size)
+            self.add(MetricSplitTasksProcessor, args=(self.conf, split_tasks))
+        else:
+            split_tasks = None
         self.metric_processor_id = self.add(
-            MetricProcessor, args=(self.conf,),
+            MetricProcessor, args=(self.conf, split_tasks),
             workers=conf.metricd.workers)
         if self.conf.metricd.metric_reporting_delay >= 0:
             self.add(MetricReporting, args=(self.conf,))
         self.add(MetricJanitor, args=(self.conf,))
+        if self.conf.storage.driver == "tiered":
+            self.add(MetricTierMigrator, args=(self.conf,))
 
         self.register_hooks(on_reload=self.on_reload)
 
@@ -0,0 +1,152 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import errno
+import hashlib
+import os
+import uuid
+
+import daiquiri
+
+from gnocchi import utils
+
+
+LOG = daiquiri.getLogger(__name__)
+
+# Number of hexadecimal digits of the hash used by each level of
+# subdirectories, i.e. 256 subdirectories per level.
+SHARD_WIDTH = 2
+
+
+def get_shards(name, levels):
+    """Return the subdirectories where `name' is stored."""
+    if not levels:
+        return []
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH]
+            for i in range(levels)]
+
+
+def get_path(basepath, name, levels):
+    """Return the path of `name' in `basepath' sharded on `levels' levels."""
+    return os.path.join(basepath, *(get_shards(name, levels) + [name]))
+
+
+def _listdir(path):
+    try:
+        return os.listdir(path)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+
+
+def list_names(basepath, levels):
+    """List the names stored in `basepath' sharded on `levels' levels."""
+    if not levels:
+        return _listdir(basepath)
+    names = []
+    for shard in _listdir(basepath):
+        if len(shard) == SHARD_WIDTH:
+            names.extend(list_names(os.path.join(basepath, shard),
+                                    levels - 1))
+    return names
+
+
+def _is_uuid(name):
+    try:
+        uuid.UUID(name)
+    except ValueError:
+        return False
+    return True
+
+
+def get_subdir_levels(path):
+    """Return the levels of subdirectories recorded in `path', if any."""
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return
+        raise
+
+
+def get_current_subdir_levels(path, levels):
+    """Return the levels of subdirectories to use.
+
+    The levels recorded in `path' are used until gnocchi-upgrade moves the
+    directories to the `levels' configured.
+    """
+    current = get_subdir_levels(path)
+    if current is None or current == levels:
+        return levels
+    LOG.warning("The directories of %s are stored on %d levels of "
+                "subdirectories, not on %d: run gnocchi-upgrade to move them",
+                os.path.dirname(os.path.dirname(path)), current, levels)
+    return current
+
+
+def set_subdir_levels(path, levels):
+    """Record the levels of subdirectories in `path'."""
+    with open(path + ".tmp", "w") as f:
+        f.write(str(levels))
+    os.rename(path + ".tmp", path)
+
+
+def _remove_empty_shards(basepath, levels):
+    for shard in _listdir(basepath):
+        if len(shard) != SHARD_WIDTH:
+            continue
+        path = os.path.join(basepath, shard)
+        if levels > 1:
+            _remove_empty_shards(path, levels - 1)
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+
+
+def shard_directory(basepath, levels, previous_levels=0):
+    """Move the metric directories of `basepath' to their shard.
+
+    :param levels: The levels of subdirectories to move them to.
+    :param previous_levels: The levels of subdirectories they are in.
+    :return: The number of directories moved.
+    """
+    if levels == previous_levels:
+        return 0
+    moved = 0
+    for name in list_names(basepath, previous_levels):
+        if not _is_uuid(name):
+            continue
+        src = get_path(basepath, name, previous_levels)
+        path = get_path(basepath, name, levels)
+        utils.ensure_paths([os.path.dirname(path)])
+        try:
+            os.rename(src, path)
+        except OSError as e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                raise
+            # NOTE(jd) Already created in its shard, move the files.
+            for f in os.listdir(src):
+                os.rename(os.path.join(src, f), os.path.join(path, f))
+            os.rmdir(src)
+        moved += 1
+    if previous_levels:
+        _remove_empty_shards(basepath, previous_levels)
+    if moved:
+        LOG.info("Moved %d directories of %s from %d to %d levels of "
+                 "subdirectories", moved, basepath, previous_levels, levels)
+    return moved
@@ -11,6 +11,9 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import contextlib
+import threading
+
 import daiquiri
 from six.moves.urllib.parse import quote
 
@@ -52,6 +55,53 @@ def get_connection(conf):
         retries=0)
 
 
+class ConnectionPool(object):
+    """Share Swift connections between threads.
+
+    A swiftclient connection keeps its HTTP connection alive between requests
+    but cannot be used by several threads at once. The pool lends one
+    connection per caller, creating up to `size' of them, and blocks the
+    callers once they are all in use. The methods of the swiftclient
+    connection can be called directly on the pool.
+    """
+
+    def __init__(self, conf, size):
+        self.conf = conf
+        self.size = size
+        self._semaphore = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._connections = []
+
+    @contextlib.contextmanager
+    def connection(self):
+        with self._semaphore:
+            with self._lock:
+                conn = self._connections.pop() if self._connections else None
+            if conn is None:
+                conn = get_connection(self.conf)
+            try:
+                yield conn
+            finally:
+                with self._lock:
+                    self._connections.append(conn)
+
+    def __getattr__(self, name):
+        def _call(*args, **kwargs):
+            with self.connection() as conn:
+                return getattr(conn, name)(*args, **kwargs)
+        return _call
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+
+def get_connection_pool(conf):
+    return ConnectionPool(conf, conf.swift_max_connections)
+
+
 POST_HEADERS = {'Accept': 'application/json', 'Content-Type': 'text/plain'}
 
 
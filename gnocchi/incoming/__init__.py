@@ -15,6 +15,11 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 from concurrent import futures
+import contextlib
+import copy
+import os
+import threading
+import time
 
 import daiquiri
 import numpy
@@ -28,6 +33,8 @@ LOG = daiquiri.getLogger(__name__)
 
 _NUM_WORKERS = utils.get_default_workers()
 
+_TIMESERIES_ARRAY_ITEMSIZE = numpy.dtype(TIMESERIES_ARRAY_DTYPE).itemsize
+
 
 class ReportGenerationError(Exception):
     pass
@@ -42,16 +49,36 @@ class IncomingDriver(object):
     SACK_PREFIX = "incoming"
     CFG_PREFIX = 'gnocchi-config'
     CFG_SACKS = 'sacks'
+    CFG_DRAINING_SACKS = 'draining_sacks'
+    CFG_DRAINING_SINCE = 'draining_since'
+
+    # Number of seconds after which the number of sacks is read again, so
+    # running processes follow an online change of the number of sacks.
+    SACKS_REFRESH_DELAY = 60
+
+    # True for the drivers returned by `get_draining_group'
+    _draining_group = False
 
     @property
     def NUM_SACKS(self):
-        if not hasattr(self, '_num_sacks'):
+        if (not hasattr(self, '_num_sacks') or
+                (not self._draining_group and
+                 self._num_sacks_timer.elapsed() > self.SACKS_REFRESH_DELAY)):
             try:
-                self._num_sacks = int(self.get_storage_sacks())
+                num_sacks = int(self.get_storage_sacks())
             except Exception as e:
-                LOG.error('Unable to detect the number of storage sacks. '
-                          'Ensure gnocchi-upgrade has been executed: %s', e)
-                raise SackDetectionError(e)
+                if hasattr(self, '_num_sacks'):
+                    LOG.warning('Unable to refresh the number of storage '
+                                'sacks, still using %d: %s',
+                                self._num_sacks, e)
+                    num_sacks = self._num_sacks
+                else:
+                    LOG.error('Unable to detect the number of storage '
+                              'sacks. Ensure gnocchi-upgrade has been '
+                              'executed: %s', e)
+                    raise SackDetectionError(e)
+            self._num_sacks = num_sacks
+            self._num_sacks_timer = utils.StopWatch().start()
         return self._num_sacks
 
     @staticmethod
@@ -66,41 +93,109 @@ class IncomingDriver(object):
         if not self.get_storage_sacks():
             self.set_storage_settings(num_sacks)
 
+    def set_storage_settings(self, num_sacks, draining_sacks=None):
+        """Set the number of sacks.
+
+        :param num_sacks: The number of sacks measures are written to.
+        :param draining_sacks: The number of sacks of the group whose measures
+                               are moved to the new sacks, if any.
+        """
+        settings = {self.CFG_SACKS: num_sacks}
+        if draining_sacks:
+            settings[self.CFG_DRAINING_SACKS] = draining_sacks
+            settings[self.CFG_DRAINING_SINCE] = time.time()
+        self._num_sacks = num_sacks
+        self._num_sacks_timer = utils.StopWatch().start()
+        self._set_storage_settings(settings)
+
     @staticmethod
-    def set_storage_settings(num_sacks):
+    def _set_storage_settings(settings):
         raise exceptions.NotImplementedError
 
     @staticmethod
-    def remove_sack_group(num_sacks):
+    def _get_storage_settings():
+        """Return the storage settings as a dict. Empty if not set."""
         raise exceptions.NotImplementedError
 
     @staticmethod
-    def get_storage_sacks():
-        """Return the number of sacks in storage. None if not set."""
+    def remove_sack_group(num_sacks):
         raise exceptions.NotImplementedError
 
-    @staticmethod
-    def get_sack_lock(coord, sack):
-        lock_name = b'gnocchi-sack-%s-lock' % str(sack).encode('ascii')
-        return coord.get_lock(lock_name)
+    def get_storage_sacks(self):
+        """Return the number of sacks in storage. None if not set."""
+        return self._get_storage_settings().get(self.CFG_SACKS)
 
-    def _make_measures_array(self):
-        return numpy.array([], dtype=TIMESERIES_ARRAY_DTYPE)
+    def get_draining_group(self):
+        """Return a driver for the sack group being drained, if any.
+
+        :return: A driver working on the sacks of the previous group, and the
+                 number of seconds since the group has been replaced; or
+                 (None, None).
+        """
+        if self._draining_group:
+            return None, None
+        settings = self._get_storage_settings()
+        num_sacks = settings.get(self.CFG_DRAINING_SACKS)
+        if not num_sacks:
+            return None, None
+        driver = copy.copy(self)
+        driver._draining_group = True
+        driver._num_sacks = int(num_sacks)
+        return driver, max(
+            0, time.time() - float(settings[self.CFG_DRAINING_SINCE]))
+
+    def remove_draining_group(self):
+        """Remove the sack group being drained once it is empty.
+
+        Processes still using the previous number of sacks may write to the
+        group until they refresh it, so it is only removed after a while.
+
+        :return: True if the group has been removed.
+        """
+        driver, since = self.get_draining_group()
+        if (driver is None or since < 2 * self.SACKS_REFRESH_DELAY or
+                driver.measures_report(details=False)['summary']['metrics']):
+            return False
+        LOG.info("Removing the %d sacks drained", driver.NUM_SACKS)
+        self.set_storage_settings(self.get_storage_sacks())
+        driver.remove_sack_group(driver.NUM_SACKS)
+        return True
+
+    def get_sack_lock(self, coord, sack):
+        # NOTE(jd) The sacks of each group have the same numbers: name the
+        # lock after the sack name, so a process still writing to or
+        # processing the previous group and the one draining it share it.
+        lock_name = b'gnocchi-sack-%s-lock' % self.get_sack_name(
+            sack).encode('ascii')
+        return coord.get_lock(lock_name)
 
     @staticmethod
-    def _array_concatenate(arrays):
-        if arrays:
-            return numpy.concatenate(arrays)
-        return arrays
+    def _unserialize_measures(items):
+        """Unserialize the measures of several objects into one array.
 
-    def _unserialize_measures(self, measure_id, data):
-        try:
-            return numpy.frombuffer(data, dtype=TIMESERIES_ARRAY_DTYPE)
-        except ValueError:
-            LOG.error(
-                "Unable to decode measure %s, possible data corruption",
-                measure_id)
-            raise
+        The array is allocated once and filled with the data of every object,
+        rather than grown for each of them.
+
+        :param items: A list of (measure id, data) of the objects.
+        """
+        itemsize = _TIMESERIES_ARRAY_ITEMSIZE
+        size = 0
+        for measure_id, data in items:
+            if len(data) % itemsize:
+                LOG.error(
+                    "Unable to decode measure %s, possible data corruption",
+                    measure_id)
+                raise ValueError("buffer size must be a multiple of "
+                                 "element size")
+            size += len(data)
+        measures = numpy.empty(size // itemsize, dtype=TIMESERIES_ARRAY_DTYPE)
+        raw = measures.view(numpy.uint8)
+        offset = 0
+        for measure_id, data in items:
+            raw[offset:offset + len(data)] = numpy.frombuffer(
+                data, dtype=numpy.uint8)
+            offset += len(data)
+        return measures
 
     def _encode_measures(self, measures):
         return numpy.array(list(measures),
@@ -140,6 +235,16 @@ class IncomingDriver(object):
                   'details': {metric_id: pending_measures_count}}
         """
         metrics, measures, full_details = self._build_report(details)
+        # NOTE(jd) Include the measures waiting to be moved to the new sacks
+        draining, __ = self.get_draining_group()
+        if draining is not None:
+            d_metrics, d_measures, d_details = draining._build_report(details)
+            metrics += d_metrics
+            measures += d_measures
+            if full_details is not None:
+                for metric_id, count in six.iteritems(d_details):
+                    full_details[metric_id] = (
+                        full_details.get(metric_id, 0) + count)
         report = {'summary': {'metrics': metrics, 'measures': measures}}
         if full_details is not None:
             report['details'] = full_details
@@ -161,6 +266,44 @@ class IncomingDriver(object):
     def process_measure_for_metric(metric):
         raise exceptions.NotImplementedError
 
+    @contextlib.contextmanager
+    def process_measures_for_sack(self, sack, max_metrics=None):
+        """Read the pending measures of the metrics of a sack in one pass.
+
+        :param sack: The sack to read.
+        :param max_metrics: The maximum number of metrics to read, if any.
+        :return: A context manager yielding a dict of measures indexed by
+                 metric id. On exit, the measures of the metrics still in
+                 the dict are deleted at once: remove the metrics whose
+                 measures have not been processed from it.
+        """
+        measures, processed = self._get_sack_measures(sack, max_metrics)
+        yield measures
+        self._delete_sack_measures(sack, dict(
+            (metric_id, processed[metric_id]) for metric_id in measures))
+
+    @staticmethod
+    def _get_sack_measures(sack, max_metrics=None):
+        """Return the measures of the metrics of a sack.
+
+        :return: A dict of measures indexed by metric id, and a dict of what
+                 has been read, indexed by metric id, to pass to
+                 `_delete_sack_measures'.
+        """
+        raise exceptions.NotImplementedError
+
+    @staticmethod
+    def _delete_sack_measures(sack, processed):
+        raise exceptions.NotImplementedError
+
+    @staticmethod
+    def iter_on_sacks_to_process():
+        """Return an iterable of the sacks that got new measures to process.
+
+        The iterable blocks until a sack gets new measures.
+        """
+        raise exceptions.NotImplementedError
+
     @staticmethod
     def has_unprocessed(metric):
         raise exceptions.NotImplementedError
@@ -172,6 +315,124 @@ class IncomingDriver(object):
         return self.get_sack_prefix() % sack
 
 
+class _MeasuresBatch(object):
+    """Measures waiting to be written, merged per metric."""
+
+    def __init__(self):
+        self.measures = {}
+        self.size = 0
+        self.watch = None
+        self.error = None
+        self.done = threading.Event()
+
+    def add(self, metrics_and_measures):
+        if self.watch is None:
+            self.watch = utils.StopWatch().start()
+        for metric, measures in six.iteritems(metrics_and_measures):
+            measures = list(measures)
+            self.measures.setdefault(metric.id, (metric, []))[1].extend(
+                measures)
+            self.size += len(measures)
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitIncoming(object):
+    """Coalesce the measures added by a process into batches.
+
+    The measures added by all the threads during `delay' seconds, or until
+    `max_measures' are waiting, are merged per metric and written by one
+    call to `add_measures_batch' of the incoming driver. If `wait' is True,
+    adding measures returns once they are written and raises the error of
+    the write, otherwise measures waiting to be written are lost if the
+    process dies.
+    """
+
+    def __init__(self, driver, delay, max_measures, wait=True):
+        self.driver = driver
+        self.delay = delay
+        self.max_measures = max_measures
+        self.wait = wait
+        self._cond = threading.Condition()
+        self._batch = _MeasuresBatch()
+        self._flusher = None
+        self._pid = None
+        self._stopped = False
+
+    def __getattr__(self, attr):
+        return getattr(self.driver, attr)
+
+    def __str__(self):
+        return "%s: %s" % (self.__class__.__name__, self.driver)
+
+    def add_measures(self, metric, measures):
+        self.add_measures_batch({metric: measures})
+
+    def add_measures_batch(self, metrics_and_measures):
+        with self._cond:
+            if self._stopped:
+                batch = None
+            else:
+                # NOTE(jd) The API may fork after the app has been loaded,
+                # start the flusher in the process that adds measures.
+                if self._pid != os.getpid():
+                    self._pid = os.getpid()
+                    self._batch = _MeasuresBatch()
+                    self._flusher = threading.Thread(target=self._run)
+                    self._flusher.daemon = True
+                    self._flusher.start()
+                batch = self._batch
+                batch.add(metrics_and_measures)
+                if batch.size >= self.max_measures:
+                    self._cond.notify_all()
+        if batch is None:
+            self.driver.add_measures_batch(metrics_and_measures)
+        elif self.wait:
+            batch.wait()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._batch.size and not self._stopped:
+                    self._cond.wait()
+                while (not self._stopped and
+                       self._batch.size < self.max_measures):
+                    remaining = self.delay - self._batch.watch.elapsed()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch, self._batch = self._batch, _MeasuresBatch()
+                stopped = self._stopped
+            self._flush(batch)
+            if stopped:
+                return
+
+    def _flush(self, batch):
+        try:
+            if batch.size:
+                self.driver.add_measures_batch(
+                    dict(six.itervalues(batch.measures)))
+        except Exception as e:
+            if not self.wait:
+                LOG.error("Unable to write %d measures of %d metrics",
+                          batch.size, len(batch.measures), exc_info=True)
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def stop(self):
+        """Write the measures waiting and stop batching."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+            flusher = self._flusher
+        if flusher is not None and self._pid == os.getpid():
+            flusher.join()
+
+
 def get_driver(conf):
     """Return configured incoming driver only
 
@@ -14,10 +14,10 @@
 from collections import defaultdict
 import contextlib
 import datetime
+import itertools
 import json
 import uuid
 
-import numpy
 import six
 
 from gnocchi.common import ceph
@@ -62,16 +62,14 @@ class CephStorage(incoming.IncomingDriver):
         ceph.close_rados_connection(self.rados, self.ioctx)
         super(CephStorage, self).stop()
 
-    def get_storage_sacks(self):
+    def _get_storage_settings(self):
         try:
-            return json.loads(
-                self.ioctx.read(self.CFG_PREFIX).decode())[self.CFG_SACKS]
+            return json.loads(self.ioctx.read(self.CFG_PREFIX).decode())
         except rados.ObjectNotFound:
-            return
+            return {}
 
-    def set_storage_settings(self, num_sacks):
-        self.ioctx.write_full(self.CFG_PREFIX,
-                              json.dumps({self.CFG_SACKS: num_sacks}).encode())
+    def _set_storage_settings(self, settings):
+        self.ioctx.write_full(self.CFG_PREFIX, json.dumps(settings).encode())
 
     def remove_sack_group(self, num_sacks):
         prefix = self.get_sack_prefix(num_sacks)
@@ -197,7 +195,6 @@ class CephStorage(incoming.IncomingDriver):
         sack = self.sack_for_metric(metric.id)
         key_prefix = self.MEASURE_PREFIX + "_" + str(metric.id)
 
-        processed_keys = []
         with rados.ReadOpCtx() as op:
             omaps, ret = self.ioctx.get_omap_vals(op, "", key_prefix, -1)
             self.ioctx.operate_read_op(op, self.get_sack_name(sack),
@@ -215,12 +212,10 @@ class CephStorage(incoming.IncomingDriver):
                 # in the OMAP listing, ignore
                 return
 
-        measures = self._make_measures_array()
-        for k, v in omaps:
-            measures = numpy.append(measures, self._unserialize_measures(k, v))
-            processed_keys.append(k)
+        omaps = list(omaps)
+        processed_keys = [k for k, v in omaps]
 
-        yield measures
+        yield self._unserialize_measures(omaps)
 
         # Now clean omap
         with rados.WriteOpCtx() as op:
@@ -229,3 +224,50 @@ class CephStorage(incoming.IncomingDriver):
             self.ioctx.remove_omap_keys(op, tuple(processed_keys))
             self.ioctx.operate_write_op(op, self.get_sack_name(sack),
                                         flags=self.OMAP_WRITE_FLAGS)
+
+    def _get_sack_measures(self, sack, max_metrics=None):
+        measures = defaultdict(list)
+        processed = defaultdict(list)
+        marker = ""
+        while True:
+            with rados.ReadOpCtx() as op:
+                omaps, ret = self.ioctx.get_omap_vals(
+                    op, marker, self.MEASURE_PREFIX, self.Q_LIMIT)
+                try:
+                    self.ioctx.operate_read_op(
+                        op, self.get_sack_name(sack),
+                        flag=self.OMAP_READ_FLAGS)
+                except rados.ObjectNotFound:
+                    # API have still written nothing
+                    break
+                try:
+                    ceph.errno_to_exception(ret)
+                except rados.ObjectNotFound:
+                    break
+                omaps = list(omaps)
+            for k, v in omaps:
+                metric_id = k.split("_")[1]
+                # NOTE(jd) Keys are sorted, so the measures of a metric are
+                # all read before the next metric.
+                if (max_metrics is not None and metric_id not in measures
+                        and len(measures) >= max_metrics):
+                    break
+                measures[metric_id].append((k, v))
+                processed[metric_id].append(k)
+            else:
+                if len(omaps) == self.Q_LIMIT:
+                    marker = omaps[-1][0]
+                    continue
+            break
+        return (dict((metric_id, self._unserialize_measures(data))
+                     for metric_id, data in six.iteritems(measures)),
+                processed)
+
+    def _delete_sack_measures(self, sack, processed):
+        keys = tuple(itertools.chain.from_iterable(six.itervalues(processed)))
+        if not keys:
+            return
+        with rados.WriteOpCtx() as op:
+            self.ioctx.remove_omap_keys(op, keys)
+            self.ioctx.operate_write_op(op, self.get_sack_name(sack),
+                                        flags=self.OMAP_WRITE_FLAGS)
@@ -14,15 +14,16 @@
 import contextlib
 import datetime
 import errno
+import itertools
 import json
 import os
 import shutil
 import tempfile
 import uuid
 
-import numpy
 import six
 
+from gnocchi.common import file as common_file
 from gnocchi import incoming
 from gnocchi import utils
 
@@ -32,6 +33,11 @@ class FileStorage(incoming.IncomingDriver):
         super(FileStorage, self).__init__(conf)
         self.basepath = conf.file_basepath
         self.basepath_tmp = os.path.join(self.basepath, 'tmp')
+        self._subdir_levels_path = os.path.join(self.basepath_tmp,
+                                                "incoming_subdir_levels")
+        self._configured_subdir_levels = conf.file_subdir_levels
+        self.subdir_levels = common_file.get_current_subdir_levels(
+            self._subdir_levels_path, conf.file_subdir_levels)
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, str(self.basepath))
@@ -39,23 +45,36 @@ class FileStorage(incoming.IncomingDriver):
     def upgrade(self, num_sacks):
         super(FileStorage, self).upgrade(num_sacks)
         utils.ensure_paths([self.basepath_tmp])
-
-    def get_storage_sacks(self):
+        previous_levels = common_file.get_subdir_levels(
+            self._subdir_levels_path) or 0
+        sack_paths = [self._sack_path(i)
+                      for i in six.moves.range(self.NUM_SACKS)]
+        draining, __ = self.get_draining_group()
+        if draining is not None:
+            sack_paths.extend(draining._sack_path(i)
+                              for i in six.moves.range(draining.NUM_SACKS))
+        for path in sack_paths:
+            common_file.shard_directory(
+                path, self._configured_subdir_levels, previous_levels)
+        common_file.set_subdir_levels(self._subdir_levels_path,
+                                      self._configured_subdir_levels)
+        self.subdir_levels = self._configured_subdir_levels
+
+    def _get_storage_settings(self):
         try:
             with open(os.path.join(self.basepath_tmp, self.CFG_PREFIX),
                       'r') as f:
-                return json.load(f)[self.CFG_SACKS]
+                return json.load(f)
         except IOError as e:
             if e.errno == errno.ENOENT:
-                return
+                return {}
             raise
 
-    def set_storage_settings(self, num_sacks):
-        data = {self.CFG_SACKS: num_sacks}
-        with open(os.path.join(self.basepath_tmp, self.CFG_PREFIX), 'w') as f:
-            json.dump(data, f)
+    def _set_storage_settings(self, settings):
         utils.ensure_paths([self._sack_path(i)
                             for i in six.moves.range(self.NUM_SACKS)])
+        with open(os.path.join(self.basepath_tmp, self.CFG_PREFIX), 'w') as f:
+            json.dump(settings, f)
 
     def remove_sack_group(self, num_sacks):
         prefix = self.get_sack_prefix(num_sacks)
@@ -66,7 +85,9 @@ class FileStorage(incoming.IncomingDriver):
         return os.path.join(self.basepath, self.get_sack_name(sack))
 
     def _measure_path(self, sack, metric_id):
-        return os.path.join(self._sack_path(sack), six.text_type(metric_id))
+        return common_file.get_path(self._sack_path(sack),
+                                    six.text_type(metric_id),
+                                    self.subdir_levels)
 
     def _build_measure_path(self, metric_id, random_id=None):
         sack = self.sack_for_metric(metric_id)
@@ -93,6 +114,9 @@ class FileStorage(incoming.IncomingDriver):
                 if e.errno != errno.ENOENT:
                     raise
                 try:
+                    if self.subdir_levels:
+                        utils.ensure_paths([os.path.dirname(
+                            self._build_measure_path(metric.id))])
                     os.mkdir(self._build_measure_path(metric.id))
                 except OSError as e:
                     # NOTE(jd) It's possible that another process created the
@@ -125,7 +149,8 @@ class FileStorage(incoming.IncomingDriver):
                 report_vars['metric_details'] if details else None)
 
     def list_metric_with_measures_to_process(self, sack):
-        return set(self._list_target(self._sack_path(sack)))
+        return set(common_file.list_names(self._sack_path(sack),
+                                          self.subdir_levels))
 
     def _list_measures_container_for_metric_id_str(self, sack, metric_id):
         return self._list_target(self._measure_path(sack, metric_id))
@@ -144,15 +169,19 @@ class FileStorage(incoming.IncomingDriver):
             raise
 
     def _delete_measures_files_for_metric_id(self, metric_id, files):
+        self._delete_measures_files(self._build_measure_path(metric_id), files)
+
+    @staticmethod
+    def _delete_measures_files(path, files):
         for f in files:
             try:
-                os.unlink(self._build_measure_path(metric_id, f))
+                os.unlink(os.path.join(path, f))
             except OSError as e:
                 # Another process deleted it in the meantime, no prob'
                 if e.errno != errno.ENOENT:
                     raise
         try:
-            os.rmdir(self._build_measure_path(metric_id))
+            os.rmdir(path)
         except OSError as e:
             # ENOENT: ok, it has been removed at almost the same time
             #         by another process
@@ -169,16 +198,34 @@ class FileStorage(incoming.IncomingDriver):
     def has_unprocessed(self, metric):
         return os.path.isdir(self._build_measure_path(metric.id))
 
+    def _read_measures_files(self, path, files):
+        data = []
+        for f in files:
+            with open(os.path.join(path, f), "rb") as e:
+                data.append((f, e.read()))
+        return self._unserialize_measures(data)
+
     @contextlib.contextmanager
     def process_measure_for_metric(self, metric):
         files = self._list_measures_container_for_metric_id(metric.id)
-        measures = self._make_measures_array()
-        for f in files:
-            abspath = self._build_measure_path(metric.id, f)
-            with open(abspath, "rb") as e:
-                measures = numpy.append(
-                    measures, self._unserialize_measures(f, e.read()))
 
-        yield measures
+        yield self._read_measures_files(self._build_measure_path(metric.id),
+                                        files)
 
         self._delete_measures_files_for_metric_id(metric.id, files)
+
+    def _get_sack_measures(self, sack, max_metrics=None):
+        measures = {}
+        processed = {}
+        for metric_id in itertools.islice(
+                self.list_metric_with_measures_to_process(sack), max_metrics):
+            path = self._measure_path(sack, metric_id)
+            files = self._list_target(path)
+            measures[metric_id] = self._read_measures_files(path, files)
+            processed[metric_id] = files
+        return measures, processed
+
+    def _delete_sack_measures(self, sack, processed):
+        for metric_id, files in six.iteritems(processed):
+            self._delete_measures_files(
+                self._measure_path(sack, metric_id), files)
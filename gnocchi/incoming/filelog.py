@@ -0,0 +1,319 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import collections
+import contextlib
+import errno
+import fcntl
+import itertools
+import os
+import struct
+import threading
+import uuid
+
+import daiquiri
+import six
+
+from gnocchi.incoming import file
+from gnocchi import utils
+
+
+LOG = daiquiri.getLogger(__name__)
+
+
+class _SackLog(object):
+    """The records of a sack log that have not been consumed yet."""
+
+    def __init__(self, committed):
+        self.committed = committed
+        # Offset up to which the log has been read
+        self.end = committed
+        # Measures of each metric, as a list of (offset, data)
+        self.measures = collections.OrderedDict()
+        self.deleted = set()
+
+    def copy(self):
+        log = _SackLog(self.committed)
+        log.end = self.end
+        log.measures = collections.OrderedDict(
+            (metric_id, list(measures))
+            for metric_id, measures in six.iteritems(self.measures))
+        log.deleted = set(self.deleted)
+        return log
+
+    def add(self, offset, kind, metric_id, payload):
+        if kind == FileLogStorage.MEASURES:
+            if metric_id not in self.deleted:
+                self.measures.setdefault(metric_id, []).append(
+                    (offset, payload))
+        elif kind == FileLogStorage.DELETE:
+            # NOTE(jd) Metric ids are never reused, so the records of a
+            # deleted metric found after its deletion are dropped too.
+            self.deleted.add(metric_id)
+            self.measures.pop(metric_id, None)
+        elif kind == FileLogStorage.ACK:
+            up_to = FileLogStorage.ACK_PAYLOAD.unpack(payload)[0]
+            measures = [(o, data) for o, data
+                        in self.measures.pop(metric_id, [])
+                        if o >= up_to]
+            if measures:
+                self.measures[metric_id] = measures
+
+
+class FileLogStorage(file.FileStorage):
+    """Append the measures of each sack to a log of segment files.
+
+    Each record is a header, with its kind, the metric id and the size of
+    its payload, followed by the payload. The offset of the first record not
+    processed yet is committed to the `offset' file of the sack, and the
+    segments before it are deleted. Measures are never deleted from the
+    middle of the log: deleting or processing the measures of a single
+    metric appends a record telling to drop them.
+    """
+
+    # Header of each record: its kind, the metric id and the payload size.
+    RECORD_HEADER = struct.Struct("<B16sI")
+    # Payload of an ACK record: the offset before which the measures of the
+    # metric have been processed.
+    ACK_PAYLOAD = struct.Struct("<Q")
+
+    MEASURES, DELETE, ACK = range(3)
+
+    SEGMENT_SUFFIX = ".log"
+
+    def __init__(self, conf):
+        super(FileLogStorage, self).__init__(conf)
+        self.segment_size = conf.file_log_segment_size
+        # NOTE(jd) The records before the committed offset are never
+        # modified and records are only appended after it, so the log read
+        # is kept per sack and only the records appended since are read.
+        self._sack_logs = {}
+        self._sack_logs_lock = threading.Lock()
+
+    def upgrade(self, num_sacks):
+        utils.ensure_paths([self.basepath_tmp])
+        # NOTE(jd) Skip the sharding of the metric directories of the file
+        # driver, there are none.
+        super(file.FileStorage, self).upgrade(num_sacks)
+
+    def _segment_path(self, sack, start):
+        return os.path.join(self._sack_path(sack),
+                            "%020d%s" % (start, self.SEGMENT_SUFFIX))
+
+    def _list_segments(self, sack):
+        """Return the start offset of the segments of a sack, in order."""
+        return sorted(int(name[:-len(self.SEGMENT_SUFFIX)])
+                      for name in self._list_target(self._sack_path(sack))
+                      if name.endswith(self.SEGMENT_SUFFIX))
+
+    def _get_committed_offset(self, sack):
+        try:
+            with open(os.path.join(self._sack_path(sack), "offset")) as f:
+                return int(f.read())
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return 0
+            raise
+
+    @contextlib.contextmanager
+    def _lock_sack_log(self, sack, operation=fcntl.LOCK_EX):
+        # NOTE(jd) Appending, rotating and deleting segments are serialized
+        # between processes, and reading them waits for appends in progress.
+        with open(os.path.join(self._sack_path(sack), "lock"), "a") as f:
+            fcntl.flock(f, operation)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _encode_record(self, kind, metric_id, payload=b""):
+        return self.RECORD_HEADER.pack(
+            kind, uuid.UUID(six.text_type(metric_id)).bytes,
+            len(payload)) + payload
+
+    def _append(self, sack, data):
+        """Append records to the log of a sack, the lock being held."""
+        segments = self._list_segments(sack)
+        if segments:
+            start = segments[-1]
+            size = os.path.getsize(self._segment_path(sack, start))
+            if size >= self.segment_size:
+                start += size
+        else:
+            start = self._get_committed_offset(sack)
+        with open(self._segment_path(sack, start), "ab") as f:
+            f.write(data)
+
+    def _append_records(self, sack, data):
+        with self._lock_sack_log(sack):
+            self._append(sack, data)
+
+    def add_measures_batch(self, metrics_and_measures):
+        data_by_sack = collections.defaultdict(list)
+        for metric, measures in six.iteritems(metrics_and_measures):
+            data_by_sack[self.sack_for_metric(metric.id)].append(
+                self._encode_record(self.MEASURES, metric.id,
+                                    self._encode_measures(measures)))
+        for sack, data in six.iteritems(data_by_sack):
+            self._append_records(sack, b"".join(data))
+
+    def _read_sack_log(self, sack, read=_SackLog.copy):
+        """Read the records of a sack that have not been consumed yet.
+
+        :param read: Called with the `_SackLog' while it cannot change,
+                     returns the result.
+        """
+        with self._sack_logs_lock:
+            key, log = self._read_new_records(sack)
+            self._sack_logs[key] = log
+            return read(log)
+
+    def _read_new_records(self, sack):
+        with self._lock_sack_log(sack, fcntl.LOCK_SH):
+            # NOTE(jd) The number of sacks may change and the directory of a
+            # sack may be removed and created again.
+            key = (self._sack_path(sack),
+                   os.stat(self._sack_path(sack)).st_ino)
+            committed = self._get_committed_offset(sack)
+            segments = [
+                (start, os.path.getsize(self._segment_path(sack, start)))
+                for start in self._list_segments(sack)]
+        log = self._sack_logs.get(key)
+        if log is None or log.committed != committed:
+            # NOTE(jd) Consumed by a commit since it has been read.
+            log = _SackLog(committed)
+        header_size = self.RECORD_HEADER.size
+        for start, size in segments:
+            if start + size <= log.end:
+                continue
+            base = max(log.end - start, 0)
+            try:
+                with open(self._segment_path(sack, start), "rb") as f:
+                    f.seek(base)
+                    data = f.read(size - base)
+            except IOError as e:
+                # NOTE(jd) Consumed and deleted since it has been listed.
+                if e.errno == errno.ENOENT:
+                    continue
+                raise
+            offset = 0
+            while offset + header_size <= len(data):
+                kind, metric_id, length = self.RECORD_HEADER.unpack_from(
+                    data, offset)
+                end = offset + header_size + length
+                if end > len(data):
+                    break
+                log.add(start + base + offset, kind,
+                        str(uuid.UUID(bytes=metric_id)),
+                        data[offset + header_size:end])
+                offset = end
+            if offset < len(data):
+                LOG.error("Unable to decode the record at offset %d of "
+                          "sack %d, possible data corruption",
+                          start + base + offset, sack)
+            log.end = start + size
+        return key, log
+
+    def _commit(self, sack, end, requeue=None):
+        """Mark the records before `end' as consumed.
+
+        :param requeue: Measures read but not processed, indexed by metric
+                        id, appended again to the log.
+        """
+        with self._lock_sack_log(sack):
+            if not requeue and end <= self._get_committed_offset(sack):
+                return
+            if requeue:
+                self._append(sack, b"".join(
+                    self._encode_record(self.MEASURES, metric_id,
+                                        b"".join(data for __, data
+                                                 in measures))
+                    for metric_id, measures in six.iteritems(requeue)))
+            path = os.path.join(self._sack_path(sack), "offset")
+            with open(path + ".tmp", "w") as f:
+                f.write(str(end))
+            os.rename(path + ".tmp", path)
+            segments = self._list_segments(sack)
+            for start, next_start in six.moves.zip(segments, segments[1:]):
+                if next_start <= end:
+                    os.unlink(self._segment_path(sack, start))
+            if segments:
+                last = segments[-1]
+                if (last + os.path.getsize(self._segment_path(sack, last))
+                        <= end):
+                    os.unlink(self._segment_path(sack, last))
+
+    def _build_report(self, details):
+        metric_details = {}
+        for sack in six.moves.range(self.NUM_SACKS):
+            metric_details.update(self._read_sack_log(
+                sack, lambda log: dict(
+                    (metric_id, len(measures))
+                    for metric_id, measures in six.iteritems(log.measures))))
+        return (len(metric_details), sum(metric_details.values()),
+                metric_details if details else None)
+
+    def list_metric_with_measures_to_process(self, sack):
+        return self._read_sack_log(sack, lambda log: set(log.measures))
+
+    def _release_consumed(self, sack, log, metric_id=None):
+        """Commit the log read if only `metric_id' had measures pending."""
+        if not any(m != metric_id for m in log.measures):
+            # NOTE(jd) Everything read has been processed or deleted metric
+            # per metric, release the segments.
+            self._commit(sack, log.end)
+
+    def delete_unprocessed_measures_for_metric_id(self, metric_id):
+        sack = self.sack_for_metric(metric_id)
+        self._append_records(sack,
+                             self._encode_record(self.DELETE, metric_id))
+        self._release_consumed(sack, self._read_sack_log(sack))
+
+    def has_unprocessed(self, metric):
+        return self._read_sack_log(self.sack_for_metric(metric.id),
+                                   lambda log: str(metric.id) in log.measures)
+
+    @contextlib.contextmanager
+    def process_measure_for_metric(self, metric):
+        sack = self.sack_for_metric(metric.id)
+        log = self._read_sack_log(sack)
+        measures = log.measures.get(str(metric.id), [])
+
+        yield self._unserialize_measures([
+            ('%s-%d' % (metric.id, offset), data)
+            for offset, data in measures])
+
+        if measures:
+            self._append_records(sack, self._encode_record(
+                self.ACK, metric.id, self.ACK_PAYLOAD.pack(log.end)))
+            self._release_consumed(sack, log, str(metric.id))
+
+    @contextlib.contextmanager
+    def process_measures_for_sack(self, sack, max_metrics=None):
+        log = self._read_sack_log(sack)
+        pending = collections.OrderedDict(itertools.islice(
+            six.iteritems(log.measures), max_metrics))
+        measures = dict(
+            (metric_id, self._unserialize_measures([
+                ('%s-%d' % (metric_id, offset), data)
+                for offset, data in metric_measures]))
+            for metric_id, metric_measures in six.iteritems(pending))
+
+        yield measures
+
+        # NOTE(jd) The log is consumed up to its end, so append again the
+        # measures that have not been processed.
+        self._commit(sack, log.end, dict(
+            (metric_id, metric_measures)
+            for metric_id, metric_measures in six.iteritems(log.measures)
+            if metric_id not in measures))
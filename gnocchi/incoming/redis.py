@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import contextlib
+import itertools
 
 import six
 
@@ -23,23 +24,119 @@ from gnocchi import incoming
 
 class RedisStorage(incoming.IncomingDriver):
 
+    # NOTE(jd) The number of metrics and measures waiting in each sack are
+    # counted in a hash, and the metrics waiting in each sack are indexed in a
+    # set. They are updated along the measures by these scripts, so neither
+    # listing the metrics of a sack nor the backlog summary has to scan the
+    # keyspace. A notification is published when a metric gets measures to
+    # process, or still has some once processed.
+    _ADD_MEASURES = """
+local length = redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':measures', 1)
+if length == 1 then
+    redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':metrics', 1)
+    redis.call('SADD', KEYS[3], ARGV[3])
+    redis.call('PUBLISH', ARGV[4], ARGV[2])
+end
+"""
+
+    _TRIM_MEASURES = """
+local count = tonumber(ARGV[1])
+if count > 0 then
+    redis.call('LTRIM', KEYS[1], count, -1)
+    redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':measures', -count)
+end
+if redis.call('LLEN', KEYS[1]) == 0 then
+    if count > 0 then
+        redis.call('HINCRBY', KEYS[2], ARGV[2] .. ':metrics', -1)
+    end
+    redis.call('SREM', KEYS[3], ARGV[3])
+elseif count > 0 then
+    redis.call('PUBLISH', ARGV[4], ARGV[2])
+end
+"""
+
+    _DELETE_MEASURES = """
+local count = redis.call('LLEN', KEYS[1])
+if count > 0 then
+    redis.call('DEL', KEYS[1])
+    redis.call('HINCRBY', KEYS[2], ARGV[1] .. ':measures', -count)
+    redis.call('HINCRBY', KEYS[2], ARGV[1] .. ':metrics', -1)
+end
+redis.call('SREM', KEYS[3], ARGV[2])
+"""
+
+    CFG_SACK_INDEX = 'sack_index'
+
     def __init__(self, conf):
         super(RedisStorage, self).__init__(conf)
         self._client = redis.get_client(conf)
+        self._add_measures = self._client.register_script(self._ADD_MEASURES)
+        self._trim_measures = self._client.register_script(
+            self._TRIM_MEASURES)
+        self._delete_measures = self._client.register_script(
+            self._DELETE_MEASURES)
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self._client)
 
-    def get_storage_sacks(self):
-        return self._client.hget(self.CFG_PREFIX, self.CFG_SACKS)
+    def _get_storage_settings(self):
+        return dict((key.decode('utf8'), value.decode('utf8'))
+                    for key, value in six.iteritems(
+                        self._client.hgetall(self.CFG_PREFIX)))
 
-    def set_storage_settings(self, num_sacks):
-        self._client.hset(self.CFG_PREFIX, self.CFG_SACKS, num_sacks)
+    def _set_storage_settings(self, settings):
+        pipe = self._client.pipeline()
+        pipe.hdel(self.CFG_PREFIX, self.CFG_DRAINING_SACKS,
+                  self.CFG_DRAINING_SINCE)
+        for key, value in six.iteritems(settings):
+            pipe.hset(self.CFG_PREFIX, key, value)
+        pipe.execute()
 
-    @staticmethod
-    def remove_sack_group(num_sacks):
+    def remove_sack_group(self, num_sacks):
         # NOTE(gordc): redis doesn't maintain keys with empty values
-        pass
+        self._client.delete(self._counters_key(num_sacks))
+
+    def upgrade(self, num_sacks):
+        super(RedisStorage, self).upgrade(num_sacks)
+        counters_key = self._counters_key()
+        build_counters = not self._client.exists(counters_key)
+        build_index = not self._client.hget(self.CFG_PREFIX,
+                                            self.CFG_SACK_INDEX)
+        if not build_counters and not build_index:
+            return
+        # NOTE(jd) Count and index the measures stored before the counters
+        # and the sack indexes existed.
+        counters = {}
+        for sack in six.moves.range(self.NUM_SACKS):
+            match = redis.SEP.join([self.get_sack_name(sack), "*"])
+            keys = list(self._client.scan_iter(match=match, count=1000))
+            pipe = self._client.pipeline(transaction=False)
+            for key in keys:
+                pipe.llen(key)
+            lengths = dict((key.decode('utf8').split(redis.SEP)[1], length)
+                           for key, length in six.moves.zip(keys,
+                                                            pipe.execute())
+                           if length)
+            counters['%d:metrics' % sack] = len(lengths)
+            counters['%d:measures' % sack] = sum(lengths.values())
+            if build_index and lengths:
+                self._client.sadd(self._sack_index_key(sack), *lengths)
+        pipe = self._client.pipeline()
+        if build_counters:
+            for field, value in six.iteritems(counters):
+                pipe.hset(counters_key, field, value)
+        pipe.hset(self.CFG_PREFIX, self.CFG_SACK_INDEX, 1)
+        pipe.execute()
+
+    def _counters_key(self, num_sacks=None):
+        return self.get_sack_prefix(num_sacks) % "counters"
+
+    def _sack_index_key(self, sack):
+        return self.get_sack_name(sack) + "-metrics"
+
+    def _notifications_channel(self):
+        return self.get_sack_prefix() % "notifications"
 
     def _build_measure_path(self, metric_id):
         return redis.SEP.join([
@@ -47,49 +144,80 @@ class RedisStorage(incoming.IncomingDriver):
             six.text_type(metric_id)])
 
     def add_measures_batch(self, metrics_and_measures):
+        counters_key = self._counters_key()
+        channel = self._notifications_channel()
         pipe = self._client.pipeline(transaction=False)
         for metric, measures in six.iteritems(metrics_and_measures):
-            path = self._build_measure_path(metric.id)
-            pipe.rpush(path, self._encode_measures(measures))
+            sack = self.sack_for_metric(metric.id)
+            self._add_measures(
+                keys=[self._build_measure_path(metric.id), counters_key,
+                      self._sack_index_key(sack)],
+                args=[self._encode_measures(measures), sack,
+                      six.text_type(metric.id), channel],
+                client=pipe)
         pipe.execute()
 
     def _build_report(self, details):
-        report_vars = {'measures': 0, 'metric_details': {}}
-
-        def update_report(results, m_list):
-            report_vars['measures'] += sum(results)
-            if details:
-                report_vars['metric_details'].update(
-                    dict(six.moves.zip(m_list, results)))
-
-        match = redis.SEP.join([self.get_sack_name("*"), "*"])
-        metrics = 0
-        m_list = []
-        pipe = self._client.pipeline()
-        for key in self._client.scan_iter(match=match, count=1000):
-            metrics += 1
-            pipe.llen(key)
-            if details:
-                m_list.append(key.decode('utf8').split(redis.SEP)[1])
-            # group 100 commands/call
-            if metrics % 100 == 0:
-                results = pipe.execute()
-                update_report(results, m_list)
-                m_list = []
-                pipe = self._client.pipeline()
-        else:
-            results = pipe.execute()
-            update_report(results, m_list)
-        return (metrics, report_vars['measures'],
-                report_vars['metric_details'] if details else None)
+        if not details:
+            counters = self._client.hgetall(self._counters_key())
+            if counters:
+                totals = {'metrics': 0, 'measures': 0}
+                for field, value in six.iteritems(counters):
+                    kind = field.decode('utf8').split(redis.SEP)[1]
+                    # NOTE(jd) The counters can be briefly negative while
+                    # they are rebuilt by an upgrade.
+                    totals[kind] += max(0, int(value))
+                return totals['metrics'], totals['measures'], None
+        metric_details = {}
+        for sack in six.moves.range(self.NUM_SACKS):
+            metrics = list(self.list_metric_with_measures_to_process(sack))
+            pipe = self._client.pipeline(transaction=False)
+            for metric_id in metrics:
+                pipe.llen(redis.SEP.join([self.get_sack_name(sack),
+                                          metric_id]))
+            metric_details.update(
+                (metric_id, length) for metric_id, length
+                in six.moves.zip(metrics, pipe.execute()) if length)
+        return (len(metric_details), sum(metric_details.values()),
+                metric_details if details else None)
 
     def list_metric_with_measures_to_process(self, sack):
-        match = redis.SEP.join([self.get_sack_name(sack), "*"])
-        keys = self._client.scan_iter(match=match, count=1000)
-        return set([k.decode('utf8').split(redis.SEP)[1] for k in keys])
+        return set(m.decode('utf8') for m in
+                   self._client.smembers(self._sack_index_key(sack)))
 
     def delete_unprocessed_measures_for_metric_id(self, metric_id):
-        self._client.delete(self._build_measure_path(metric_id))
+        sack = self.sack_for_metric(metric_id)
+        self._delete_measures(
+            keys=[self._build_measure_path(metric_id), self._counters_key(),
+                  self._sack_index_key(sack)],
+            args=[sack, six.text_type(metric_id)])
+
+    def iter_on_sacks_to_process(self):
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        channel = self._notifications_channel()
+        pubsub.subscribe(channel)
+        try:
+            while True:
+                # NOTE(jd) Wake up regularly to follow an online change of
+                # the number of sacks, which changes the channel.
+                message = pubsub.get_message(
+                    timeout=self.SACKS_REFRESH_DELAY)
+                new_channel = self._notifications_channel()
+                if new_channel != channel:
+                    pubsub.subscribe(new_channel)
+                    pubsub.unsubscribe(channel)
+                    channel = new_channel
+                if message is None or message['type'] != 'message':
+                    continue
+                message_channel = message['channel']
+                if isinstance(message_channel, bytes):
+                    message_channel = message_channel.decode('utf8')
+                # NOTE(jd) The sacks of the previous group are drained, not
+                # processed.
+                if message_channel == channel:
+                    yield int(message['data'])
+        finally:
+            pubsub.close()
 
     def has_unprocessed(self, metric):
         return bool(self._client.exists(self._build_measure_path(metric.id)))
@@ -98,13 +226,46 @@ class RedisStorage(incoming.IncomingDriver):
     def process_measure_for_metric(self, metric):
         key = self._build_measure_path(metric.id)
         item_len = self._client.llen(key)
-        # lrange is inclusive on both ends, decrease to grab exactly n items
-        item_len = item_len - 1 if item_len else item_len
 
-        yield self._array_concatenate([
-            self._unserialize_measures('%s-%s' % (metric.id, i), data)
-            for i, data in enumerate(self._client.lrange(key, 0, item_len))
+        # lrange is inclusive on both ends, decrease to grab exactly n items
+        yield self._unserialize_measures([
+            ('%s-%s' % (metric.id, i), data)
+            for i, data in enumerate(
+                self._client.lrange(key, 0, item_len - 1) if item_len else [])
         ])
 
-        # ltrim is inclusive, bump 1 to remove up to and including nth item
-        self._client.ltrim(key, item_len + 1, -1)
+        sack = self.sack_for_metric(metric.id)
+        self._trim_measures(
+            keys=[key, self._counters_key(), self._sack_index_key(sack)],
+            args=[item_len, sack, six.text_type(metric.id),
+                  self._notifications_channel()])
+
+    def _get_sack_measures(self, sack, max_metrics=None):
+        metric_ids = list(itertools.islice(
+            self.list_metric_with_measures_to_process(sack), max_metrics))
+        pipe = self._client.pipeline(transaction=False)
+        for metric_id in metric_ids:
+            pipe.lrange(redis.SEP.join([self.get_sack_name(sack), metric_id]),
+                        0, -1)
+        measures = {}
+        processed = {}
+        for metric_id, items in six.moves.zip(metric_ids, pipe.execute()):
+            measures[metric_id] = self._unserialize_measures([
+                ('%s-%s' % (metric_id, i), data)
+                for i, data in enumerate(items)
+            ])
+            processed[metric_id] = len(items)
+        return measures, processed
+
+    def _delete_sack_measures(self, sack, processed):
+        counters_key = self._counters_key()
+        index_key = self._sack_index_key(sack)
+        channel = self._notifications_channel()
+        pipe = self._client.pipeline(transaction=False)
+        for metric_id, count in six.iteritems(processed):
+            # NOTE(jd) Keep the measures pushed since they have been read.
+            self._trim_measures(
+                keys=[redis.SEP.join([self.get_sack_name(sack), metric_id]),
+                      counters_key, index_key],
+                args=[count, sack, metric_id, channel], client=pipe)
+        pipe.execute()
@@ -16,10 +16,11 @@
 from collections import defaultdict
 import contextlib
 import datetime
+import itertools
 import json
 import uuid
 
-import numpy
+from concurrent import futures
 import six
 
 from gnocchi.common import s3
@@ -40,24 +41,25 @@ class S3Storage(incoming.IncomingDriver):
         self._bucket_name_measures = (
             self._bucket_prefix + "-" + self.MEASURE_PREFIX
         )
+        self._max_pool_connections = conf.s3_max_pool_connections
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self._bucket_name_measures)
 
-    def get_storage_sacks(self):
+    def _get_storage_settings(self):
         try:
             response = self.s3.get_object(Bucket=self._bucket_name_measures,
                                           Key=self.CFG_PREFIX)
-            return json.loads(response['Body'].read().decode())[self.CFG_SACKS]
+            return json.loads(response['Body'].read().decode())
         except botocore.exceptions.ClientError as e:
             if e.response['Error'].get('Code') == "NoSuchKey":
-                return
+                return {}
+            raise
 
-    def set_storage_settings(self, num_sacks):
-        data = {self.CFG_SACKS: num_sacks}
+    def _set_storage_settings(self, settings):
         self.s3.put_object(Bucket=self._bucket_name_measures,
                            Key=self.CFG_PREFIX,
-                           Body=json.dumps(data).encode())
+                           Body=json.dumps(settings).encode())
 
     def get_sack_prefix(self, num_sacks=None):
         # NOTE(gordc): override to follow s3 partitioning logic
@@ -166,17 +168,59 @@ class S3Storage(incoming.IncomingDriver):
         sack = self.sack_for_metric(metric.id)
         files = self._list_measure_files_for_metric_id(sack, metric.id)
 
-        measures = self._make_measures_array()
-        for f in files:
-            response = self.s3.get_object(
-                Bucket=self._bucket_name_measures,
-                Key=f)
-            measures = numpy.append(
-                measures,
-                self._unserialize_measures(f, response['Body'].read())
-            )
+        def _get_object(f):
+            return self.s3.get_object(
+                Bucket=self._bucket_name_measures, Key=f)['Body'].read()
+
+        files = list(files)
+        with futures.ThreadPoolExecutor(
+                max_workers=self._max_pool_connections) as executor:
+            contents = list(executor.map(_get_object, files))
 
-        yield measures
+        yield self._unserialize_measures(list(six.moves.zip(files, contents)))
 
         # Now clean objects
         s3.bulk_delete(self.s3, self._bucket_name_measures, files)
+
+    def _get_sack_measures(self, sack, max_metrics=None):
+        files_by_metric = defaultdict(list)
+        response = {}
+        while response.get('IsTruncated', True):
+            if 'NextContinuationToken' in response:
+                kwargs = {
+                    'ContinuationToken': response['NextContinuationToken']
+                }
+            else:
+                kwargs = {}
+            response = self.s3.list_objects_v2(
+                Bucket=self._bucket_name_measures,
+                Prefix=self.get_sack_name(sack),
+                **kwargs)
+            for c in response.get('Contents', ()):
+                __, metric_id, __ = c['Key'].split("/", 2)
+                files_by_metric[metric_id].append(c['Key'])
+        metric_ids = list(itertools.islice(files_by_metric, max_metrics))
+        files = [f for metric_id in metric_ids
+                 for f in files_by_metric[metric_id]]
+
+        def _get_object(f):
+            return self.s3.get_object(
+                Bucket=self._bucket_name_measures, Key=f)['Body'].read()
+
+        with futures.ThreadPoolExecutor(
+                max_workers=self._max_pool_connections) as executor:
+            contents = dict(six.moves.zip(files,
+                                          executor.map(_get_object, files)))
+
+        measures = dict(
+            (metric_id, self._unserialize_measures([
+                (f, contents[f]) for f in files_by_metric[metric_id]
+            ]))
+            for metric_id in metric_ids)
+        return measures, dict((metric_id, files_by_metric[metric_id])
+                              for metric_id in metric_ids)
+
+    def _delete_sack_measures(self, sack, processed):
+        files = list(itertools.chain.from_iterable(six.itervalues(processed)))
+        if files:
+            s3.bulk_delete(self.s3, self._bucket_name_measures, files)
@@ -14,9 +14,11 @@
 from collections import defaultdict
 import contextlib
 import datetime
+import itertools
 import json
 import uuid
 
+from concurrent import futures
 import six
 
 from gnocchi.common import swift
@@ -29,25 +31,29 @@ swift_utils = swift.swift_utils
 class SwiftStorage(incoming.IncomingDriver):
     def __init__(self, conf):
         super(SwiftStorage, self).__init__(conf)
-        self.swift = swift.get_connection(conf)
+        self.swift = swift.get_connection_pool(conf)
 
     def __str__(self):
         return self.__class__.__name__
 
-    def get_storage_sacks(self):
+    def stop(self):
+        self.swift.close()
+
+    def _get_storage_settings(self):
         try:
             __, data = self.swift.get_object(self.CFG_PREFIX, self.CFG_PREFIX)
-            return json.loads(data)[self.CFG_SACKS]
+            return json.loads(data)
         except swclient.ClientException as e:
             if e.http_status == 404:
-                return
+                return {}
+            raise
 
-    def set_storage_settings(self, num_sacks):
+    def _set_storage_settings(self, settings):
+        for i in six.moves.range(self.NUM_SACKS):
+            self.swift.put_container(self.get_sack_name(i))
         self.swift.put_container(self.CFG_PREFIX)
         self.swift.put_object(self.CFG_PREFIX, self.CFG_PREFIX,
-                              json.dumps({self.CFG_SACKS: num_sacks}))
-        for i in six.moves.range(num_sacks):
-            self.swift.put_container(self.get_sack_name(i))
+                              json.dumps(settings))
 
     def remove_sack_group(self, num_sacks):
         prefix = self.get_sack_prefix(num_sacks)
@@ -106,13 +112,48 @@ class SwiftStorage(incoming.IncomingDriver):
         sack_name = self.get_sack_name(sack)
         files = self._list_measure_files_for_metric_id(sack, metric.id)
 
-        yield self._array_concatenate([
-            self._unserialize_measures(
-                f['name'],
-                self.swift.get_object(sack_name, f['name'])[1],
-            )
-            for f in files
+        with futures.ThreadPoolExecutor(
+                max_workers=self.swift.size) as executor:
+            contents = list(executor.map(
+                lambda f: self.swift.get_object(sack_name, f['name'])[1],
+                files))
+
+        yield self._unserialize_measures([
+            (f['name'], data) for f, data in six.moves.zip(files, contents)
         ])
 
         # Now clean objects
         swift.bulk_delete(self.swift, sack_name, files)
+
+    def _get_sack_measures(self, sack, max_metrics=None):
+        sack_name = self.get_sack_name(sack)
+        headers, files = self.swift.get_container(sack_name,
+                                                  full_listing=True)
+        files_by_metric = defaultdict(list)
+        for f in files:
+            files_by_metric[f['name'].split("/", 1)[0]].append(f)
+        metric_ids = list(itertools.islice(files_by_metric, max_metrics))
+        files = [f for metric_id in metric_ids
+                 for f in files_by_metric[metric_id]]
+
+        with futures.ThreadPoolExecutor(
+                max_workers=self.swift.size) as executor:
+            contents = dict(six.moves.zip(
+                (f['name'] for f in files),
+                executor.map(
+                    lambda f: self.swift.get_object(sack_name, f['name'])[1],
+                    files)))
+
+        measures = dict(
+            (metric_id, self._unserialize_measures([
+                (f['name'], contents[f['name']])
+                for f in files_by_metric[metric_id]
+            ]))
+            for metric_id in metric_ids)
+        return measures, dict((metric_id, files_by_metric[metric_id])
+                              for metric_id in metric_ids)
+
+    def _delete_sack_measures(self, sack, processed):
+        files = list(itertools.chain.from_iterable(six.itervalues(processed)))
+        if files:
+            swift.bulk_delete(self.swift, self.get_sack_name(sack), files)
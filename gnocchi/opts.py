@@ -29,6 +29,7 @@ import gnocchi.storage.file
 import gnocchi.storage.redis
 import gnocchi.storage.s3
 import gnocchi.storage.swift
+import gnocchi.storage.tiered
 
 
 # NOTE(sileht): The oslo.config interpolation is buggy when the value
@@ -113,8 +114,23 @@ def list_opts():
                        default=60,
                        required=True,
                        deprecated_group='storage',
-                       help="How many seconds to wait between "
-                       "scheduling new metrics to process"),
+                       help="Maximum number of seconds to wait between "
+                       "looking for new measures in all the sacks, when "
+                       "none are found. Sacks that had new measures are "
+                       "processed again right away."),
+            cfg.IntOpt('metric_processing_min_delay',
+                       default=5,
+                       min=0,
+                       help="Number of seconds to wait between looking for "
+                       "new measures in all the sacks, when some are found. "
+                       "The delay doubles each time none are found, up to "
+                       "`metric_processing_delay'."),
+            cfg.BoolOpt('greedy',
+                        default=True,
+                        help="Process the sacks that the incoming driver "
+                        "notifies to have new measures right away, rather "
+                        "than waiting for the next time all the sacks are "
+                        "processed."),
             cfg.IntOpt('metric_reporting_delay',
                        deprecated_group='storage',
                        default=120,
@@ -136,6 +152,57 @@ def list_opts():
                        "value may improve worker utilization but may also "
                        "increase load on coordination backend. Value is "
                        "capped by number of workers globally."),
+            cfg.BoolOpt('sack_affinity',
+                        default=False,
+                        help="Process each sack only from the worker that "
+                        "owns it first in the partitioning ring, instead of "
+                        "sharing it between `processing_replicas' workers. "
+                        "This keeps the unaggregated timeserie cache of "
+                        "workers warm at the cost of less balanced load."),
+            cfg.BoolOpt('defer_split_tasks',
+                        default=False,
+                        help="Run the compaction and the retention of "
+                        "aggregated splits in a dedicated worker instead of "
+                        "doing it while processing new measures."),
+            cfg.IntOpt('split_tasks_queue_size',
+                       default=10000,
+                       min=1,
+                       help="Maximum number of split tasks waiting to be "
+                       "run. When the queue is full, tasks are run while "
+                       "processing new measures."),
+            cfg.IntOpt('split_tasks_batch_size',
+                       default=100,
+                       min=1,
+                       help="Maximum number of split tasks run at once."),
+            cfg.FloatOpt('split_tasks_rate',
+                         default=0,
+                         min=0,
+                         help="Maximum number of split tasks run per second. "
+                         "Set value to 0 to disable rate limiting."),
+            cfg.IntOpt('split_tasks_rescan_delay',
+                       default=86400,
+                       min=0,
+                       help="How many seconds to wait between two searches "
+                       "of the splits that cannot change anymore but have "
+                       "not been compacted, e.g. because their task was "
+                       "lost when gnocchi-metricd stopped. Only the first "
+                       "byte of the splits is read. The first search looks "
+                       "at all the splits, the next ones only at the splits "
+                       "that ended at most this delay before the previous "
+                       "search started. Only drivers that do not write "
+                       "splits in full, such as Ceph, need it. Set value to "
+                       "0 to disable."),
+            cfg.IntOpt('tier_migration_delay',
+                       default=300,
+                       min=1,
+                       help="How many seconds to wait between moves of "
+                       "splits to the cold tier of the tiered storage "
+                       "driver."),
+            cfg.IntOpt('tier_migration_batch_size',
+                       default=1000,
+                       min=1,
+                       help="Number of metrics checked for splits to move to "
+                       "the cold tier at each run."),
         )),
         ("api", (
             cfg.StrOpt('paste_config',
@@ -156,9 +223,10 @@ def list_opts():
                        default=10, min=0,
                        help='Number of seconds before timeout when attempting '
                             'to force refresh of metric.'),
-        ) + gnocchi.rest.app.API_OPTS,
+        ) + gnocchi.rest.app.API_OPTS + gnocchi.rest.app.GROUP_COMMIT_OPTS,
         ),
-        ("storage", (_STORAGE_OPTS + gnocchi.storage._carbonara.OPTS)),
+        ("storage", (_STORAGE_OPTS + gnocchi.storage._carbonara.OPTS
+                     + gnocchi.storage.tiered.OPTS)),
         ("incoming", _INCOMING_OPTS),
         ("statsd", (
             cfg.HostAddressOpt('host',
@@ -1562,6 +1562,61 @@ class MetricsMeasuresBatchController(rest.RestController):
             abort(404, e)
 
 
+class MetricsLatestBatchController(rest.RestController):
+    MetricIDsSchema = [utils.UUID]
+
+    @pecan.expose('json')
+    def get_all(self, metric=None, aggregation='mean', granularity=None):
+        try:
+            metric_ids = voluptuous.Schema(
+                self.MetricIDsSchema, required=True)(arg_to_list(metric))
+        except voluptuous.Error as e:
+            abort(400, "Invalid input: %s" % e)
+        return self._get_latest_measures(metric_ids, aggregation, granularity)
+
+    @pecan.expose('json')
+    def post(self, aggregation='mean', granularity=None):
+        metric_ids = deserialize_and_validate(self.MetricIDsSchema)
+        return self._get_latest_measures(metric_ids, aggregation, granularity)
+
+    @staticmethod
+    def _get_latest_measures(metric_ids, aggregation, granularity):
+        metric_ids = set(six.text_type(m) for m in metric_ids)
+        # Check RBAC policy
+        metrics = pecan.request.indexer.list_metrics(ids=metric_ids)
+        missing_metric_ids = (metric_ids
+                              - set(six.text_type(m.id) for m in metrics))
+        if missing_metric_ids:
+            abort(400, {"cause": "Unknown metrics",
+                        "detail": list(missing_metric_ids)})
+
+        for metric in metrics:
+            enforce("get metric", metric)
+
+        if (aggregation
+           not in archive_policy.ArchivePolicy.VALID_AGGREGATION_METHODS):
+            abort(
+                400,
+                'Invalid aggregation value %s, must be one of %s'
+                % (aggregation,
+                   archive_policy.ArchivePolicy.VALID_AGGREGATION_METHODS))
+
+        if granularity is not None:
+            try:
+                granularity = utils.to_timespan(granularity)
+            except ValueError as e:
+                abort(400, e)
+
+        try:
+            return dict((str(metric.id), measures)
+                        for metric, measures in six.iteritems(
+                            pecan.request.storage.get_latest_measures(
+                                metrics, aggregation, granularity)))
+        except (storage.GranularityDoesNotExist,
+                storage.AggregationDoesNotExist) as e:
+            abort(404, e)
+
+
 class SearchController(object):
     resource = SearchResourceController()
     metric = SearchMetricController()
@@ -1604,6 +1659,10 @@ class AggregationResourceController(rest.RestController):
         def groupper(r):
             return tuple((attr, r[attr]) for attr in groupby)
 
+        rollup = pecan.request.storage.get_group_rollup(
+            self.resource_type, self.metric_name, groupby,
+            aggregation, reaggregation)
+
         results = []
         for key, resources in itertools.groupby(resources, groupper):
             metrics = list(filter(None,
@@ -1613,7 +1672,8 @@ class AggregationResourceController(rest.RestController):
                 "group": dict(key),
                 "measures": AggregationController.get_cross_metric_measures_from_objs(  # noqa
                     metrics, start, stop, aggregation, reaggregation,
-                    granularity, needed_overlap, fill, refresh, resample)
+                    granularity, needed_overlap, fill, refresh, resample,
+                    rollup, tuple(value for attr, value in key))
             })
 
         return results
@@ -1644,7 +1704,8 @@ class AggregationController(rest.RestController):
                                             reaggregation=None,
                                             granularity=None,
                                             needed_overlap=100.0, fill=None,
-                                            refresh=False, resample=None):
+                                            refresh=False, resample=None,
+                                            rollup=None, group=None):
         try:
             needed_overlap = float(needed_overlap)
         except ValueError:
@@ -1720,6 +1781,13 @@ class AggregationController(rest.RestController):
                 return pecan.request.storage.get_measures(
                     metrics[0], start, stop, aggregation,
                     granularity, resample)
+            if (rollup is not None and fill is None and not resample
+               and not strtobool("refresh", refresh)):
+                measures = pecan.request.storage.get_group_rollup_measures(
+                    rollup, group, metrics, start, stop,
+                    granularity, needed_overlap)
+                if measures is not None:
+                    return measures
             return pecan.request.storage.get_cross_metric_measures(
                 metrics, start, stop, aggregation,
                 reaggregation, resample, granularity, needed_overlap, fill)
@@ -1800,6 +1868,7 @@ class StatusController(rest.RestController):
 
 class MetricsBatchController(object):
     measures = MetricsMeasuresBatchController()
+    latest = MetricsLatestBatchController()
 
 
 class ResourcesMetricsBatchController(object):
@@ -13,6 +13,7 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import atexit
 import os
 import pkg_resources
 import uuid
@@ -47,6 +48,28 @@ API_OPTS = (
                 help="Port to listen on"),
 )
 
+GROUP_COMMIT_OPTS = (
+    cfg.FloatOpt('group_commit_delay',
+                 default=0,
+                 min=0,
+                 help="Number of seconds during which the measures posted "
+                 "to an API process are merged before being written to the "
+                 "incoming storage. Set value to 0 to write the measures of "
+                 "each request on their own."),
+    cfg.IntOpt('group_commit_max_measures',
+               default=10000,
+               min=1,
+               help="Number of measures merged after which they are written "
+               "to the incoming storage without waiting for "
+               "`group_commit_delay'."),
+    cfg.BoolOpt('group_commit_wait',
+                default=True,
+                help="Answer a request posting measures once they are "
+                "written to the incoming storage. If disabled, measures "
+                "merged but not written yet are lost if the API process "
+                "dies."),
+)
+
 
 # Register our encoder by default for everything
 jsonify.jsonify.register(object)(json.to_primitive)
@@ -105,6 +128,12 @@ def load_app(conf, indexer=None, storage=None, incoming=None,
         storage = gnocchi_storage.get_driver(conf)
     if not incoming:
         incoming = gnocchi_incoming.get_driver(conf)
+        if conf.api.group_commit_delay:
+            incoming = gnocchi_incoming.GroupCommitIncoming(
+                incoming, conf.api.group_commit_delay,
+                conf.api.group_commit_max_measures,
+                conf.api.group_commit_wait)
+            atexit.register(incoming.stop)
     if not indexer:
         indexer = gnocchi_indexer.get_driver(conf)
 
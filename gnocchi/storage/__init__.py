@@ -14,9 +14,10 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import collections
-import operator
+import functools
 
 import daiquiri
+import numpy
 from oslo_config import cfg
 
 from gnocchi import exceptions
@@ -254,6 +255,26 @@ class StorageDriver(object):
                 else:
                     raise GranularityDoesNotExist(metric, granularity)
 
+    @staticmethod
+    def get_latest_measures(metrics, aggregation='mean', granularity=None):
+        """Get the last measure of multiple metrics.
+
+        :param metrics: The metrics to get the last measure of.
+        :param aggregation: The type of aggregation to retrieve.
+        :param granularity: The granularity to retrieve, or None for all.
+        :return: A dict of lists of (timestamp, granularity, value) indexed
+                 by metric.
+        """
+        for metric in metrics:
+            if aggregation not in metric.archive_policy.aggregation_methods:
+                raise AggregationDoesNotExist(metric, aggregation)
+            if granularity is not None:
+                for d in metric.archive_policy.definition:
+                    if d.granularity == granularity:
+                        break
+                else:
+                    raise GranularityDoesNotExist(metric, granularity)
+
     @staticmethod
     def search_value(metrics, query, from_timestamp=None,
                      to_timestamp=None,
@@ -272,63 +293,74 @@ class StorageDriver(object):
 
 
 class MeasureQuery(object):
+    """A search query on measure values.
+
+    The query is compiled into numpy operations, so it can be evaluated on a
+    whole array of values at once. Calling it returns a boolean mask.
+    """
+
     binary_operators = {
-        u"=": operator.eq,
-        u"==": operator.eq,
-        u"eq": operator.eq,
+        u"=": numpy.equal,
+        u"==": numpy.equal,
+        u"eq": numpy.equal,
 
-        u"<": operator.lt,
-        u"lt": operator.lt,
+        u"<": numpy.less,
+        u"lt": numpy.less,
 
-        u">": operator.gt,
-        u"gt": operator.gt,
+        u">": numpy.greater,
+        u"gt": numpy.greater,
 
-        u"<=": operator.le,
-        u"≤": operator.le,
-        u"le": operator.le,
+        u"<=": numpy.less_equal,
+        u"≤": numpy.less_equal,
+        u"le": numpy.less_equal,
 
-        u">=": operator.ge,
-        u"≥": operator.ge,
-        u"ge": operator.ge,
+        u">=": numpy.greater_equal,
+        u"≥": numpy.greater_equal,
+        u"ge": numpy.greater_equal,
 
-        u"!=": operator.ne,
-        u"≠": operator.ne,
-        u"ne": operator.ne,
+        u"!=": numpy.not_equal,
+        u"≠": numpy.not_equal,
+        u"ne": numpy.not_equal,
 
-        u"%": operator.mod,
-        u"mod": operator.mod,
+        u"%": numpy.mod,
+        u"mod": numpy.mod,
 
-        u"+": operator.add,
-        u"add": operator.add,
+        u"+": numpy.add,
+        u"add": numpy.add,
 
-        u"-": operator.sub,
-        u"sub": operator.sub,
+        u"-": numpy.subtract,
+        u"sub": numpy.subtract,
 
-        u"*": operator.mul,
-        u"×": operator.mul,
-        u"mul": operator.mul,
+        u"*": numpy.multiply,
+        u"×": numpy.multiply,
+        u"mul": numpy.multiply,
 
-        u"/": operator.truediv,
-        u"÷": operator.truediv,
-        u"div": operator.truediv,
+        u"/": numpy.true_divide,
+        u"÷": numpy.true_divide,
+        u"div": numpy.true_divide,
 
-        u"**": operator.pow,
-        u"^": operator.pow,
-        u"pow": operator.pow,
+        u"**": numpy.power,
+        u"^": numpy.power,
+        u"pow": numpy.power,
     }
 
     multiple_operators = {
-        u"or": any,
-        u"∨": any,
-        u"and": all,
-        u"∧": all,
+        u"or": numpy.logical_or,
+        u"∨": numpy.logical_or,
+        u"and": numpy.logical_and,
+        u"∧": numpy.logical_and,
     }
 
     def __init__(self, tree):
         self._eval = self.build_evaluator(tree)
 
-    def __call__(self, value):
-        return self._eval(value)
+    def __call__(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64)
+        # NOTE(jd) Division by zero or invalid operations give inf or nan,
+        # which never match a comparison, instead of raising.
+        with numpy.errstate(all='ignore'):
+            mask = numpy.asarray(self._eval(values)).astype(bool)
+        return numpy.broadcast_to(mask, values.shape)
 
     def build_evaluator(self, tree):
         try:
@@ -347,7 +379,8 @@ class MeasureQuery(object):
 
     def _handle_multiple_op(self, op, nodes):
         elements = [self.build_evaluator(node) for node in nodes]
-        return lambda value: op((e(value) for e in elements))
+        return lambda value: functools.reduce(
+            op, (e(value) for e in elements), op.identity)
 
     def _handle_binary_op(self, op, node):
         try:
@@ -358,7 +391,7 @@ class MeasureQuery(object):
         if len(nodes) != 2:
             raise InvalidQuery(
                 "Binary operator %s needs 2 arguments, %d given" %
-                (op, len(nodes)))
+                (op.__name__, len(nodes)))
         node0 = self.build_evaluator(node[0])
         node1 = self.build_evaluator(node[1])
         return lambda value: op(node0(value), node1(value))
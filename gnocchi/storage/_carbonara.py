@@ -17,6 +17,8 @@
 import collections
 import functools
 import itertools
+import threading
+import uuid
 
 from concurrent import futures
 import daiquiri
@@ -26,6 +28,7 @@ from oslo_config import cfg
 import six
 import six.moves
 
+from gnocchi import archive_policy
 from gnocchi import carbonara
 from gnocchi import storage
 from gnocchi import utils
@@ -40,11 +43,151 @@ OPTS = [
     cfg.StrOpt('coordination_url',
                secret=True,
                help='Coordination driver URL'),
-
+    cfg.IntOpt('split_cache_size',
+               default=0, min=0,
+               help='Maximum size in MiB of the in-memory cache of '
+                    'unserialized aggregated splits kept by each process. '
+                    'Only splits that cannot change anymore are cached. '
+                    'Set to 0 to disable the cache.'),
+    cfg.IntOpt('unaggregated_timeserie_cache_size',
+               default=0, min=0,
+               help='Number of unaggregated timeseries each metricd worker '
+                    'keeps in memory after processing them. A cached '
+                    'timeserie is reused, without being downloaded again, '
+                    'as long as the backend reports that no other worker '
+                    'rewrote it. Set to 0 to disable the cache.'),
+    cfg.IntOpt('cross_metric_streaming_threshold',
+               default=100, min=0,
+               help='Number of metrics from which cross-metric aggregation '
+                    'reads and aggregates measures one split at a time '
+                    'instead of loading the whole timeseries of every '
+                    'metric at once. Set to 0 to disable.'),
+    cfg.BoolOpt('metric_locking',
+                default=False,
+                help='Lock each metric while processing, refreshing or '
+                     'deleting it, instead of locking the whole sack of the '
+                     'metric. gnocchi-metricd still locks a sack while '
+                     'processing it, but a refresh from the API only waits '
+                     'for the metric it refreshes. Must be set to the same '
+                     'value for all the API and metricd processes.'),
+    cfg.MultiStrOpt('group_rollups',
+                    default=[],
+                    help='Cross-metric aggregation of a group of resources '
+                         'maintained by gnocchi-metricd, in the form '
+                         '<resource type>:<metric name>:<aggregation>:'
+                         '<reaggregation>:<groupby>[,<groupby>...], e.g. '
+                         'instance:cpu_util:mean:mean:project_id. Aggregation '
+                         'requests on a resource type matching a rollup are '
+                         'answered from the rollup instead of reading every '
+                         'metric of each group. Can be specified multiple '
+                         'times.'),
 ]
 
 LOG = daiquiri.getLogger(__name__)
 
+# The last point of each aggregation and granularity of a metric
+LATEST_MEASURES_DTYPE = [('aggregation', 'S16'),
+                         ('granularity', '<m8[ns]'),
+                         ('timestamp', '<M8[ns]'),
+                         ('value', '<d')]
+
+
+class SplitTask(collections.namedtuple("SplitTask", ["action", "metric_id",
+                                                     "aggregation", "key"])):
+    """A maintenance operation on an aggregated split.
+
+    `COMPACT` rewrites a split that cannot change anymore in its compressed
+    form, `DELETE` removes a split that is out of the archive policy
+    timespan.
+    """
+
+    COMPACT = "compact"
+    DELETE = "delete"
+
+    def __str__(self):
+        return "%s of split %s (%s, %s) for metric %s" % (
+            self.action, self.key, self.aggregation, self.key.sampling,
+            self.metric_id)
+
+
+class GroupRollup(collections.namedtuple("GroupRollup", [
+        "resource_type", "metric_name", "aggregation", "reaggregation",
+        "groupby"])):
+    """A cross-metric aggregation of groups of resources.
+
+    For each group of resources of `resource_type` having the same values
+    for the `groupby` attributes, the `aggregation` timeseries of their
+    `metric_name` metrics are aggregated with `reaggregation`. The result
+    is stored in a `GroupRollupMetric`.
+    """
+
+    # NOTE(jd) This UUID must never change: it is used to compute the id of
+    # the metric storing each group rollup.
+    NAMESPACE = uuid.UUID('b3a6a3d2-0c8e-4e49-9d2a-6f4f5d8c3e17')
+
+    REAGGREGATION_METHODS = set(
+        ('mean', 'sum', 'min', 'max', 'median', 'std', 'count'))
+
+    @classmethod
+    def parse(cls, value):
+        parts = value.split(":")
+        if len(parts) < 5:
+            raise ValueError("Invalid group rollup `%s'" % value)
+        aggregation, reaggregation = parts[-3:-1]
+        groupby = tuple(sorted(set(filter(None, parts[-1].split(",")))))
+        if not groupby:
+            raise ValueError("No groupby attribute in group rollup `%s'"
+                             % value)
+        if (aggregation
+           not in archive_policy.ArchivePolicy.VALID_AGGREGATION_METHODS):
+            raise ValueError("Invalid aggregation `%s' in group rollup `%s'"
+                             % (aggregation, value))
+        if reaggregation not in cls.REAGGREGATION_METHODS:
+            raise ValueError("Invalid reaggregation `%s' in group rollup `%s'"
+                             % (reaggregation, value))
+        return cls(parts[0], ":".join(parts[1:-3]), aggregation,
+                   reaggregation, groupby)
+
+    def get_group(self, resource):
+        return tuple(resource[attr] for attr in self.groupby)
+
+    def get_metric(self, group, metrics):
+        """Return the metric storing the rollup of a group.
+
+        :param group: The values of the groupby attributes.
+        :param metrics: The metrics of the group.
+        :return: A `GroupRollupMetric`, or None if the metrics do not all
+                 have the same archive policy.
+        """
+        if len(set(m.archive_policy.name for m in metrics)) != 1:
+            return
+        policy = metrics[0].archive_policy
+        name = u"\x00".join(
+            (self.resource_type, self.metric_name, self.aggregation,
+             self.reaggregation, policy.name)
+            + tuple(u"%s%s" % (attr, u"" if value is None
+                               else u"=" + six.text_type(value))
+                    for attr, value in six.moves.zip(self.groupby, group)))
+        # NOTE(jd) The name must be str (unicode) in Python 3 and str (bytes)
+        # in Python 2.
+        if six.PY2:
+            name = name.encode('utf-8')
+        return GroupRollupMetric(
+            uuid.uuid5(self.NAMESPACE, name),
+            archive_policy.ArchivePolicy(
+                policy.name, policy.back_window, policy.definition,
+                set((self.reaggregation, 'count'))),
+            name=self.metric_name)
+
+
+class GroupRollupMetric(storage.Metric):
+    """A metric storing a `GroupRollup`; it does not exist in the indexer.
+
+    Its `count' aggregation holds the number of metrics of the group that
+    have a point at each timestamp. Its unaggregated timeserie holds the
+    list of metrics the rollup has been computed from.
+    """
+
 
 class CorruptionError(ValueError):
     """Data corrupted, damn it."""
@@ -53,8 +196,118 @@ class CorruptionError(ValueError):
         super(CorruptionError, self).__init__(message)
 
 
+class PendingWrites(object):
+    """The writes of objects not known to be stored yet, by metric.
+
+    Drivers writing asynchronously record there what to wait for in
+    `_flush_metric_measures' or before reading an object again.
+    """
+
+    def __init__(self):
+        self._writes = collections.defaultdict(collections.OrderedDict)
+        self._lock = threading.Lock()
+
+    def add(self, metric, name, write):
+        with self._lock:
+            self._writes[metric.id].setdefault(name, []).append(write)
+
+    def get(self, metric, name):
+        """Return the writes of an object."""
+        with self._lock:
+            if metric.id not in self._writes:
+                return []
+            return list(self._writes[metric.id].get(name, ()))
+
+    def items(self, metric):
+        """Return the (name, writes) of the objects of a metric."""
+        with self._lock:
+            if metric.id not in self._writes:
+                return []
+            return [(name, list(writes)) for name, writes
+                    in six.iteritems(self._writes[metric.id])]
+
+    def pop(self, metric, name=None):
+        """Forget the writes of a metric, or of one of its objects.
+
+        :return: A dict of the writes by object name.
+        """
+        with self._lock:
+            if metric.id not in self._writes:
+                return {}
+            if name is None:
+                return self._writes.pop(metric.id)
+            writes = self._writes[metric.id].pop(name, None)
+            return {name: writes} if writes else {}
+
+
+class SplitCache(object):
+    """A LRU cache of unserialized aggregated splits bounded in bytes.
+
+    Values are the numpy arrays backing `AggregatedTimeSerie` objects; they
+    are made read-only so they can be shared safely between readers.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if value.nbytes > self.max_size:
+            return
+        value.flags.writeable = False
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old.nbytes
+            self._items[key] = value
+            self.size += value.nbytes
+            while self.size > self.max_size:
+                __, evicted = self._items.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.evictions += 1
+
+    def invalidate(self, metric_id):
+        """Drop all the splits cached for a metric."""
+        with self._lock:
+            for key in [k for k in self._items if k[0] == metric_id]:
+                self.size -= self._items.pop(key).nbytes
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "items": len(self._items),
+                "size": self.size,
+                "max_size": self.max_size,
+            }
+
+
 class CarbonaraBasedStorage(storage.StorageDriver):
 
+    # Number of splits read at once by streaming cross-metric aggregation
+    CROSS_METRIC_READ_BATCH = 100
+
     def __init__(self, conf, coord=None):
         super(CarbonaraBasedStorage, self).__init__(conf)
         self.aggregation_workers_number = conf.aggregation_workers_number
@@ -66,6 +319,23 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         self.coord = (coord if coord else
                       utils.get_coordinator_and_start(conf.coordination_url))
         self.shared_coord = bool(coord)
+        if conf.split_cache_size:
+            self.split_cache = SplitCache(conf.split_cache_size * 1024 * 1024)
+        else:
+            self.split_cache = None
+        self.unaggregated_timeserie_cache_size = (
+            conf.unaggregated_timeserie_cache_size)
+        self._unaggregated_timeserie_cache = collections.OrderedDict()
+        # NOTE(jd) If set to a queue, split compaction and retention are not
+        # done while processing new measures but queued as `SplitTask'
+        # objects; see `process_split_tasks'.
+        self.split_tasks = None
+        self.cross_metric_streaming_threshold = (
+            conf.cross_metric_streaming_threshold)
+        self.group_rollups = [GroupRollup.parse(r)
+                              for r in conf.group_rollups]
+        self.metric_locking = conf.metric_locking
+        self.lock_statistics = utils.LockStatistics()
 
     def stop(self):
         if not self.shared_coord:
@@ -79,6 +349,63 @@ class CarbonaraBasedStorage(storage.StorageDriver):
     def _get_unaggregated_timeserie(metric, version=3):
         raise NotImplementedError
 
+    def _get_unaggregated_timeserie_buffer(self, metric, version=3):
+        """Return the unaggregated timeserie of a metric as a buffer.
+
+        Drivers that can give access to the stored data without copying it,
+        e.g. with mmap, override this. The buffer is only read while
+        unserializing.
+        """
+        return self._get_unaggregated_timeserie(metric, version)
+
+    def _get_measures_buffer(self, metric, key, aggregation, version=3):
+        """Return a split as a buffer.
+
+        See `_get_unaggregated_timeserie_buffer'.
+        """
+        return self._get_measures(metric, key, aggregation, version)
+
+    def _get_measures_batch(self, metric, keys, aggregation, version=3):
+        """Return the buffers of several splits of a metric, in order.
+
+        Drivers that can pipeline reads override this.
+        """
+        return self._map_in_thread(
+            self._get_measures_buffer,
+            ((metric, key, aggregation, version) for key in keys))
+
+    @staticmethod
+    def _get_unaggregated_timeserie_version(metric, version=3):
+        """Return a token identifying the stored unaggregated timeserie.
+
+        The token must change every time the timeserie is rewritten. Drivers
+        that cannot retrieve such a token cheaply return None, which disables
+        the caching of unaggregated timeseries.
+        """
+        return None
+
+    def _get_cached_unaggregated_timeserie(self, metric, block_size,
+                                           back_window):
+        # NOTE(jd) Pop the timeserie: it is going to be modified, so it must
+        # not be reused if the processing fails before it is stored again.
+        cached = self._unaggregated_timeserie_cache.pop(metric.id, None)
+        if cached is None:
+            return
+        token, ts = cached
+        if (ts.block_size == block_size
+                and ts.back_window == back_window
+                and token == self._get_unaggregated_timeserie_version(
+                    metric)):
+            return ts
+
+    def _cache_unaggregated_timeserie(self, metric, token, ts):
+        if token is None or not self.unaggregated_timeserie_cache_size:
+            return
+        self._unaggregated_timeserie_cache[metric.id] = (token, ts)
+        while (len(self._unaggregated_timeserie_cache) >
+               self.unaggregated_timeserie_cache_size):
+            self._unaggregated_timeserie_cache.popitem(last=False)
+
     def _get_unaggregated_timeserie_and_unserialize(
             self, metric, block_size, back_window):
         """Retrieve unaggregated timeserie for a metric and unserialize it.
@@ -87,9 +414,15 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         be retrieved, returns None.
 
         """
+        ts = self._get_cached_unaggregated_timeserie(
+            metric, block_size, back_window)
+        if ts is not None:
+            LOG.debug("Reusing cached unaggregated measures for %s",
+                      metric.id)
+            return ts
         with utils.StopWatch() as sw:
             raw_measures = (
-                self._get_unaggregated_timeserie(
+                self._get_unaggregated_timeserie_buffer(
                     metric)
             )
         if not raw_measures:
@@ -108,6 +441,11 @@ class CarbonaraBasedStorage(storage.StorageDriver):
 
     @staticmethod
     def _store_unaggregated_timeserie(metric, data, version=3):
+        """Store the unaggregated timeserie of a metric.
+
+        :return: The token that `_get_unaggregated_timeserie_version` returns
+                 for the stored data, or None.
+        """
         raise NotImplementedError
 
     @staticmethod
@@ -115,6 +453,69 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                                data, offset=None, version=3):
         raise NotImplementedError
 
+    def _flush_metric_measures(self, metric):
+        """Wait for the splits of a metric written so far to be stored.
+
+        `_store_metric_measures' may return before the split is stored, e.g.
+        for drivers writing asynchronously; this is called at the end of
+        every pass writing splits. Drivers writing synchronously do nothing.
+        """
+
+    @staticmethod
+    def _store_latest_measures(metric, data, version=3):
+        raise NotImplementedError
+
+    @staticmethod
+    def _get_latest_measures(metric, version=3):
+        """Return the stored latest measures of a metric, or None."""
+        raise NotImplementedError
+
+    def _get_latest_measures_batch(self, metrics, version=3):
+        return self._map_in_thread(self._get_latest_measures,
+                                   ((metric, version) for metric in metrics))
+
+    @staticmethod
+    def _serialize_latest_measures(points):
+        latest = numpy.zeros(len(points), dtype=LATEST_MEASURES_DTYPE)
+        for i, ((aggregation, granularity), (timestamp, value)) in enumerate(
+                sorted(six.iteritems(points))):
+            latest[i] = (aggregation.encode('ascii'), granularity,
+                         timestamp, value)
+        return latest.tobytes()
+
+    @staticmethod
+    def _unserialize_latest_measures(data):
+        return dict(
+            ((aggregation.decode('ascii'), granularity), (timestamp, value))
+            for aggregation, granularity, timestamp, value
+            in numpy.frombuffer(data, dtype=LATEST_MEASURES_DTYPE))
+
+    def _update_latest_measures(self, metric, points):
+        """Store the latest point of each aggregation and granularity.
+
+        :param points: A dict of (timestamp, value) indexed by
+                       (aggregation, granularity), for the aggregated
+                       timeseries that got new points.
+        """
+        agg_methods = metric.archive_policy.aggregation_methods
+        granularities = [numpy.timedelta64(d.granularity, 'ns')
+                         for d in metric.archive_policy.definition]
+        points = dict(((aggregation, numpy.timedelta64(granularity, 'ns')),
+                       point)
+                      for (aggregation, granularity), point
+                      in six.iteritems(points))
+        if len(points) < len(agg_methods) * len(granularities):
+            # NOTE(jd) Some timeseries did not get any new point, e.g. std
+            # with a single new measure: keep their previous latest point.
+            data = self._get_latest_measures(metric)
+            if data:
+                for key, point in six.iteritems(
+                        self._unserialize_latest_measures(data)):
+                    if key[0] in agg_methods and key[1] in granularities:
+                        points.setdefault(key, point)
+        self._store_latest_measures(
+            metric, self._serialize_latest_measures(points))
+
     def _list_split_keys_for_metric(self, metric, aggregation, granularity,
                                     version=3):
         return set(map(
@@ -158,7 +559,11 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                                       for ts in agg_timeseries]))
 
     def _get_measures_and_unserialize(self, metric, key, aggregation):
-        data = self._get_measures(metric, key, aggregation)
+        data = self._get_measures_buffer(metric, key, aggregation)
+        return self._unserialize_measures(metric, key, aggregation, data)
+
+    @staticmethod
+    def _unserialize_measures(metric, key, aggregation, data):
         try:
             return carbonara.AggregatedTimeSerie.unserialize(
                 data, key, aggregation)
@@ -168,6 +573,76 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                       "around time `%s', ignoring.",
                       metric.id, aggregation, key.sampling, key)
 
+    def _get_measures_and_unserialize_cached(self, metric, key, aggregation,
+                                             cacheable, version=3):
+        if not cacheable:
+            return self._get_measures_and_unserialize(
+                metric, key, aggregation)
+        # NOTE(jd) The format version is part of the key so that a data
+        # format change never returns splits unserialized the old way.
+        cache_key = (metric.id, aggregation, key.sampling, key.key, version)
+        ts = self.split_cache.get(cache_key)
+        if ts is not None:
+            return carbonara.AggregatedTimeSerie(
+                key.sampling, aggregation, ts)
+        split = self._get_measures_and_unserialize(metric, key, aggregation)
+        if split is not None:
+            self.split_cache.set(cache_key, split.ts)
+        return split
+
+    def _get_measures_and_unserialize_batch(self, metric, keys, aggregation,
+                                            cacheable, version=3):
+        """Return the unserialized splits of a metric.
+
+        :param keys: The split keys to read.
+        :param cacheable: A function telling if a split key is cacheable.
+        :return: The splits, or None for corrupted ones, in the keys order.
+        """
+        splits = {}
+        to_read = []
+        for key in keys:
+            if self.split_cache is not None and cacheable(key):
+                ts = self.split_cache.get(
+                    (metric.id, aggregation, key.sampling, key.key, version))
+                if ts is not None:
+                    splits[key] = carbonara.AggregatedTimeSerie(
+                        key.sampling, aggregation, ts)
+                    continue
+            to_read.append(key)
+        if to_read:
+            data = self._get_measures_batch(metric, to_read, aggregation)
+            for key, split in six.moves.zip(to_read, self._map_in_thread(
+                    self._unserialize_measures,
+                    ((metric, key, aggregation, d)
+                     for key, d in six.moves.zip(to_read, data)))):
+                splits[key] = split
+                if split is not None and cacheable(key):
+                    self.split_cache.set(
+                        (metric.id, aggregation, key.sampling, key.key,
+                         version), split.ts)
+        return [splits[key] for key in keys]
+
+    @staticmethod
+    def _get_oldest_immutable_split_key(metric, keys):
+        """Return the split key before which splits are immutable.
+
+        A split cannot be modified anymore once it ends before the oldest
+        mutable timestamp of the metric. That timestamp is not known without
+        reading the unaggregated timeserie, but the last split key gives a
+        lower bound for it.
+        """
+        if not keys:
+            return
+        block_size = metric.archive_policy.max_block_size
+        back_window = metric.archive_policy.back_window
+        # NOTE(sileht): One more block is kept to compute rate of change,
+        # for all the aggregation methods of the archive policy
+        if any(m.startswith("rate:")
+               for m in metric.archive_policy.aggregation_methods):
+            back_window += 1
+        return (carbonara.round_timestamp(max(keys).key, block_size)
+                - block_size * back_window)
+
     def _get_measures_timeserie(self, metric,
                                 aggregation, granularity,
                                 from_timestamp=None, to_timestamp=None):
@@ -201,14 +676,24 @@ class CarbonaraBasedStorage(storage.StorageDriver):
             to_timestamp = carbonara.SplitKey.from_timestamp_and_sampling(
                 to_timestamp, granularity)
 
+        # NOTE(jd) The splits of a group rollup are recomputed entirely when
+        # the group changes, so they are never immutable.
+        if self.split_cache is None or isinstance(metric, GroupRollupMetric):
+            oldest_immutable_key = None
+        else:
+            oldest_immutable_key = self._get_oldest_immutable_split_key(
+                metric, all_keys)
+
         timeseries = list(filter(
             lambda x: x is not None,
-            self._map_in_thread(
-                self._get_measures_and_unserialize,
-                ((metric, key, aggregation)
-                 for key in sorted(all_keys)
+            self._get_measures_and_unserialize_batch(
+                metric,
+                [key for key in sorted(all_keys)
                  if ((not from_timestamp or key >= from_timestamp)
-                     and (not to_timestamp or key <= to_timestamp))))
+                     and (not to_timestamp or key <= to_timestamp))],
+                aggregation,
+                lambda key: (oldest_immutable_key is not None
+                             and next(key) <= oldest_immutable_key))
         ))
 
         return carbonara.AggregatedTimeSerie.from_timeseries(
@@ -257,6 +742,11 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                       metric, grouped_serie,
                       previous_oldest_mutable_timestamp,
                       oldest_mutable_timestamp):
+        """Aggregate and store a grouped serie.
+
+        :return: The last (timestamp, value) of the aggregated timeserie, or
+                 None if it is empty.
+        """
 
         if aggregation.startswith("rate:"):
             grouped_serie = grouped_serie.derived()
@@ -293,7 +783,8 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                 # contains our timestamp, so we prefer to keep a bit more
                 # than deleting too much
                 if key < oldest_key_to_keep:
-                    self._delete_metric_measures(metric, key, aggregation)
+                    self._run_or_queue_split_task(metric, SplitTask(
+                        SplitTask.DELETE, str(metric.id), aggregation, key))
                     existing_keys.remove(key)
         else:
             oldest_key_to_keep = None
@@ -310,14 +801,9 @@ class CarbonaraBasedStorage(storage.StorageDriver):
             if previous_oldest_mutable_key != oldest_mutable_key:
                 for key in existing_keys:
                     if previous_oldest_mutable_key <= key < oldest_mutable_key:
-                        LOG.debug(
-                            "Compressing previous split %s (%s) for metric %s",
-                            key, aggregation, metric)
-                        # NOTE(jd) Rewrite it entirely for fun (and later for
-                        # compression). For that, we just pass None as split.
-                        self._store_timeserie_split(
-                            metric, key,
-                            None, aggregation, oldest_mutable_timestamp)
+                        self._run_or_queue_split_task(metric, SplitTask(
+                            SplitTask.COMPACT, str(metric.id),
+                            aggregation, key))
 
         for key, split in ts.split():
             if oldest_key_to_keep is None or key >= oldest_key_to_keep:
@@ -327,21 +813,159 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                 self._store_timeserie_split(
                     metric, key, split, aggregation, oldest_mutable_timestamp)
 
+        return ts.timestamps[-1], ts.values[-1]
+
+    def _run_or_queue_split_task(self, metric, task):
+        # NOTE(jd) Queued tasks are run for metrics listed by the indexer, so
+        # the tasks of group rollups cannot be deferred.
+        if (self.split_tasks is not None
+           and not isinstance(metric, GroupRollupMetric)):
+            try:
+                self.split_tasks.put_nowait(task)
+            except six.moves.queue.Full:
+                LOG.debug("Split tasks queue is full, running %s now", task)
+            else:
+                return
+        self._run_split_task(metric, task)
+
+    def _run_split_task(self, metric, task):
+        LOG.debug("Running %s", task)
+        if task.action == SplitTask.DELETE:
+            self._delete_metric_measures(metric, task.key, task.aggregation)
+        elif task.action == SplitTask.COMPACT:
+            # NOTE(jd) Rewrite it entirely for fun (and later for
+            # compression). For that, we just pass None as split and a
+            # mutable timestamp past the split so it is written in full.
+            self._store_timeserie_split(
+                metric, task.key, None, task.aggregation, next(task.key).key)
+
+    def _get_measures_header(self, metric, key, aggregation, size,
+                             version=3):
+        """Return the first `size' bytes of a split.
+
+        Drivers able to read part of an object should override this.
+        """
+        data = self._get_measures(metric, key, aggregation, version)
+        return data[:size] if data else data
+
+    def find_uncompressed_splits(self, metric, since=None):
+        """Return the compaction tasks of the immutable splits of a metric
+        that are still uncompressed.
+
+        Drivers that do not write splits in full store them uncompressed
+        until a `COMPACT` task rewrites them. That task is only created when
+        a split becomes immutable, so this finds the ones that have been
+        lost.
+
+        :param metric: The metric to look at.
+        :param since: Only look at the splits ending after this timestamp.
+        :return: A list of `SplitTask`.
+        """
+        tasks = []
+        if self.WRITE_FULL:
+            return tasks
+        for aggregation in metric.archive_policy.aggregation_methods:
+            for d in metric.archive_policy.definition:
+                try:
+                    keys = self._list_split_keys_for_metric(
+                        metric, aggregation, d.granularity)
+                except storage.MetricDoesNotExist:
+                    return tasks
+                oldest_immutable_key = self._get_oldest_immutable_split_key(
+                    metric, keys)
+                for key in sorted(keys):
+                    if not next(key) <= oldest_immutable_key:
+                        break
+                    if since is not None and next(key).key <= since:
+                        continue
+                    # NOTE(jd) The first byte tells whether it is compressed.
+                    try:
+                        data = self._get_measures_header(
+                            metric, key, aggregation, 1)
+                    except storage.AggregationDoesNotExist:
+                        continue
+                    if (data and not
+                            carbonara.AggregatedTimeSerie.is_compressed(data)):
+                        tasks.append(SplitTask(
+                            SplitTask.COMPACT, str(metric.id),
+                            aggregation, key))
+        return tasks
+
+    def process_split_tasks(self, indexer, tasks, sync=False):
+        """Run queued split compaction and retention tasks.
+
+        Duplicated tasks are run once and tasks of deleted metrics are
+        ignored.
+
+        :param indexer: An indexer to be used for querying metrics
+        :param tasks: A list of `SplitTask`
+        :param sync: If True, raise on error
+        """
+        unique_tasks = collections.OrderedDict(
+            ((t.action, t.metric_id, t.aggregation, t.key.sampling, t.key.key),
+             t) for t in tasks)
+        tasks_by_metric = collections.OrderedDict()
+        for task in six.itervalues(unique_tasks):
+            tasks_by_metric.setdefault(task.metric_id, []).append(task)
+        metrics = dict((str(m.id), m)
+                       for m in indexer.list_metrics(
+                           ids=list(tasks_by_metric)))
+        for metric_id, metric_tasks in six.iteritems(tasks_by_metric):
+            metric = metrics.get(metric_id)
+            if metric is None:
+                continue
+            if self.metric_locking:
+                # NOTE(jd) The caller holds the sack lock, but the metric can
+                # still be refreshed.
+                lock = self.lock_statistics.acquire(
+                    "metric", self._get_metric_lock(metric))
+            else:
+                lock = utils.nullcontext(True)
+            with lock:
+                for task in metric_tasks:
+                    try:
+                        self._run_split_task(metric, task)
+                    except Exception:
+                        if sync:
+                            raise
+                        LOG.error("Unable to run %s", task, exc_info=True)
+                try:
+                    self._flush_metric_measures(metric)
+                except Exception:
+                    if sync:
+                        raise
+                    LOG.error("Unable to store the splits of metric %s",
+                              metric, exc_info=True)
+
+    def _get_metric_lock(self, metric):
+        return self.coord.get_lock(
+            b"gnocchi-metric-%s-lock" % str(metric.id).encode('ascii'))
+
+    def _get_lock_for_metric(self, incoming, metric):
+        """Return the kind and the lock that protects a metric."""
+        if self.metric_locking:
+            return "metric", self._get_metric_lock(metric)
+        return "sack", incoming.get_sack_lock(
+            self.coord, incoming.sack_for_metric(metric.id))
+
     @staticmethod
     def _delete_metric(metric):
         raise NotImplementedError
 
     def delete_metric(self, incoming, metric, sync=False):
         LOG.debug("Deleting metric %s", metric)
-        lock = incoming.get_sack_lock(
-            self.coord, incoming.sack_for_metric(metric.id))
-        if not lock.acquire(blocking=sync):
-            raise storage.LockedMetric(metric)
+        kind, lock = self._get_lock_for_metric(incoming, metric)
         # NOTE(gordc): no need to hold lock because the metric has been already
         #              marked as "deleted" in the indexer so no measure worker
         #              is going to process it anymore.
-        lock.release()
+        with self.lock_statistics.acquire(kind, lock,
+                                          blocking=sync) as acquired:
+            if not acquired:
+                raise storage.LockedMetric(metric)
         self._delete_metric(metric)
+        self._unaggregated_timeserie_cache.pop(metric.id, None)
+        if self.split_cache is not None:
+            self.split_cache.invalidate(metric.id)
         incoming.delete_unprocessed_measures_for_metric_id(metric.id)
         LOG.debug("Deleted metric %s", metric)
 
@@ -351,35 +975,266 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         raise NotImplementedError
 
     def refresh_metric(self, indexer, incoming, metric, timeout):
-        s = incoming.sack_for_metric(metric.id)
-        lock = incoming.get_sack_lock(self.coord, s)
-        if not lock.acquire(blocking=timeout):
-            raise storage.SackLockTimeoutError(
-                'Unable to refresh metric: %s. Metric is locked. '
-                'Please try again.' % metric.id)
-        try:
-            self.process_new_measures(indexer, incoming,
-                                      [six.text_type(metric.id)])
-        finally:
-            lock.release()
+        kind, lock = self._get_lock_for_metric(incoming, metric)
+        with self.lock_statistics.acquire(kind, lock,
+                                          blocking=timeout) as acquired:
+            if not acquired:
+                raise storage.SackLockTimeoutError(
+                    'Unable to refresh metric: %s. Metric is locked. '
+                    'Please try again.' % metric.id)
+            self._process_new_measures(indexer, incoming,
+                                       [six.text_type(metric.id)],
+                                       lock_metrics=False)
 
     def process_new_measures(self, indexer, incoming, metrics_to_process,
                              sync=False):
+        # NOTE(gordc): must lock at sack level
+        self._process_new_measures(indexer, incoming, metrics_to_process,
+                                   sync, lock_metrics=self.metric_locking)
+
+    def _process_new_measures(self, indexer, incoming, metrics_to_process,
+                              sync=False, lock_metrics=False):
         # process only active metrics. deleted metrics with unprocessed
         # measures will be skipped until cleaned by janitor.
         metrics = indexer.list_metrics(ids=metrics_to_process)
+        first_timestamps = {}
         for metric in metrics:
-            # NOTE(gordc): must lock at sack level
+            if lock_metrics:
+                lock = self.lock_statistics.acquire(
+                    "metric", self._get_metric_lock(metric), blocking=False)
+            else:
+                lock = utils.nullcontext(True)
             try:
+                with lock as acquired:
+                    if not acquired:
+                        # NOTE(jd) Being refreshed: its measures are going to
+                        # be processed anyway.
+                        LOG.debug("Skipping locked metric %s", metric)
+                        continue
+                    LOG.debug("Processing measures for %s", metric)
+                    with incoming.process_measure_for_metric(metric) \
+                            as measures:
+                        self._process_metric_measures(
+                            metric, measures, first_timestamps)
+                    LOG.debug("Measures for metric %s processed", metric)
+            except Exception:
+                if sync:
+                    raise
+                LOG.error("Error processing new measures", exc_info=True)
+
+        if self.group_rollups and first_timestamps:
+            self._update_group_rollups(indexer, first_timestamps, sync)
+
+    def _process_metric_measures(self, metric, measures, first_timestamps):
+        self._compute_and_store_timeseries(metric, measures)
+        if len(measures):
+            first_timestamps[metric] = numpy.min(measures['timestamps'])
+
+    def process_new_measures_for_sack(self, indexer, incoming, sack,
+                                      sync=False):
+        """Process the new measures of all the metrics of a sack.
+
+        The measures are read from the sack and deleted in bulk. The caller
+        must hold the lock of the sack.
+
+        :param indexer: An indexer to be used for querying metrics
+        :param incoming: The incoming storage
+        :param sack: The sack to process
+        :param sync: If True, raise on error
+        :return: The number of metrics with new measures.
+        """
+        if self.metric_locking:
+            # NOTE(jd) Metrics can be refreshed while the sack is read, so
+            # their measures must be read once their lock is held.
+            metrics = incoming.list_metric_with_measures_to_process(sack)
+            self.process_background_tasks(indexer, incoming, metrics, sync)
+            return len(metrics)
+
+        first_timestamps = {}
+        with incoming.process_measures_for_sack(sack) as measures:
+            nb_metrics = len(measures)
+            processed = set()
+            # process only active metrics. deleted metrics with unprocessed
+            # measures will be skipped until cleaned by janitor.
+            for metric in indexer.list_metrics(ids=list(measures)):
+                metric_id = str(metric.id)
                 LOG.debug("Processing measures for %s", metric)
-                with incoming.process_measure_for_metric(metric) \
-                        as measures:
-                    self._compute_and_store_timeseries(metric, measures)
+                try:
+                    self._process_metric_measures(
+                        metric, measures[metric_id], first_timestamps)
+                except Exception:
+                    if sync:
+                        raise
+                    LOG.error("Error processing new measures", exc_info=True)
+                    continue
+                processed.add(metric_id)
                 LOG.debug("Measures for metric %s processed", metric)
+            # NOTE(jd) Keep the measures that have not been processed.
+            for metric_id in set(measures) - processed:
+                del measures[metric_id]
+
+        if self.group_rollups and first_timestamps:
+            self._update_group_rollups(indexer, first_timestamps, sync)
+        return nb_metrics
+
+    def _update_group_rollups(self, indexer, first_timestamps, sync=False):
+        """Update the group rollups of the metrics that got new measures.
+
+        :param first_timestamps: A dict of the oldest new measure timestamp
+                                 indexed by metric.
+        """
+        for rollup in self.group_rollups:
+            timestamps = {}
+            for metric, timestamp in six.iteritems(first_timestamps):
+                if (metric.name == rollup.metric_name
+                   and metric.resource_id is not None):
+                    timestamps[str(metric.resource_id)] = timestamp
+            if not timestamps:
+                continue
+            groups = {}
+            try:
+                for r in indexer.list_resources(
+                        rollup.resource_type,
+                        attribute_filter={"in": {"id": list(timestamps)}}):
+                    group = rollup.get_group(r)
+                    timestamp = timestamps[str(r.id)]
+                    groups[group] = min(groups.get(group, timestamp),
+                                        timestamp)
+                for group, timestamp in six.iteritems(groups):
+                    self._compute_group_rollup(
+                        indexer, rollup, group, timestamp)
             except Exception:
                 if sync:
                     raise
-                LOG.error("Error processing new measures", exc_info=True)
+                LOG.error("Error updating group rollup %s", rollup,
+                          exc_info=True)
+
+    @staticmethod
+    def _serialize_group_rollup_metrics(metrics):
+        return b"\n".join(sorted(str(m.id).encode('ascii') for m in metrics))
+
+    def _compute_group_rollup(self, indexer, rollup, group, from_timestamp):
+        resources = indexer.list_resources(
+            rollup.resource_type,
+            attribute_filter={"and": [
+                {"=": {attr: value}}
+                for attr, value in six.moves.zip(rollup.groupby, group)]})
+        metrics = list(filter(None, (r.get_metric(rollup.metric_name)
+                                     for r in resources)))
+        if not metrics:
+            return
+        rollup_metric = rollup.get_metric(group, metrics)
+        if rollup_metric is None:
+            LOG.debug("Not computing %s for group %s: its metrics have "
+                      "different archive policies", rollup, group)
+            return
+        members = self._serialize_group_rollup_metrics(metrics)
+
+        lock = self.coord.get_lock(
+            b"gnocchi-rollup-%s-lock" % str(rollup_metric.id).encode('ascii'))
+        with lock:
+            try:
+                stored_members = self._get_unaggregated_timeserie(
+                    rollup_metric)
+            except storage.MetricDoesNotExist:
+                stored_members = None
+            if stored_members != members:
+                # NOTE(jd) The group changed: drop the rollup so that no
+                # reader uses it until it is recomputed entirely.
+                if stored_members is not None:
+                    self._delete_metric(rollup_metric)
+                try:
+                    self._create_metric(rollup_metric)
+                except storage.MetricAlreadyExists:
+                    pass
+                from_timestamp = None
+
+            try:
+                self._compute_group_rollup_splits(
+                    rollup, rollup_metric, metrics, from_timestamp)
+            finally:
+                self._flush_metric_measures(rollup_metric)
+
+            self._store_unaggregated_timeserie(rollup_metric, members)
+        LOG.debug("Computed %s for group %s from %d metrics",
+                  rollup, group, len(metrics))
+
+    def _compute_group_rollup_splits(self, rollup, rollup_metric, metrics,
+                                     from_timestamp):
+        for d in rollup_metric.archive_policy.definition:
+            if from_timestamp is None:
+                start = None
+            else:
+                start = carbonara.round_timestamp(
+                    from_timestamp, d.granularity)
+            points = numpy.concatenate([
+                ts.fetch_points(start)
+                for ts in self._map_in_thread(
+                    self._get_measures_timeserie,
+                    ((m, rollup.aggregation, d.granularity, start)
+                     for m in metrics))])
+            if not len(points):
+                continue
+            points = points[numpy.argsort(points['timestamps'],
+                                          kind='mergesort')]
+            grouped = carbonara.GroupedTimeSeries(points, d.granularity)
+            for aggregation in (
+                    rollup_metric.archive_policy.aggregation_methods):
+                self._add_measures(aggregation, d, rollup_metric,
+                                   grouped, None, points['timestamps'][0])
+
+    def get_group_rollup(self, resource_type, metric_name, groupby,
+                         aggregation, reaggregation=None):
+        """Return the group rollup matching an aggregation, or None."""
+        key = (resource_type, metric_name, aggregation,
+               reaggregation or aggregation, tuple(sorted(set(groupby))))
+        for rollup in self.group_rollups:
+            if rollup == key:
+                return rollup
+
+    def get_group_rollup_measures(self, rollup, group, metrics,
+                                  from_timestamp=None, to_timestamp=None,
+                                  granularity=None, needed_overlap=100.0):
+        """Get the cross-metric aggregation of a group from its rollup.
+
+        The result is the same as `get_cross_metric_measures' with the
+        rollup aggregation and reaggregation methods.
+
+        :param rollup: The `GroupRollup`.
+        :param group: The values of the groupby attributes of the group.
+        :param metrics: The metrics of the group.
+        :return: The measures, or None if the rollup has not been computed
+                 from exactly those metrics.
+        """
+        rollup_metric = rollup.get_metric(group, metrics)
+        if rollup_metric is None:
+            return
+        try:
+            stored_members = self._get_unaggregated_timeserie(rollup_metric)
+        except storage.MetricDoesNotExist:
+            return
+        if stored_members != self._serialize_group_rollup_metrics(metrics):
+            return
+
+        if granularity is None:
+            granularities = [d.granularity
+                             for d in rollup_metric.archive_policy.definition]
+        else:
+            granularities = [granularity]
+
+        tss = self._map_in_thread(
+            self._get_measures_timeserie,
+            ((rollup_metric, aggregation, g, from_timestamp, to_timestamp)
+             for g in granularities
+             for aggregation in (rollup.reaggregation, 'count')))
+        try:
+            return [(timestamp.replace(tzinfo=iso8601.iso8601.UTC), r, v)
+                    for timestamp, r, v
+                    in carbonara.AggregatedTimeSerie.aggregated_from_counts(
+                        tss[::2], tss[1::2], len(metrics),
+                        from_timestamp, to_timestamp, needed_overlap)]
+        except carbonara.UnAggregableTimeseries as e:
+            raise storage.MetricUnaggregatable(metrics, e.reason)
 
     def _compute_and_store_timeseries(self, metric, measures):
         # NOTE(mnaser): The metric could have been handled by
@@ -426,6 +1281,7 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         # hack to pass a variable around a closure,
         # sorry.
         computed_points = {"number": 0}
+        latest_points = {}
 
         def _map_add_measures(bound_timeserie):
             # NOTE (gordc): bound_timeserie is entire set of
@@ -440,16 +1296,25 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                     d.granularity, carbonara.round_timestamp(
                         tstamp, d.granularity))
 
-                self._map_in_thread(
+                last_points = self._map_in_thread(
                     self._add_measures,
                     ((aggregation, d, metric, ts,
                         current_first_block_timestamp,
                         new_first_block_timestamp)
                         for aggregation in agg_methods))
+                for aggregation, point in six.moves.zip(agg_methods,
+                                                        last_points):
+                    if point is not None:
+                        latest_points[aggregation, d.granularity] = point
 
         with utils.StopWatch() as sw:
-            ts.set_values(measures,
-                          before_truncate_callback=_map_add_measures)
+            try:
+                ts.set_values(measures,
+                              before_truncate_callback=_map_add_measures)
+            finally:
+                # NOTE(jd) Wait for the splits even on failure, so the ones
+                # already written are not lost for the next pass.
+                self._flush_metric_measures(metric)
 
         number_of_operations = (len(agg_methods) * len(definition))
         perf = ""
@@ -464,7 +1329,57 @@ class CarbonaraBasedStorage(storage.StorageDriver):
                   "in %.2f seconds%s",
                   metric.id, len(measures), elapsed, perf)
 
-        self._store_unaggregated_timeserie(metric, ts.serialize())
+        token = self._store_unaggregated_timeserie(metric, ts.serialize())
+        self._cache_unaggregated_timeserie(metric, token, ts)
+        self._update_latest_measures(metric, latest_points)
+
+    def get_latest_measures(self, metrics, aggregation='mean',
+                            granularity=None):
+        super(CarbonaraBasedStorage, self).get_latest_measures(
+            metrics, aggregation, granularity)
+        results = {}
+        missing = []
+        for metric, data in six.moves.zip(
+                metrics, self._get_latest_measures_batch(metrics)):
+            if data is None:
+                missing.append(metric)
+                continue
+            points = self._unserialize_latest_measures(data)
+            results[metric] = []
+            for d in reversed(metric.archive_policy.definition):
+                if granularity is not None and d.granularity != granularity:
+                    continue
+                point = points.get(
+                    (aggregation, numpy.timedelta64(d.granularity, 'ns')))
+                if point is not None:
+                    results[metric].append(
+                        (point[0], d.granularity, point[1]))
+        # NOTE(jd) Metrics processed before the latest measures were stored
+        # or never processed.
+        for metric, measures in six.moves.zip(missing, self._map_in_thread(
+                self._get_last_measures,
+                ((metric, aggregation, granularity) for metric in missing))):
+            results[metric] = measures
+        return results
+
+    def _get_last_measures(self, metric, aggregation, granularity=None):
+        measures = []
+        for d in reversed(metric.archive_policy.definition):
+            if granularity is not None and d.granularity != granularity:
+                continue
+            try:
+                keys = self._list_split_keys_for_metric(
+                    metric, aggregation, d.granularity)
+            except storage.MetricDoesNotExist:
+                return []
+            for key in sorted(keys, reverse=True):
+                split = self._get_measures_and_unserialize(
+                    metric, key, aggregation)
+                if split:
+                    measures.append((split.timestamps[-1], d.granularity,
+                                     split.values[-1]))
+                    break
+        return measures
 
     def get_cross_metric_measures(self, metrics, from_timestamp=None,
                                   to_timestamp=None, aggregation='mean',
@@ -497,6 +1412,23 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         else:
             granularities_in_common = [granularity]
 
+        if (not resample
+                and self.cross_metric_streaming_threshold
+                and len(metrics) >= self.cross_metric_streaming_threshold
+                and carbonara.SplitAggregation.supports(reaggregation, fill)):
+            agg = carbonara.SplitAggregation(
+                reaggregation, len(metrics), from_timestamp, to_timestamp,
+                needed_overlap, fill)
+            for g in granularities_in_common:
+                self._add_cross_metric_splits(
+                    agg, metrics, aggregation, g,
+                    from_timestamp, to_timestamp)
+            try:
+                return [(timestamp.replace(tzinfo=iso8601.iso8601.UTC), r, v)
+                        for timestamp, r, v in agg.result()]
+            except carbonara.UnAggregableTimeseries as e:
+                raise storage.MetricUnaggregatable(metrics, e.reason)
+
         if resample and granularity:
             tss = self._map_in_thread(self._get_measures_timeserie,
                                       [(metric, aggregation, granularity,
@@ -520,16 +1452,92 @@ class CarbonaraBasedStorage(storage.StorageDriver):
         except carbonara.UnAggregableTimeseries as e:
             raise storage.MetricUnaggregatable(metrics, e.reason)
 
+    def _add_cross_metric_splits(self, agg, metrics, aggregation,
+                                 granularity, from_timestamp, to_timestamp):
+        """Feed a `SplitAggregation` with the splits of several metrics.
+
+        Splits are walked from the newest to the oldest so that each metric
+        is truncated to the number of points of its archive policy, like
+        `_get_measures_timeserie` does.
+        """
+        if from_timestamp:
+            from_key = carbonara.SplitKey.from_timestamp_and_sampling(
+                from_timestamp, granularity)
+        else:
+            from_key = None
+        if to_timestamp:
+            to_key = carbonara.SplitKey.from_timestamp_and_sampling(
+                to_timestamp, granularity)
+        else:
+            to_key = None
+
+        remaining_points = {}
+        keys_by_metric = {}
+        for metric in metrics:
+            for d in metric.archive_policy.definition:
+                if d.granularity == granularity:
+                    remaining_points[metric.id] = d.points
+                    break
+            else:
+                raise storage.GranularityDoesNotExist(metric, granularity)
+            try:
+                keys_by_metric[metric.id] = set(
+                    key for key in self._list_split_keys_for_metric(
+                        metric, aggregation, granularity)
+                    if ((not from_key or key >= from_key)
+                        and (not to_key or key <= to_key)))
+            except storage.MetricDoesNotExist:
+                keys_by_metric[metric.id] = set()
+
+        oldest_immutable_keys = {}
+        if self.split_cache is not None:
+            for metric in metrics:
+                oldest_immutable_keys[metric.id] = (
+                    self._get_oldest_immutable_split_key(
+                        metric, keys_by_metric[metric.id]))
+
+        def _is_cacheable(metric, key):
+            oldest_immutable_key = oldest_immutable_keys.get(metric.id)
+            return (oldest_immutable_key is not None
+                    and next(key) <= oldest_immutable_key)
+
+        def _get_splits(key):
+            metrics_with_key = [
+                metric for metric in metrics
+                if key in keys_by_metric[metric.id]
+                and remaining_points[metric.id] > 0
+            ]
+            for batch in utils.grouper(metrics_with_key,
+                                       self.CROSS_METRIC_READ_BATCH):
+                splits = self._map_in_thread(
+                    self._get_measures_and_unserialize_cached,
+                    ((metric, key, aggregation, _is_cacheable(metric, key))
+                     for metric in batch))
+                for metric, split in six.moves.zip(batch, splits):
+                    if split is None or not len(split):
+                        continue
+                    points = split[-remaining_points[metric.id]:]
+                    remaining_points[metric.id] -= len(points)
+                    yield ((metric.id, granularity),
+                           carbonara.AggregatedTimeSerie(
+                               granularity, aggregation, points))
+
+        all_keys = set(itertools.chain.from_iterable(
+            six.itervalues(keys_by_metric)))
+        for key in sorted(all_keys, reverse=True):
+            agg.add_split(key, _get_splits(key))
+
     def _find_measure(self, metric, aggregation, granularity, predicate,
                       from_timestamp, to_timestamp):
         timeserie = self._get_measures_timeserie(
             metric, aggregation, granularity,
             from_timestamp, to_timestamp)
-        values = timeserie.fetch(from_timestamp, to_timestamp)
-        return {metric:
-                [(timestamp, g, value)
-                 for timestamp, g, value in values
-                 if predicate(value)]}
+        points = timeserie.fetch_points(from_timestamp, to_timestamp)
+        points = points[predicate(points['values'])]
+        return {metric: list(six.moves.zip(
+            points['timestamps'],
+            itertools.repeat(timeserie.sampling),
+            points['values']))}
 
     def search_value(self, metrics, query, from_timestamp=None,
                      to_timestamp=None, aggregation='mean',
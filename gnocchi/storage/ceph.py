@@ -13,8 +13,12 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import errno
+import functools
+import itertools
 
 from oslo_config import cfg
+import six
 
 from gnocchi.common import ceph
 from gnocchi import storage
@@ -44,9 +48,17 @@ rados = ceph.rados
 class CephStorage(_carbonara.CarbonaraBasedStorage):
     WRITE_FULL = False
 
+    # NOTE(jd) A split holds at most 3600 points of 9 bytes, or 10 bytes
+    # once compressed with lz4, so it is always smaller than that: one read
+    # of that size gets a whole split.
+    SPLIT_READ_SIZE = 64 * 1024
+
     def __init__(self, conf, coord=None):
         super(CephStorage, self).__init__(conf, coord)
         self.rados, self.ioctx = ceph.create_rados_connection(conf)
+        # NOTE(jd) Splits are written asynchronously and registered in the
+        # omap of the metric all at once by `_flush_metric_measures'.
+        self._pending_writes = _carbonara.PendingWrites()
 
     def __str__(self):
         # Use cluster ID for now
@@ -82,16 +94,39 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
                                data, offset=None, version=3):
         name = self._get_object_name(metric, key, aggregation, version)
         if offset is None:
-            self.ioctx.write_full(name, data)
+            completion = self.ioctx.aio_write_full(name, data)
         else:
-            self.ioctx.write(name, data, offset=offset)
-        with rados.WriteOpCtx() as op:
-            self.ioctx.set_omap(op, (name,), (b"",))
-            self.ioctx.operate_write_op(
-                op, self._build_unaggregated_timeserie_path(metric, 3))
+            completion = self.ioctx.aio_write(name, data, offset=offset)
+        self._pending_writes.add(metric, name, completion)
+
+    @staticmethod
+    def _wait_for_completions(completions):
+        for completion in completions:
+            completion.wait_for_complete_and_cb()
+        for completion in completions:
+            ceph.errno_to_exception(completion.get_return_value())
+
+    def _wait_for_pending_writes(self, metric, name=None):
+        """Wait for the writes of a metric, or of one of its objects.
+
+        :return: The names of the objects written.
+        """
+        pending = self._pending_writes.pop(metric, name)
+        self._wait_for_completions(
+            list(itertools.chain.from_iterable(six.itervalues(pending))))
+        return list(pending)
+
+    def _flush_metric_measures(self, metric):
+        names = self._wait_for_pending_writes(metric)
+        if names:
+            with rados.WriteOpCtx() as op:
+                self.ioctx.set_omap(op, tuple(names), (b"",) * len(names))
+                self.ioctx.operate_write_op(
+                    op, self._build_unaggregated_timeserie_path(metric, 3))
 
     def _delete_metric_measures(self, metric, key, aggregation, version=3):
         name = self._get_object_name(metric, key, aggregation, version)
+        self._wait_for_pending_writes(metric, name)
 
         try:
             self.ioctx.remove_object(name)
@@ -107,6 +142,7 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
                 op, self._build_unaggregated_timeserie_path(metric, 3))
 
     def _delete_metric(self, metric):
+        self._wait_for_pending_writes(metric)
         with rados.ReadOpCtx() as op:
             omaps, ret = self.ioctx.get_omap_vals(op, "", "", -1)
             try:
@@ -131,23 +167,68 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
         for op in ops:
             op.wait_for_complete_and_cb()
 
-        try:
-            self.ioctx.remove_object(
-                self._build_unaggregated_timeserie_path(metric, 3))
-        except rados.ObjectNotFound:
-            # It's possible that the object does not exists
-            pass
+        for name in (self._build_latest_measures_path(metric, 3),
+                     self._build_unaggregated_timeserie_path(metric, 3)):
+            try:
+                self.ioctx.remove_object(name)
+            except rados.ObjectNotFound:
+                # It's possible that the object does not exists
+                pass
 
     def _get_measures(self, metric, key, aggregation, version=3):
+        name = self._get_object_name(metric, key, aggregation, version)
+        # NOTE(jd) The split may be rewritten during the same pass.
+        self._wait_for_completions(self._pending_writes.get(metric, name))
         try:
-            name = self._get_object_name(metric, key, aggregation, version)
             return self._get_object_content(name)
         except rados.ObjectNotFound:
-            if self._object_exists(
-                    self._build_unaggregated_timeserie_path(metric, 3)):
-                raise storage.AggregationDoesNotExist(metric, aggregation)
-            else:
-                raise storage.MetricDoesNotExist(metric)
+            self._raise_measures_not_found(metric, aggregation)
+
+    def _get_measures_header(self, metric, key, aggregation, size,
+                             version=3):
+        name = self._get_object_name(metric, key, aggregation, version)
+        self._wait_for_completions(self._pending_writes.get(metric, name))
+        try:
+            return self.ioctx.read(name, length=size)
+        except rados.ObjectNotFound:
+            self._raise_measures_not_found(metric, aggregation)
+
+    def _raise_measures_not_found(self, metric, aggregation):
+        if self._object_exists(
+                self._build_unaggregated_timeserie_path(metric, 3)):
+            raise storage.AggregationDoesNotExist(metric, aggregation)
+        else:
+            raise storage.MetricDoesNotExist(metric)
+
+    def _get_measures_batch(self, metric, keys, aggregation, version=3):
+        names = [self._get_object_name(metric, key, aggregation, version)
+                 for key in keys]
+        for name in names:
+            self._wait_for_completions(self._pending_writes.get(metric, name))
+        contents = {}
+
+        def _on_read(name, completion, data):
+            contents[name] = data
+
+        # NOTE(jd) Send all the reads at once rather than one per thread.
+        completions = [
+            self.ioctx.aio_read(name, self.SPLIT_READ_SIZE, 0,
+                                functools.partial(_on_read, name))
+            for name in names
+        ]
+        for completion in completions:
+            completion.wait_for_complete_and_cb()
+        results = []
+        for name, completion in six.moves.zip(names, completions):
+            ret = completion.get_return_value()
+            if ret == -errno.ENOENT:
+                self._raise_measures_not_found(metric, aggregation)
+            ceph.errno_to_exception(ret)
+            content = contents[name]
+            if len(content) >= self.SPLIT_READ_SIZE:
+                content = self._get_object_content(name)
+            results.append(content)
+        return results
 
     def _list_split_keys(self, metric, aggregation, granularity, version=3):
         with rados.ReadOpCtx() as op:
@@ -194,9 +275,30 @@ class CephStorage(_carbonara.CarbonaraBasedStorage):
         self.ioctx.write_full(
             self._build_unaggregated_timeserie_path(metric, version), data)
 
+    @staticmethod
+    def _build_latest_measures_path(metric, version):
+        return (('gnocchi_%s_latest' % metric.id)
+                + ("_v%s" % version if version else ""))
+
+    def _store_latest_measures(self, metric, data, version=3):
+        self.ioctx.write_full(
+            self._build_latest_measures_path(metric, version), data)
+
+    def _get_latest_measures(self, metric, version=3):
+        try:
+            return self._get_object_content(
+                self._build_latest_measures_path(metric, version))
+        except rados.ObjectNotFound:
+            return
+
     def _get_object_content(self, name):
-        offset = 0
-        content = b''
+        # NOTE(jd) Read the object at once rather than by chunks of 8 KiB.
+        # One more byte is asked to notice if it grew in the mean time.
+        length = self.ioctx.stat(name)[0] + 1
+        content = self.ioctx.read(name, length=length)
+        if len(content) < length:
+            return content
+        offset = len(content)
         while True:
             data = self.ioctx.read(name, offset=offset)
             if not data:
@@ -14,13 +14,20 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import collections
 import errno
+import mmap
 import os
 import shutil
+import struct
 import tempfile
+import threading
+import uuid
 
 from oslo_config import cfg
+import six
 
+from gnocchi.common import file as common_file
 from gnocchi import storage
 from gnocchi.storage import _carbonara
 from gnocchi import utils
@@ -30,17 +37,77 @@ OPTS = [
     cfg.StrOpt('file_basepath',
                default='/var/lib/gnocchi',
                help='Path used to store gnocchi data files.'),
+    cfg.IntOpt('file_subdir_levels',
+               default=0,
+               min=0,
+               max=4,
+               help='Number of levels of subdirectories, named after the '
+                    'hash of the metric id, used to spread the metrics '
+                    'directories, for file systems or tools that do not '
+                    'cope with large directories. Each level has up to 256 '
+                    'subdirectories. This makes metric lookups and listings '
+                    'slower: with 2 levels, listing the metrics of an '
+                    'incoming sack walks up to 65536 directories. Stop the '
+                    'Gnocchi services and run gnocchi-upgrade after '
+                    'changing it to move the existing directories; until '
+                    'then, the previous number of levels is used.'),
+    cfg.StrOpt('file_layout',
+               default='split',
+               choices=['split', 'segment'],
+               help='How aggregated measures are laid out on disk. `split\' '
+                    'stores each split in its own file, rewritten every '
+                    'time it changes. `segment\' appends the splits of a '
+                    'granularity and an aggregation method to a single '
+                    'file, compacted from time to time. This must not be '
+                    'changed once measures have been stored.'),
+    cfg.FloatOpt('file_segment_compaction_ratio',
+                 default=0.5,
+                 min=0,
+                 max=1,
+                 help='Compact a segment file once this ratio of its size '
+                      'is used by splits that have been replaced or '
+                      'deleted.'),
+    cfg.IntOpt('file_log_segment_size',
+               default=64 * 1024 * 1024,
+               min=1,
+               help='Size in bytes after which the filelog incoming driver '
+                    'starts a new segment file in the log of a sack. '
+                    'Segment files are deleted once all their measures '
+                    'have been processed.'),
 ]
 
 
 class FileStorage(_carbonara.CarbonaraBasedStorage):
     WRITE_FULL = True
 
+    # Header of each split appended to a segment file: the split key in
+    # nanoseconds and the size of the split, 0 if the split has been deleted.
+    SEGMENT_HEADER = struct.Struct("<qI")
+    # Key of the record starting each segment file, followed by a random
+    # generation identifying the file, which changes on each compaction.
+    SEGMENT_GENERATION_KEY = -2 ** 63
+    SEGMENT_GENERATION_SIZE = 16
+    # Segment files smaller than this are never compacted
+    SEGMENT_COMPACTION_MIN_SIZE = 64 * 1024
+    # Number of segment file indexes kept in memory
+    SEGMENT_INDEXES_CACHE_SIZE = 10000
+
     def __init__(self, conf, coord=None):
         super(FileStorage, self).__init__(conf, coord)
         self.basepath = conf.file_basepath
         self.basepath_tmp = os.path.join(self.basepath, 'tmp')
         utils.ensure_paths([self.basepath_tmp])
+        self._subdir_levels_path = os.path.join(self.basepath_tmp,
+                                                "storage_subdir_levels")
+        self._configured_subdir_levels = conf.file_subdir_levels
+        self.subdir_levels = common_file.get_current_subdir_levels(
+            self._subdir_levels_path, conf.file_subdir_levels)
+        self.segment_layout = conf.file_layout == 'segment'
+        self.segment_compaction_ratio = conf.file_segment_compaction_ratio
+        # NOTE(jd) Index of the splits of each segment file read so far, so
+        # only the splits appended since are read again.
+        self._segment_indexes = collections.OrderedDict()
+        self._segment_indexes_lock = threading.Lock()
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, str(self.basepath))
@@ -53,14 +120,29 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
         tmpfile.close()
         os.rename(tmpfile.name, dest)
 
+    def upgrade(self):
+        super(FileStorage, self).upgrade()
+        common_file.shard_directory(
+            self.basepath, self._configured_subdir_levels,
+            common_file.get_subdir_levels(self._subdir_levels_path) or 0)
+        common_file.set_subdir_levels(self._subdir_levels_path,
+                                      self._configured_subdir_levels)
+        self.subdir_levels = self._configured_subdir_levels
+
     def _build_metric_dir(self, metric):
-        return os.path.join(self.basepath, str(metric.id))
+        return common_file.get_path(self.basepath, str(metric.id),
+                                    self.subdir_levels)
 
     def _build_unaggregated_timeserie_path(self, metric, version=3):
         return os.path.join(
             self._build_metric_dir(metric),
             'none' + ("_v%s" % version if version else ""))
 
+    def _build_latest_measures_path(self, metric, version=3):
+        return os.path.join(
+            self._build_metric_dir(metric),
+            'latest' + ("_v%s" % version if version else ""))
+
     def _build_metric_path(self, metric, aggregation):
         return os.path.join(self._build_metric_dir(metric),
                             "agg_" + aggregation)
@@ -74,8 +156,119 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
             + str(utils.timespan_total_seconds(key.sampling)))
         return path + '_v%s' % version if version else path
 
+    def _build_segment_path(self, metric, aggregation, granularity,
+                            version=3):
+        path = os.path.join(
+            self._build_metric_path(metric, aggregation),
+            str(utils.timespan_total_seconds(granularity)) + ".segment")
+        return path + '_v%s' % version if version else path
+
+    def _open_segment(self, path):
+        """Open a segment file, or return None if it does not exist."""
+        try:
+            return open(path, 'rb')
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
+    def _new_segment_generation(self):
+        return self.SEGMENT_HEADER.pack(
+            self.SEGMENT_GENERATION_KEY,
+            self.SEGMENT_GENERATION_SIZE) + uuid.uuid4().bytes
+
+    def _read_segment_generation(self, f):
+        """Return the generation of an open segment file, if it has one."""
+        f.seek(0)
+        data = f.read(self.SEGMENT_HEADER.size + self.SEGMENT_GENERATION_SIZE)
+        if len(data) == (self.SEGMENT_HEADER.size
+                         + self.SEGMENT_GENERATION_SIZE):
+            key, length = self.SEGMENT_HEADER.unpack_from(data)
+            if key == self.SEGMENT_GENERATION_KEY:
+                return data[self.SEGMENT_HEADER.size:]
+
+    def _read_segment_index(self, f):
+        """Return the index of an open segment file.
+
+        :return: A tuple (index, size, garbage) where index is a dict of
+                 (offset, length) of the splits indexed by their key in
+                 nanoseconds, size the size of the file indexed and garbage
+                 the number of bytes used by replaced or deleted splits.
+        """
+        st = os.fstat(f.fileno())
+        # NOTE(jd) Compacted files replace the previous ones by renaming, and
+        # their inode number may be reused: the generation tells them apart.
+        generation = self._read_segment_generation(f)
+        with self._segment_indexes_lock:
+            cached = self._segment_indexes.pop(f.name, None)
+        if (cached is not None and cached[:2] == (st.st_ino, generation)
+                and cached[3] <= st.st_size):
+            __, __, index, offset, garbage = cached
+            if offset == st.st_size:
+                self._cache_segment_index(f.name, cached)
+                return index, offset, garbage
+            index = index.copy()
+        else:
+            index, offset, garbage = {}, 0, 0
+        if st.st_size == 0:
+            return index, offset, garbage
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header_size = self.SEGMENT_HEADER.size
+            # NOTE(jd) Stop at a split that is still being appended.
+            while offset + header_size <= len(m):
+                key, length = self.SEGMENT_HEADER.unpack_from(m, offset)
+                if offset + header_size + length > len(m):
+                    break
+                if key == self.SEGMENT_GENERATION_KEY:
+                    offset += header_size + length
+                    continue
+                previous = index.pop(key, None)
+                if previous is not None:
+                    garbage += previous[1] + header_size
+                if length:
+                    index[key] = (offset + header_size, length)
+                else:
+                    garbage += header_size
+                offset += header_size + length
+        finally:
+            m.close()
+        self._cache_segment_index(
+            f.name, (st.st_ino, generation, index, offset, garbage))
+        return index, offset, garbage
+
+    def _cache_segment_index(self, path, cached):
+        with self._segment_indexes_lock:
+            self._segment_indexes[path] = cached
+            while len(self._segment_indexes) > self.SEGMENT_INDEXES_CACHE_SIZE:
+                self._segment_indexes.popitem(last=False)
+
+    def _append_segment(self, path, key, data):
+        with open(path, 'ab') as f:
+            record = self.SEGMENT_HEADER.pack(
+                key.key.astype('datetime64[ns]').astype(int), len(data))
+            if os.fstat(f.fileno()).st_size == 0:
+                record = self._new_segment_generation() + record
+            f.write(record + data)
+        with open(path, 'rb') as f:
+            index, size, garbage = self._read_segment_index(f)
+            if (size >= self.SEGMENT_COMPACTION_MIN_SIZE
+                    and garbage > size * self.segment_compaction_ratio):
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    data = self._new_segment_generation() + b"".join(
+                        self.SEGMENT_HEADER.pack(split_key, length)
+                        + m[offset:offset + length]
+                        for split_key, (offset, length)
+                        in sorted(index.items()))
+                finally:
+                    m.close()
+                self._atomic_file_store(path, data)
+
     def _create_metric(self, metric):
         path = self._build_metric_dir(metric)
+        if self.subdir_levels:
+            utils.ensure_paths([os.path.dirname(path)])
         try:
             os.mkdir(path, 0o750)
         except OSError as e:
@@ -90,21 +283,87 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
                     raise
 
     def _store_unaggregated_timeserie(self, metric, data, version=3):
-        self._atomic_file_store(
-            self._build_unaggregated_timeserie_path(metric, version),
-            data)
+        path = self._build_unaggregated_timeserie_path(metric, version)
+        self._atomic_file_store(path, data)
+        return self._file_version(path)
+
+    @staticmethod
+    def _file_version(path):
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+        # NOTE(jd) Files are always replaced by renaming a new file, so the
+        # inode changes on each write; mtime and size make reuse harmless.
+        return st.st_ino, st.st_mtime, st.st_size
 
-    def _get_unaggregated_timeserie(self, metric, version=3):
+    def _get_unaggregated_timeserie_version(self, metric, version=3):
+        return self._file_version(
+            self._build_unaggregated_timeserie_path(metric, version))
+
+    def _get_unaggregated_timeserie(self, metric, version=3, mapped=False):
         path = self._build_unaggregated_timeserie_path(metric, version)
         try:
             with open(path, 'rb') as f:
+                if mapped:
+                    return self._map_file(f)
                 return f.read()
         except IOError as e:
             if e.errno == errno.ENOENT:
                 raise storage.MetricDoesNotExist(metric)
             raise
 
+    def _get_unaggregated_timeserie_buffer(self, metric, version=3):
+        return self._get_unaggregated_timeserie(metric, version, mapped=True)
+
+    @staticmethod
+    def _map_file(f, offset=0, length=None):
+        """Return the content of an open file as a read-only buffer.
+
+        The file is mapped in memory: the data is read from the page cache
+        shared by all processes instead of being copied in each of them.
+        """
+        if length is None:
+            length = os.fstat(f.fileno()).st_size - offset
+        if not length:
+            return b""
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if six.PY2:
+            # NOTE(jd) mmap objects do not support memoryview on Python 2
+            try:
+                return m[offset:offset + length]
+            finally:
+                m.close()
+        # NOTE(jd) The mapping is closed once the buffer is not used anymore.
+        return memoryview(m)[offset:offset + length]
+
+    def _store_latest_measures(self, metric, data, version=3):
+        self._atomic_file_store(
+            self._build_latest_measures_path(metric, version), data)
+
+    def _get_latest_measures(self, metric, version=3):
+        try:
+            with open(self._build_latest_measures_path(metric, version),
+                      'rb') as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return
+            raise
+
     def _list_split_keys(self, metric, aggregation, granularity, version=3):
+        if self.segment_layout:
+            if not os.path.isdir(self._build_metric_path(metric, aggregation)):
+                raise storage.MetricDoesNotExist(metric)
+            f = self._open_segment(self._build_segment_path(
+                metric, aggregation, granularity, version))
+            if f is None:
+                return set()
+            with f:
+                index, __, __ = self._read_segment_index(f)
+            return set(str(key / 10e8) for key in index)
         try:
             files = os.listdir(self._build_metric_path(metric, aggregation))
         except OSError as e:
@@ -120,11 +379,19 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
         return keys
 
     def _delete_metric_measures(self, metric, key, aggregation, version=3):
+        if self.segment_layout:
+            self._append_segment(self._build_segment_path(
+                metric, aggregation, key.sampling, version), key, b"")
+            return
         os.unlink(self._build_metric_path_for_split(
             metric, aggregation, key, version))
 
     def _store_metric_measures(self, metric, key, aggregation,
                                data, offset=None, version=3):
+        if self.segment_layout:
+            self._append_segment(self._build_segment_path(
+                metric, aggregation, key.sampling, version), key, data)
+            return
         self._atomic_file_store(
             self._build_metric_path_for_split(
                 metric, aggregation, key, version),
@@ -140,11 +407,21 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
                 # measures)
                 raise
 
-    def _get_measures(self, metric, key, aggregation, version=3):
+    def _get_measures_buffer(self, metric, key, aggregation, version=3):
+        return self._get_measures(metric, key, aggregation, version,
+                                  mapped=True)
+
+    def _get_measures(self, metric, key, aggregation, version=3,
+                      mapped=False):
+        if self.segment_layout:
+            return self._get_segment_measures(metric, key, aggregation,
+                                              version, mapped)
         path = self._build_metric_path_for_split(
             metric, aggregation, key, version)
         try:
             with open(path, 'rb') as aggregation_file:
+                if mapped:
+                    return self._map_file(aggregation_file)
                 return aggregation_file.read()
         except IOError as e:
             if e.errno == errno.ENOENT:
@@ -152,3 +429,22 @@ class FileStorage(_carbonara.CarbonaraBasedStorage):
                     raise storage.AggregationDoesNotExist(metric, aggregation)
                 raise storage.MetricDoesNotExist(metric)
             raise
+
+    def _get_segment_measures(self, metric, key, aggregation, version=3,
+                              mapped=False):
+        f = self._open_segment(self._build_segment_path(
+            metric, aggregation, key.sampling, version))
+        if f is not None:
+            with f:
+                index, __, __ = self._read_segment_index(f)
+                split = index.get(
+                    key.key.astype('datetime64[ns]').astype(int))
+                if split is not None:
+                    offset, length = split
+                    data = self._map_file(f, offset, length)
+                    if mapped:
+                        return data
+                    return bytes(data)
+        if os.path.exists(self._build_metric_dir(metric)):
+            raise storage.AggregationDoesNotExist(metric, aggregation)
+        raise storage.MetricDoesNotExist(metric)
@@ -13,7 +13,11 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import uuid
+
+import daiquiri
 from oslo_config import cfg
+import six
 
 from gnocchi.common import redis
 from gnocchi import storage
@@ -27,6 +31,8 @@ OPTS = [
                help='Redis URL'),
 ]
 
+LOG = daiquiri.getLogger(__name__)
+
 
 class RedisStorage(_carbonara.CarbonaraBasedStorage):
     WRITE_FULL = True
@@ -37,17 +43,60 @@ class RedisStorage(_carbonara.CarbonaraBasedStorage):
     def __init__(self, conf, coord=None):
         super(RedisStorage, self).__init__(conf, coord)
         self._client = redis.get_client(conf)
+        # NOTE(jd) Splits written and deleted are sent in one pipeline by
+        # `_flush_metric_measures'.
+        self._pending_writes = _carbonara.PendingWrites()
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self._client)
 
+    def upgrade(self):
+        super(RedisStorage, self).upgrade()
+        # NOTE(jd) Index the splits stored before the split indexes existed.
+        prefix = self.STORAGE_PREFIX + redis.SEP
+        for key in self._client.scan_iter(match=prefix + "*"):
+            key = key.decode("utf8")
+            if redis.SEP in key[len(prefix):]:
+                # A split index
+                continue
+            pipe = self._client.pipeline(transaction=False)
+            for field, __ in self._client.hscan_iter(key):
+                meta = field.decode("utf8").split(self.FIELD_SEP)
+                if len(meta) < 4 or meta[0] in ("none", "latest"):
+                    continue
+                index = redis.SEP.join([key, self.FIELD_SEP.join(
+                    [self.FIELD_SEP.join(meta[1:-2]), meta[-2], meta[-1]])])
+                pipe.execute_command("ZADD", index, float(meta[0]), meta[0])
+            indexed = len(pipe.execute())
+            if indexed:
+                LOG.info("Indexed %d splits of %s", indexed, key)
+
     def _metric_key(self, metric):
         return redis.SEP.join([self.STORAGE_PREFIX, str(metric.id)])
 
+    def _split_index_key(self, metric, aggregation, granularity, version=3):
+        """Return the key of the sorted set of the splits of a timeserie.
+
+        Its members are the split keys, scored by their timestamp.
+        """
+        path = self.FIELD_SEP.join([
+            aggregation, str(utils.timespan_total_seconds(granularity))])
+        return redis.SEP.join([
+            self._metric_key(metric),
+            path + '_v%s' % version if version else path])
+
     @staticmethod
     def _unaggregated_field(version=3):
         return 'none' + ("_v%s" % version if version else "")
 
+    @classmethod
+    def _unaggregated_version_field(cls, version=3):
+        return cls._unaggregated_field(version) + cls.FIELD_SEP + 'version'
+
+    @staticmethod
+    def _latest_measures_field(version=3):
+        return 'latest' + ("_v%s" % version if version else "")
+
     @classmethod
     def _aggregated_field_for_split(cls, aggregation, key, version=3,
                                     granularity=None):
@@ -63,8 +112,20 @@ class RedisStorage(_carbonara.CarbonaraBasedStorage):
         self._client.hset(key, self._unaggregated_field(), '')
 
     def _store_unaggregated_timeserie(self, metric, data, version=3):
-        self._client.hset(self._metric_key(metric),
-                          self._unaggregated_field(version), data)
+        token = uuid.uuid4().hex
+        pipe = self._client.pipeline()
+        pipe.hset(self._metric_key(metric),
+                  self._unaggregated_field(version), data)
+        pipe.hset(self._metric_key(metric),
+                  self._unaggregated_version_field(version), token)
+        pipe.execute()
+        return token
+
+    def _get_unaggregated_timeserie_version(self, metric, version=3):
+        token = self._client.hget(self._metric_key(metric),
+                                  self._unaggregated_version_field(version))
+        if token is not None:
+            return token.decode()
 
     def _get_unaggregated_timeserie(self, metric, version=3):
         data = self._client.hget(self._metric_key(metric),
@@ -73,40 +134,111 @@ class RedisStorage(_carbonara.CarbonaraBasedStorage):
             raise storage.MetricDoesNotExist(metric)
         return data
 
+    def _store_latest_measures(self, metric, data, version=3):
+        self._client.hset(self._metric_key(metric),
+                          self._latest_measures_field(version), data)
+
+    def _get_latest_measures(self, metric, version=3):
+        return self._client.hget(self._metric_key(metric),
+                                 self._latest_measures_field(version))
+
+    def _get_latest_measures_batch(self, metrics, version=3):
+        pipe = self._client.pipeline(transaction=False)
+        for metric in metrics:
+            pipe.hget(self._metric_key(metric),
+                      self._latest_measures_field(version))
+        return pipe.execute()
+
     def _list_split_keys(self, metric, aggregation, granularity, version=3):
-        key = self._metric_key(metric)
-        if not self._client.exists(key):
+        index = self._split_index_key(
+            metric, aggregation, granularity, version)
+        pipe = self._client.pipeline(transaction=False)
+        pipe.exists(self._metric_key(metric))
+        pipe.zrange(index, 0, -1)
+        exists, split_keys = pipe.execute()
+        if not exists:
             raise storage.MetricDoesNotExist(metric)
-        split_keys = set()
-        hashes = self._client.hscan_iter(
-            key, match=self._aggregated_field_for_split(
-                aggregation, '*', version, granularity))
-        for f, __ in hashes:
-            meta = f.decode("utf8").split(self.FIELD_SEP, 1)
-            split_keys.add(meta[0])
+        split_keys = set(k.decode("utf8") for k in split_keys)
+        for field, writes in self._pending_writes.items(metric):
+            pending_index, key, data = writes[-1]
+            if pending_index == index:
+                if data is None:
+                    split_keys.discard(str(key))
+                else:
+                    split_keys.add(str(key))
         return split_keys
 
     def _delete_metric_measures(self, metric, key, aggregation, version=3):
         field = self._aggregated_field_for_split(aggregation, key, version)
-        self._client.hdel(self._metric_key(metric), field)
+        self._pending_writes.add(metric, field, (
+            self._split_index_key(metric, aggregation, key.sampling, version),
+            key, None))
 
     def _store_metric_measures(self, metric, key, aggregation,
                                data, offset=None, version=3):
         field = self._aggregated_field_for_split(
             aggregation, key, version)
-        self._client.hset(self._metric_key(metric), field, data)
+        self._pending_writes.add(metric, field, (
+            self._split_index_key(metric, aggregation, key.sampling, version),
+            key, data))
+
+    def _flush_metric_measures(self, metric):
+        pending = self._pending_writes.pop(metric)
+        if not pending:
+            return
+        redis_key = self._metric_key(metric)
+        pipe = self._client.pipeline()
+        for field, writes in six.iteritems(pending):
+            # NOTE(jd) Only the last write of a split matters.
+            index, key, data = writes[-1]
+            if data is None:
+                pipe.hdel(redis_key, field)
+                pipe.zrem(index, str(key))
+            else:
+                pipe.hset(redis_key, field, data)
+                pipe.execute_command(
+                    "ZADD", index, float(str(key)), str(key))
+        pipe.execute()
 
     def _delete_metric(self, metric):
-        self._client.delete(self._metric_key(metric))
+        self._pending_writes.pop(metric)
+        self._client.delete(self._metric_key(metric), *[
+            self._split_index_key(metric, aggregation, d.granularity)
+            for aggregation in metric.archive_policy.aggregation_methods
+            for d in metric.archive_policy.definition])
 
     # Carbonara API
 
+    def _get_pending_measures(self, metric, field):
+        """Return the data of a split not sent to Redis yet.
+
+        :return: The data, None if the split is being deleted, or False if
+                 the split has not been written.
+        """
+        writes = self._pending_writes.get(metric, field)
+        if not writes:
+            return False
+        return writes[-1][2]
+
     def _get_measures(self, metric, key, aggregation, version=3):
+        return self._get_measures_batch(metric, [key], aggregation, version)[0]
+
+    def _get_measures_batch(self, metric, keys, aggregation, version=3):
         redis_key = self._metric_key(metric)
-        field = self._aggregated_field_for_split(aggregation, key, version)
-        data = self._client.hget(redis_key, field)
-        if data is None:
-            if not self._client.exists(redis_key):
-                raise storage.MetricDoesNotExist(metric)
-            raise storage.AggregationDoesNotExist(metric, aggregation)
-        return data
+        fields = [self._aggregated_field_for_split(aggregation, key, version)
+                  for key in keys]
+        pipe = self._client.pipeline(transaction=False)
+        pipe.exists(redis_key)
+        for field in fields:
+            pipe.hget(redis_key, field)
+        results = pipe.execute()
+        exists, contents = results[0], results[1:]
+        for i, field in enumerate(fields):
+            pending = self._get_pending_measures(metric, field)
+            if pending is not False:
+                contents[i] = pending
+            if contents[i] is None:
+                if not exists:
+                    raise storage.MetricDoesNotExist(metric)
+                raise storage.AggregationDoesNotExist(metric, aggregation)
+        return contents
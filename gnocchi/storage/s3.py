@@ -13,9 +13,15 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import base64
+import collections
+import hashlib
 import os
+import threading
 
+from concurrent import futures
 from oslo_config import cfg
+import six
 import tenacity
 
 from gnocchi.common import s3
@@ -50,6 +56,25 @@ OPTS = [
                  help="Maximum time to wait checking data consistency when "
                  "writing to S3. Set to 0 to disable data consistency "
                  "validation."),
+    cfg.StrOpt('s3_consistency_check',
+               choices=['head', 'etag', 'manifest'],
+               default='head',
+               help="How data consistency is checked when writing to S3. "
+               "'head' reads every object written until S3 returns it, "
+               "so any process reads what has been written. 'etag' only "
+               "sends the MD5 of the objects written so that S3 rejects "
+               "corrupted writes, and does not wait for them to be "
+               "readable. 'manifest' does the same and also remembers the "
+               "ETag of the objects written, reading them again until S3 "
+               "returns that version, but only in the process that wrote "
+               "them. 'etag' and 'manifest' are only safe with an S3 "
+               "implementation providing read-after-write consistency."),
+    cfg.IntOpt('s3_max_pool_connections',
+               min=1,
+               default=50,
+               help='Maximum number of connections kept open to S3 by a '
+                    'process, which is also the number of objects '
+                    'uploaded or downloaded concurrently.'),
 ]
 
 
@@ -58,10 +83,19 @@ def retry_if_operationaborted(exception):
             and exception.response['Error'].get('Code') == "OperationAborted")
 
 
+def retry_if_stale(exception):
+    return (isinstance(exception, botocore.exceptions.ClientError)
+            and exception.response['Error'].get('Code') in (
+                "PreconditionFailed", "NoSuchKey", "412"))
+
+
 class S3Storage(_carbonara.CarbonaraBasedStorage):
 
     WRITE_FULL = True
 
+    # Number of ETags remembered by the 'manifest' consistency check
+    MANIFEST_SIZE = 100000
+
     _consistency_wait = tenacity.wait_exponential(multiplier=0.1)
 
     def __init__(self, conf, coord=None):
@@ -75,10 +109,22 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
                 conf.s3_check_consistency_timeout)
         else:
             self._consistency_stop = None
+        self._consistency_check = conf.s3_consistency_check
+        self._manifest = collections.OrderedDict()
+        self._manifest_lock = threading.Lock()
+        # NOTE(jd) Splits are uploaded in the background and waited for by
+        # `_flush_metric_measures'.
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=conf.s3_max_pool_connections)
+        self._pending_writes = _carbonara.PendingWrites()
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self._bucket_name)
 
+    def stop(self):
+        self._executor.shutdown()
+        super(S3Storage, self).stop()
+
     def upgrade(self):
         super(S3Storage, self).upgrade()
         try:
@@ -103,10 +149,43 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
     def _create_metric(self, metric):
         pass
 
+    def _set_manifest(self, key, etag):
+        with self._manifest_lock:
+            self._manifest.pop(key, None)
+            if etag is not None:
+                self._manifest[key] = etag
+                if len(self._manifest) > self.MANIFEST_SIZE:
+                    self._manifest.popitem(last=False)
+
+    def _get_object(self, Key):
+        """Get an object, in the version written last if it is known."""
+        etag = None
+        if self._consistency_check == "manifest" and self._consistency_stop:
+            with self._manifest_lock:
+                etag = self._manifest.get(Key)
+        if etag is None:
+            return self.s3.get_object(Bucket=self._bucket_name, Key=Key)
+        return tenacity.Retrying(
+            retry=tenacity.retry_if_exception(retry_if_stale),
+            wait=self._consistency_wait,
+            stop=self._consistency_stop,
+            reraise=True)(self.s3.get_object,
+                          Bucket=self._bucket_name, Key=Key, IfMatch=etag)
+
     def _put_object_safe(self, Bucket, Key, Body):
-        put = self.s3.put_object(Bucket=Bucket, Key=Key, Body=Body)
+        if self._consistency_check == "head":
+            put = self.s3.put_object(Bucket=Bucket, Key=Key, Body=Body)
+        else:
+            # NOTE(jd) S3 checks the MD5 and rejects corrupted writes, so
+            # the object does not have to be read again.
+            put = self.s3.put_object(
+                Bucket=Bucket, Key=Key, Body=Body,
+                ContentMD5=base64.b64encode(
+                    hashlib.md5(Body).digest()).decode('ascii'))
+            if self._consistency_check == "manifest":
+                self._set_manifest(Key, put['ETag'])
 
-        if self._consistency_stop:
+        if self._consistency_check == "head" and self._consistency_stop:
 
             def _head():
                 return self.s3.head_object(Bucket=Bucket,
@@ -118,22 +197,39 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
                 wait=self._consistency_wait,
                 stop=self._consistency_stop)(_head)
 
+        return put
+
     def _store_metric_measures(self, metric, key, aggregation,
                                data, offset=0, version=3):
-        self._put_object_safe(
-            Bucket=self._bucket_name,
-            Key=self._prefix(metric) + self._object_name(
-                key, aggregation, version),
-            Body=data)
+        name = self._prefix(metric) + self._object_name(
+            key, aggregation, version)
+        self._pending_writes.add(metric, name, self._executor.submit(
+            self._put_object_safe,
+            Bucket=self._bucket_name, Key=name, Body=data))
+
+    def _wait_for_pending_writes(self, metric, name=None):
+        pending = self._pending_writes.pop(metric, name)
+        for writes in six.itervalues(pending):
+            for future in writes:
+                future.result()
+
+    def _flush_metric_measures(self, metric):
+        self._wait_for_pending_writes(metric)
 
     def _delete_metric_measures(self, metric, key, aggregation,
                                 version=3):
-        self.s3.delete_object(
-            Bucket=self._bucket_name,
-            Key=self._prefix(metric) + self._object_name(
-                key, aggregation, version))
+        name = self._prefix(metric) + self._object_name(
+            key, aggregation, version)
+        self._wait_for_pending_writes(metric, name)
+        self.s3.delete_object(Bucket=self._bucket_name, Key=name)
+        self._set_manifest(name, None)
 
     def _delete_metric(self, metric):
+        self._wait_for_pending_writes(metric)
+        with self._manifest_lock:
+            for key in [k for k in self._manifest
+                        if k.startswith(self._prefix(metric))]:
+                del self._manifest[key]
         bucket = self._bucket_name
         response = {}
         while response.get('IsTruncated', True):
@@ -155,10 +251,28 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
                            [c['Key'] for c in response.get('Contents', ())])
 
     def _get_measures(self, metric, key, aggregation, version=3):
+        # NOTE(jd) The split may have been written during the same pass.
+        self._wait_for_pending_writes(
+            metric, self._prefix(metric) + self._object_name(
+                key, aggregation, version))
+        return self._get_object_measures(metric, key, aggregation, version)
+
+    def _get_measures_batch(self, metric, keys, aggregation, version=3):
+        # NOTE(jd) Wait here rather than in the executor, whose threads may
+        # all be busy waiting for writes that it has not run yet otherwise.
+        for key in keys:
+            self._wait_for_pending_writes(
+                metric, self._prefix(metric) + self._object_name(
+                    key, aggregation, version))
+        return list(self._executor.map(
+            lambda key: self._get_object_measures(
+                metric, key, aggregation, version),
+            keys))
+
+    def _get_object_measures(self, metric, key, aggregation, version=3):
         try:
-            response = self.s3.get_object(
-                Bucket=self._bucket_name,
-                Key=self._prefix(metric) + self._object_name(
+            response = self._get_object(
+                self._prefix(metric) + self._object_name(
                     key, aggregation, version))
         except botocore.exceptions.ClientError as e:
             if e.response['Error'].get('Code') == 'NoSuchKey':
@@ -213,9 +327,8 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
 
     def _get_unaggregated_timeserie(self, metric, version=3):
         try:
-            response = self.s3.get_object(
-                Bucket=self._bucket_name,
-                Key=self._build_unaggregated_timeserie_path(metric, version))
+            response = self._get_object(
+                self._build_unaggregated_timeserie_path(metric, version))
         except botocore.exceptions.ClientError as e:
             if e.response['Error'].get('Code') == "NoSuchKey":
                 raise storage.MetricDoesNotExist(metric)
@@ -223,7 +336,42 @@ class S3Storage(_carbonara.CarbonaraBasedStorage):
         return response['Body'].read()
 
     def _store_unaggregated_timeserie(self, metric, data, version=3):
-        self._put_object_safe(
+        return self._put_object_safe(
             Bucket=self._bucket_name,
             Key=self._build_unaggregated_timeserie_path(metric, version),
+            Body=data)['ETag']
+
+    def _get_unaggregated_timeserie_version(self, metric, version=3):
+        try:
+            response = self.s3.head_object(
+                Bucket=self._bucket_name,
+                Key=self._build_unaggregated_timeserie_path(metric, version))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error'].get('Code') in ("NoSuchKey", "404"):
+                return
+            raise
+        return response['ETag']
+
+    @staticmethod
+    def _build_latest_measures_path(metric, version):
+        return S3Storage._prefix(metric) + 'latest' + ("_v%s" % version
+                                                       if version else "")
+
+    def _store_latest_measures(self, metric, data, version=3):
+        # NOTE(jd) Do not wait for consistency: the latest measures are
+        # rewritten on each processing and a stale read is harmless.
+        self.s3.put_object(
+            Bucket=self._bucket_name,
+            Key=self._build_latest_measures_path(metric, version),
             Body=data)
+
+    def _get_latest_measures(self, metric, version=3):
+        try:
+            response = self.s3.get_object(
+                Bucket=self._bucket_name,
+                Key=self._build_latest_measures_path(metric, version))
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error'].get('Code') == "NoSuchKey":
+                return
+            raise
+        return response['Body'].read()
@@ -14,7 +14,9 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from concurrent import futures
 from oslo_config import cfg
+import six
 
 from gnocchi.common import swift
 from gnocchi import storage
@@ -76,6 +78,12 @@ OPTS = [
                min=0,
                default=300,
                help='Connection timeout in seconds.'),
+    cfg.IntOpt('swift_max_connections',
+               min=1,
+               default=16,
+               help='Maximum number of connections opened to Swift by a '
+                    'process, which is also the number of objects '
+                    'uploaded or downloaded concurrently.'),
 ]
 
 
@@ -85,12 +93,22 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
 
     def __init__(self, conf, coord=None):
         super(SwiftStorage, self).__init__(conf, coord)
-        self.swift = swift.get_connection(conf)
+        self.swift = swift.get_connection_pool(conf)
         self._container_prefix = conf.swift_container_prefix
+        # NOTE(jd) Splits are uploaded in the background and waited for by
+        # `_flush_metric_measures'.
+        self._executor = futures.ThreadPoolExecutor(
+            max_workers=conf.swift_max_connections)
+        self._pending_writes = _carbonara.PendingWrites()
 
     def __str__(self):
         return "%s: %s" % (self.__class__.__name__, self._container_prefix)
 
+    def stop(self):
+        self._executor.shutdown()
+        self.swift.close()
+        super(SwiftStorage, self).stop()
+
     def _container_name(self, metric):
         return '%s.%s' % (self._container_prefix, str(metric.id))
 
@@ -114,17 +132,27 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
 
     def _store_metric_measures(self, metric, key, aggregation,
                                data, offset=None, version=3):
-        self.swift.put_object(
-            self._container_name(metric),
-            self._object_name(key, aggregation, version),
-            data)
+        name = self._object_name(key, aggregation, version)
+        future = self._executor.submit(
+            self.swift.put_object, self._container_name(metric), name, data)
+        self._pending_writes.add(metric, name, future)
+
+    def _wait_for_pending_writes(self, metric, name=None):
+        pending = self._pending_writes.pop(metric, name)
+        for writes in six.itervalues(pending):
+            for future in writes:
+                future.result()
+
+    def _flush_metric_measures(self, metric):
+        self._wait_for_pending_writes(metric)
 
     def _delete_metric_measures(self, metric, key, aggregation, version=3):
-        self.swift.delete_object(
-            self._container_name(metric),
-            self._object_name(key, aggregation, version))
+        name = self._object_name(key, aggregation, version)
+        self._wait_for_pending_writes(metric, name)
+        self.swift.delete_object(self._container_name(metric), name)
 
     def _delete_metric(self, metric):
+        self._wait_for_pending_writes(metric)
         container = self._container_name(metric)
         try:
             headers, files = self.swift.get_container(
@@ -143,14 +171,20 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
                     raise
 
     def _get_measures(self, metric, key, aggregation, version=3):
+        # NOTE(jd) The split may have been written during the same pass.
+        self._wait_for_pending_writes(
+            metric, self._object_name(key, aggregation, version))
+        return self._get_object_measures(metric, key, aggregation, version)
+
+    def _get_object_measures(self, metric, key, aggregation, version=3):
+        container = self._container_name(metric)
+        name = self._object_name(key, aggregation, version)
         try:
-            headers, contents = self.swift.get_object(
-                self._container_name(metric), self._object_name(
-                    key, aggregation, version))
+            headers, contents = self.swift.get_object(container, name)
         except swclient.ClientException as e:
             if e.http_status == 404:
                 try:
-                    self.swift.head_container(self._container_name(metric))
+                    self.swift.head_container(container)
                 except swclient.ClientException as e:
                     if e.http_status == 404:
                         raise storage.MetricDoesNotExist(metric)
@@ -159,6 +193,17 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
             raise
         return contents
 
+    def _get_measures_batch(self, metric, keys, aggregation, version=3):
+        # NOTE(jd) Wait here rather than in the executor, whose threads may
+        # all be busy waiting for writes that it has not run yet otherwise.
+        for key in keys:
+            self._wait_for_pending_writes(
+                metric, self._object_name(key, aggregation, version))
+        return list(self._executor.map(
+            lambda key: self._get_object_measures(
+                metric, key, aggregation, version),
+            keys))
+
     def _list_split_keys(self, metric, aggregation, granularity, version=3):
         container = self._container_name(metric)
         try:
@@ -196,7 +241,40 @@ class SwiftStorage(_carbonara.CarbonaraBasedStorage):
             raise
         return contents
 
+    def _get_unaggregated_timeserie_version(self, metric, version=3):
+        try:
+            headers = self.swift.head_object(
+                self._container_name(metric),
+                self._build_unaggregated_timeserie_path(version))
+        except swclient.ClientException as e:
+            if e.http_status == 404:
+                return
+            raise
+        return headers.get('etag')
+
+    @staticmethod
+    def _build_latest_measures_path(version):
+        return 'latest' + ("_v%s" % version if version else "")
+
+    def _store_latest_measures(self, metric, data, version=3):
+        self.swift.put_object(
+            self._container_name(metric),
+            self._build_latest_measures_path(version),
+            data)
+
+    def _get_latest_measures(self, metric, version=3):
+        try:
+            headers, contents = self.swift.get_object(
+                self._container_name(metric),
+                self._build_latest_measures_path(version))
+        except swclient.ClientException as e:
+            if e.http_status == 404:
+                return
+            raise
+        return contents
+
     def _store_unaggregated_timeserie(self, metric, data, version=3):
-        self.swift.put_object(self._container_name(metric),
-                              self._build_unaggregated_timeserie_path(version),
-                              data)
+        return self.swift.put_object(
+            self._container_name(metric),
+            self._build_unaggregated_timeserie_path(version),
+            data)
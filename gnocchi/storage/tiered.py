@@ -0,0 +1,214 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import daiquiri
+from oslo_config import cfg
+from stevedore import driver
+
+from gnocchi import storage
+from gnocchi.storage import _carbonara
+
+
+OPTS = [
+    cfg.StrOpt('tiered_hot_driver',
+               default='redis',
+               help='Storage driver of the hot tier of the tiered driver. '
+                    'It stores the unaggregated measures and the splits '
+                    'that can still be modified.'),
+    cfg.StrOpt('tiered_cold_driver',
+               default='s3',
+               help='Storage driver of the cold tier of the tiered driver. '
+                    'Splits are moved there by gnocchi-metricd once they '
+                    'cannot be modified anymore.'),
+]
+
+LOG = daiquiri.getLogger(__name__)
+
+
+class TieredStorage(_carbonara.CarbonaraBasedStorage):
+    """Store recent data in a fast driver and old data in a cheap one.
+
+    Everything is written to the hot tier. Splits that cannot be modified
+    anymore are moved to the cold tier by `migrate_metric'. Reads look for a
+    split in the hot tier first, then in the cold tier.
+    """
+
+    def __init__(self, conf, coord=None):
+        super(TieredStorage, self).__init__(conf, coord)
+        self.hot = self._get_tier_driver(conf, conf.tiered_hot_driver)
+        self.cold = self._get_tier_driver(conf, conf.tiered_cold_driver)
+        self.WRITE_FULL = self.hot.WRITE_FULL
+
+    def _get_tier_driver(self, conf, name):
+        if name == "tiered":
+            raise ValueError("A tier of the tiered driver cannot be tiered")
+        return driver.DriverManager("gnocchi.storage", name).driver(
+            conf, self.coord)
+
+    def __str__(self):
+        return "%s: hot %s, cold %s" % (self.__class__.__name__,
+                                        self.hot, self.cold)
+
+    def upgrade(self):
+        self.hot.upgrade()
+        self.cold.upgrade()
+
+    def stop(self):
+        self.hot.stop()
+        self.cold.stop()
+        super(TieredStorage, self).stop()
+
+    def _create_metric(self, metric):
+        self.hot._create_metric(metric)
+
+    def _get_unaggregated_timeserie(self, metric, version=3):
+        return self.hot._get_unaggregated_timeserie(metric, version)
+
+    def _get_unaggregated_timeserie_buffer(self, metric, version=3):
+        return self.hot._get_unaggregated_timeserie_buffer(metric, version)
+
+    def _get_unaggregated_timeserie_version(self, metric, version=3):
+        return self.hot._get_unaggregated_timeserie_version(metric, version)
+
+    def _store_unaggregated_timeserie(self, metric, data, version=3):
+        return self.hot._store_unaggregated_timeserie(metric, data, version)
+
+    def _store_latest_measures(self, metric, data, version=3):
+        self.hot._store_latest_measures(metric, data, version)
+
+    def _get_latest_measures(self, metric, version=3):
+        return self.hot._get_latest_measures(metric, version)
+
+    def _get_latest_measures_batch(self, metrics, version=3):
+        return self.hot._get_latest_measures_batch(metrics, version)
+
+    def _store_metric_measures(self, metric, key, aggregation,
+                               data, offset=None, version=3):
+        self.hot._store_metric_measures(metric, key, aggregation,
+                                        data, offset, version)
+
+    def _flush_metric_measures(self, metric):
+        self.hot._flush_metric_measures(metric)
+
+    def _get_measures(self, metric, key, aggregation, version=3):
+        return self._get_measures_from_tiers(
+            "_get_measures", metric, key, aggregation, version)
+
+    def _get_measures_buffer(self, metric, key, aggregation, version=3):
+        return self._get_measures_from_tiers(
+            "_get_measures_buffer", metric, key, aggregation, version)
+
+    def _get_measures_from_tiers(self, method, metric, key, aggregation,
+                                 version=3):
+        try:
+            return getattr(self.hot, method)(
+                metric, key, aggregation, version)
+        except (storage.MetricDoesNotExist,
+                storage.AggregationDoesNotExist) as e:
+            hot_error = e
+        try:
+            return getattr(self.cold, method)(
+                metric, key, aggregation, version)
+        except storage.MetricDoesNotExist:
+            # NOTE(jd) Nothing has been moved to the cold tier yet, the hot
+            # tier knows better what is missing.
+            raise hot_error
+
+    def _list_split_keys(self, metric, aggregation, granularity, version=3):
+        keys = set()
+        found = False
+        for tier in (self.hot, self.cold):
+            try:
+                keys.update(tier._list_split_keys(
+                    metric, aggregation, granularity, version))
+            except storage.MetricDoesNotExist:
+                pass
+            else:
+                found = True
+        if not found:
+            raise storage.MetricDoesNotExist(metric)
+        return keys
+
+    def _delete_metric_measures(self, metric, key, aggregation, version=3):
+        # NOTE(jd) Drivers do not agree on how to delete a split that does not
+        # exist, so only delete it from the tiers that have it.
+        for tier in (self.hot, self.cold):
+            try:
+                keys = tier._list_split_keys_for_metric(
+                    metric, aggregation, key.sampling, version)
+            except storage.MetricDoesNotExist:
+                continue
+            if key in keys:
+                tier._delete_metric_measures(metric, key, aggregation,
+                                             version)
+
+    def _delete_metric(self, metric):
+        self.hot._delete_metric(metric)
+        self.cold._delete_metric(metric)
+
+    def migrate_metric(self, incoming, metric):
+        """Move the splits of a metric that cannot change to the cold tier.
+
+        :param incoming: The incoming storage
+        :param metric: The metric to migrate
+        :return: The number of splits moved, or None if the metric is locked.
+        """
+        kind, lock = self._get_lock_for_metric(incoming, metric)
+        with self.lock_statistics.acquire(kind, lock,
+                                          blocking=False) as acquired:
+            if not acquired:
+                return
+            moved = 0
+            for aggregation in metric.archive_policy.aggregation_methods:
+                for d in metric.archive_policy.definition:
+                    moved += self._migrate_splits(
+                        metric, aggregation, d.granularity)
+        if moved:
+            LOG.debug("Moved %d splits of metric %s to the cold tier",
+                      moved, metric)
+        return moved
+
+    def _migrate_splits(self, metric, aggregation, granularity):
+        try:
+            keys = self.hot._list_split_keys_for_metric(
+                metric, aggregation, granularity)
+        except storage.MetricDoesNotExist:
+            return 0
+        oldest_immutable_key = self._get_oldest_immutable_split_key(
+            metric, keys)
+        moved = []
+        for key in sorted(keys):
+            if not next(key) <= oldest_immutable_key:
+                break
+            split = self.hot._get_measures_and_unserialize(
+                metric, key, aggregation)
+            if split is None:
+                # NOTE(jd) Corrupted, leave it where it has been noticed.
+                continue
+            if not moved:
+                try:
+                    self.cold._create_metric(metric)
+                except storage.MetricAlreadyExists:
+                    pass
+            offset, data = split.serialize(key, compressed=True)
+            self.cold._store_metric_measures(metric, key, aggregation,
+                                             data, offset=offset)
+            moved.append(key)
+        if moved:
+            # NOTE(jd) Write then delete, so the splits are always readable.
+            self.cold._flush_metric_measures(metric)
+            for key in moved:
+                self.hot._delete_metric_measures(metric, key, aggregation)
+            # NOTE(jd) Some drivers only delete on flush.
+            self.hot._flush_metric_measures(metric)
+        return len(moved)
@@ -14,6 +14,7 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 import functools
+import hashlib
 import json
 import logging
 import os
@@ -71,7 +72,9 @@ class FakeSwiftClient(object):
                 response_dict['status'] = 204
             else:
                 response_dict['status'] = 201
-        self.kvs[container] = {}
+        # NOTE(jd) Like Swift, creating an existing container keeps its
+        # objects.
+        self.kvs.setdefault(container, {})
 
     def get_container(self, container, delimiter=None,
                       path=None, full_listing=False, limit=None):
@@ -121,6 +124,13 @@ class FakeSwiftClient(object):
         except KeyError:
             raise swexc.ClientException("No such container",
                                         http_status=404)
+        return self._etag(obj)
+
+    @staticmethod
+    def _etag(obj):
+        if isinstance(obj, six.text_type):
+            obj = obj.encode('utf-8')
+        return hashlib.md5(obj).hexdigest()
 
     def get_object(self, container, key):
         try:
@@ -129,6 +139,13 @@ class FakeSwiftClient(object):
             raise swexc.ClientException("No such container/object",
                                         http_status=404)
 
+    def head_object(self, container, key):
+        try:
+            return {'etag': self._etag(self.kvs[container][key])}
+        except KeyError:
+            raise swexc.ClientException("No such container/object",
+                                        http_status=404)
+
     def delete_object(self, container, obj):
         try:
             del self.kvs[container][obj]
@@ -175,6 +192,9 @@ class FakeSwiftClient(object):
 
         return {}, None
 
+    def close(self):
+        pass
+
 
 class CaptureOutput(fixtures.Fixture):
     """Optionally capture the output streams.
@@ -333,9 +353,11 @@ class TestCase(BaseTestCase):
     def setUp(self):
         super(TestCase, self).setUp()
         if swexc:
+            # NOTE(jd) Share the same fake backend between all the
+            # connections created by the test, like a real Swift cluster.
             self.useFixture(fixtures.MockPatch(
                 'swiftclient.client.Connection',
-                FakeSwiftClient))
+                return_value=FakeSwiftClient()))
 
         if self.conf.storage.driver == 'file':
             tempdir = self.useFixture(fixtures.TempDir())
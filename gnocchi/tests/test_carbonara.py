@@ -998,6 +998,19 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
                          carbonara.AggregatedTimeSerie.unserialize(
                              s, key, 'mean'))
 
+    def test_unserialize_buffer(self):
+        ts = carbonara.AggregatedTimeSerie.from_data(
+            numpy.timedelta64(60, 's'), 'mean',
+            [datetime64(2014, 1, 1, 12, 0), datetime64(2014, 1, 1, 12, 3)],
+            [3, 5])
+        key = ts.get_split_key()
+        for compressed in (True, False):
+            o, s = ts.serialize(key, compressed=compressed)
+            if o:
+                s = b"\x00" * o + s
+            self.assertEqual(ts, carbonara.AggregatedTimeSerie.unserialize(
+                memoryview(s), key, 'mean'))
+
     def test_no_truncation(self):
         ts = {'sampling': numpy.timedelta64(60, 's'), 'agg': 'mean'}
         tsb = carbonara.BoundTimeSerie()
@@ -1438,3 +1451,95 @@ class TestAggregatedTimeSerie(base.BaseTestCase):
         self.assertEqual(2, len(agg_ts))
         self.assertEqual(5, agg_ts[0][1])
         self.assertEqual(3, agg_ts[1][1])
+
+    @staticmethod
+    def _split_aggregation(timeseries, aggregation, from_timestamp=None,
+                           to_timestamp=None, needed_overlap=100.0,
+                           fill=None):
+        splits = {}
+        for i, ts in enumerate(timeseries):
+            for key, split in ts.split():
+                splits.setdefault(key, []).append((i, split))
+        agg = carbonara.SplitAggregation(
+            aggregation, len(timeseries), from_timestamp, to_timestamp,
+            needed_overlap, fill)
+        # NOTE(jd) Feed the newest split first like the storage does.
+        for key in sorted(splits, reverse=True):
+            agg.add_split(key, splits[key])
+        return list(agg.result())
+
+    def _get_timeseries_for_split_aggregation(self):
+        sampling = numpy.timedelta64(60, 's')
+        start = datetime64(2014, 1, 1)
+        # NOTE(jd) 60s × 3600 points: each split covers 2.5 days, so those
+        # timeseries span three splits with different holes.
+        timestamps = start + numpy.arange(0, 9000, 5) * sampling
+        values = numpy.arange(1800, dtype=float)
+        return [
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', timestamps[:1600], values[:1600] % 7),
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', timestamps[200:], values[200:] * -1),
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', timestamps[::3], values[::3] / 3),
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', timestamps[800:1000], values[800:1000]),
+            # NOTE(jd) Empty between from_timestamp and to_timestamp.
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', timestamps[1700:], values[1700:]),
+        ]
+
+    def _assert_same_aggregation(self, expected, result):
+        self.assertEqual(len(expected), len(result))
+        for (e_ts, e_g, e_v), (r_ts, r_g, r_v) in six.moves.zip(expected,
+                                                                result):
+            self.assertEqual(e_ts, r_ts)
+            self.assertEqual(e_g, r_g)
+            self.assertAlmostEqual(e_v, r_v)
+
+    def test_split_aggregation(self):
+        timeseries = self._get_timeseries_for_split_aggregation()
+        for aggregation in ("mean", "sum", "min", "max", "count", "std"):
+            for fill in (None, 'null', 0, -2.5):
+                if not carbonara.SplitAggregation.supports(aggregation,
+                                                           fill):
+                    continue
+                for from_ts, to_ts in ((None, None),
+                                       (datetime64(2014, 1, 2),
+                                        datetime64(2014, 1, 6, 12))):
+                    # NOTE(jd) The third timeserie has holes everywhere, so
+                    # only a partial overlap is possible without fill.
+                    expected = list(carbonara.AggregatedTimeSerie.aggregated(
+                        timeseries, aggregation, from_ts, to_ts, 0.0, fill))
+                    self.assertNotEqual([], expected)
+                    self._assert_same_aggregation(
+                        expected, self._split_aggregation(
+                            timeseries, aggregation, from_ts, to_ts, 0.0,
+                            fill))
+
+    def test_split_aggregation_no_overlap(self):
+        sampling = numpy.timedelta64(60, 's')
+        timeseries = [
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', [datetime64(2014, 1, 1, 12)], [1]),
+            carbonara.AggregatedTimeSerie.from_data(
+                sampling, 'mean', [datetime64(2014, 1, 10, 12)], [2]),
+        ]
+        self.assertRaises(carbonara.UnAggregableTimeseries,
+                          carbonara.AggregatedTimeSerie.aggregated,
+                          timeseries, 'mean')
+        self.assertRaises(carbonara.UnAggregableTimeseries,
+                          self._split_aggregation, timeseries, 'mean')
+        self._assert_same_aggregation(
+            list(carbonara.AggregatedTimeSerie.aggregated(
+                timeseries, 'mean', fill=0)),
+            self._split_aggregation(timeseries, 'mean', fill=0))
+        self._assert_same_aggregation(
+            list(carbonara.AggregatedTimeSerie.aggregated(
+                timeseries, 'max', needed_percent_of_overlap=0.0)),
+            self._split_aggregation(timeseries, 'max', needed_overlap=0.0))
+
+    def test_split_aggregation_supports(self):
+        self.assertTrue(carbonara.SplitAggregation.supports('mean', 0))
+        self.assertTrue(carbonara.SplitAggregation.supports('std', 'null'))
+        self.assertFalse(carbonara.SplitAggregation.supports('std', 0))
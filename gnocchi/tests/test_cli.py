@@ -0,0 +1,258 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import uuid
+
+import mock
+import monotonic
+import numpy
+from oslo_config import cfg
+import six
+
+from gnocchi import cli
+from gnocchi import opts
+from gnocchi.storage import _carbonara
+from gnocchi.tests import base
+
+
+class TestCase(base.BaseTestCase):
+    def setUp(self):
+        super(TestCase, self).setUp()
+        self.conf = cfg.ConfigOpts()
+        for group, options in opts.list_opts():
+            self.conf.register_opts(
+                list(options), group=None if group == "DEFAULT" else group)
+
+
+class TestSackScheduler(base.BaseTestCase):
+    def setUp(self):
+        super(TestSackScheduler, self).setUp()
+        self.scheduler = cli._SackScheduler(30, 60)
+
+    def test_get_sacks(self):
+        self.scheduler.notify(3)
+        self.scheduler.notify(1)
+        # NOTE(jd) The sacks waiting the longest come first.
+        self.assertEqual(([3, 1, 0, 2], True),
+                         self.scheduler.get_sacks([0, 1, 2, 3]))
+        # NOTE(jd) Only the sacks known to have measures until the next
+        # full pass.
+        self.assertEqual(([3, 1], False),
+                         self.scheduler.get_sacks([0, 1, 2, 3]))
+
+    def test_get_sacks_backlog(self):
+        self.scheduler.get_sacks([0, 1, 2])
+        now = monotonic.monotonic()
+        self.scheduler.processed(0, now, 0)
+        self.scheduler.processed(1, now, 2)
+        self.scheduler.processed(2, now, 5)
+        self.scheduler.delay = 0
+        # NOTE(jd) Then the sacks with the most metrics found.
+        self.assertEqual(([2, 1, 0], True),
+                         self.scheduler.get_sacks([0, 1, 2]))
+        self.scheduler.processed(1, now, 0)
+        self.scheduler.processed(2, now, 0)
+        self.scheduler.notify(0)
+        self.assertEqual(([0, 1, 2], True),
+                         self.scheduler.get_sacks([0, 1, 2]))
+
+    def test_processed(self):
+        self.scheduler.get_sacks([0, 1])
+        self.scheduler.notify(1)
+        started_at = monotonic.monotonic()
+        self.assertGreaterEqual(self.scheduler.processed(1, started_at, 2),
+                                0)
+        self.assertIn(1, self.scheduler.lag)
+        # NOTE(jd) Measures were found, look for more right away.
+        self.assertEqual(0, self.scheduler.get_wait_delay(False))
+        self.assertEqual(([1], False), self.scheduler.get_sacks([0, 1]))
+        self.assertEqual(0, self.scheduler.processed(1, started_at, 0))
+        self.assertNotIn(1, self.scheduler.lag)
+        self.assertEqual(([], False), self.scheduler.get_sacks([0, 1]))
+        self.assertGreater(self.scheduler.get_wait_delay(False), 0)
+        # NOTE(jd) Unknown lag of a sack never seen before.
+        self.assertIsNone(self.scheduler.processed(0, started_at, 1))
+
+    def test_get_wait_delay(self):
+        self.scheduler.get_sacks([0])
+        self.scheduler.delay = 0
+        # NOTE(jd) No measures found, back off up to the maximum delay.
+        for delay in (1, 2, 4, 8, 16, 32, 60, 60):
+            self.scheduler.get_wait_delay(True)
+            self.assertEqual(delay, self.scheduler.delay)
+        self.scheduler.get_sacks([0])
+        self.scheduler.processed(0, monotonic.monotonic(), 1)
+        self.assertEqual(0, self.scheduler.get_wait_delay(True))
+        self.assertEqual(30, self.scheduler.delay)
+
+
+class TestMetricProcessor(TestCase):
+    def setUp(self):
+        super(TestMetricProcessor, self).setUp()
+        self.conf.set_override("metric_processing_min_delay", 30, "metricd")
+        self.processor = cli.MetricProcessor(0, self.conf)
+        self.processor.coord = mock.Mock()
+        self.processor.store = mock.Mock()
+        self.processor.store.lock_statistics.acquire.return_value = (
+            mock.MagicMock())
+        (self.processor.store.lock_statistics.acquire.return_value.
+         __enter__.return_value) = True
+        self.processor.store.lock_statistics.report.return_value = {}
+        self.processor.incoming = mock.Mock()
+        self.processor.incoming.get_draining_group.return_value = (None,
+                                                                   None)
+        self.processor.index = mock.Mock()
+        self.processor._get_tasks = mock.Mock(return_value=[0, 1, 2, 3])
+        self.counts = {}
+        self.processor.store.process_new_measures_for_sack.side_effect = (
+            lambda index, incoming, sack: self.counts.pop(sack, 0))
+
+    def _processed_sacks(self):
+        sacks = [c[0][2] for c in self.processor.store.
+                 process_new_measures_for_sack.call_args_list]
+        self.processor.store.process_new_measures_for_sack.reset_mock()
+        return sacks
+
+    def test_run_job(self):
+        self.counts[2] = 1
+        self.processor._run_job()
+        self.assertTrue(self.processor._full_pass)
+        self.assertEqual(4, len(self._processed_sacks()))
+        self.processor.incoming.get_draining_group.assert_called_once_with()
+        # NOTE(jd) Measures were found, look for more right away.
+        self.assertEqual(0, self.processor._get_wait_delay(0))
+
+        self.counts[2] = 1
+        self.processor._run_job()
+        self.assertFalse(self.processor._full_pass)
+        self.assertEqual([2], self._processed_sacks())
+        self.assertEqual(0, self.processor._get_wait_delay(0))
+        self.assertGreaterEqual(self.processor.scheduler.lag[2], 0)
+
+        self.processor._run_job()
+        self.assertEqual([2], self._processed_sacks())
+        self.assertNotIn(2, self.processor.scheduler.lag)
+        self.assertGreater(self.processor._get_wait_delay(0), 0)
+
+        # NOTE(jd) Until the next full pass, only notified sacks.
+        self.processor._run_job()
+        self.assertEqual([], self._processed_sacks())
+        self.processor.scheduler.notify(3)
+        self.processor._run_job()
+        self.assertEqual([3], self._processed_sacks())
+        self.assertEqual(1, self.processor.incoming.get_draining_group
+                         .call_count)
+
+    def test_run_job_sack_locked(self):
+        (self.processor.store.lock_statistics.acquire.return_value.
+         __enter__.return_value) = False
+        self.counts[2] = 1
+        self.processor._run_job()
+        self.assertEqual([], self._processed_sacks())
+
+    def test_run_job_lag(self):
+        self.processor.scheduler.notify(1)
+        self.processor.scheduler._pending_since[1] -= 120
+        self.counts[1] = 3
+        with mock.patch.object(cli.LOG, 'warning') as warning:
+            self.processor._run_job()
+        warning.assert_called_once_with(
+            mock.ANY, 3, 1, mock.ANY, 60)
+        self.assertGreaterEqual(self.processor.scheduler.lag[1], 120)
+
+
+class TestMetricSplitTasksProcessor(TestCase):
+    def setUp(self):
+        super(TestMetricSplitTasksProcessor, self).setUp()
+        self.queue = six.moves.queue.Queue(1)
+        self.processor = cli.MetricSplitTasksProcessor(0, self.conf,
+                                                       self.queue)
+        self.processor.store = mock.Mock(WRITE_FULL=False)
+        self.processor.index = mock.Mock()
+
+    @staticmethod
+    def _task(metric_id):
+        return _carbonara.SplitTask(_carbonara.SplitTask.COMPACT, metric_id,
+                                    "mean", mock.sentinel.key)
+
+    def test_requeue_when_queue_is_full(self):
+        task = self._task(str(uuid.uuid4()))
+        self.queue.put(self._task(str(uuid.uuid4())))
+        self.processor._requeue(task)
+        # NOTE(jd) The tasks to run again come first.
+        self.assertEqual(task, self.processor._get_batch()[0])
+        self.assertEqual([], self.processor._retry_tasks)
+
+    def test_run_job_sack_locked(self):
+        tasks = [self._task(str(uuid.uuid4())) for i in range(2)]
+        self.processor.incoming = mock.Mock()
+        self.processor.incoming.sack_for_metric.side_effect = [0, 1]
+        self.processor.coord = mock.Mock()
+        lock = self.processor.incoming.get_sack_lock.return_value
+        lock.acquire.side_effect = [False, True]
+        self.processor._shutdown = mock.Mock()
+        self.processor._retry_tasks = list(tasks)
+        self.processor._run_job()
+        # NOTE(jd) The locked sack is not waited for.
+        lock.acquire.assert_called_with(blocking=False)
+        self.processor.store.process_split_tasks.assert_called_once_with(
+            self.processor.index, [tasks[1]])
+        self.assertEqual([tasks[0]], self.processor._retry_tasks)
+        self.processor._shutdown.wait.assert_not_called()
+
+        # NOTE(jd) Nothing can run, wait a bit before retrying.
+        lock.acquire.side_effect = [False]
+        self.processor.incoming.sack_for_metric.side_effect = [0]
+        self.processor._run_job()
+        self.assertEqual([tasks[0]], self.processor._retry_tasks)
+        self.processor._shutdown.wait.assert_called_once_with(1)
+
+    def test_rescan_uncompressed_splits(self):
+        metrics = [mock.Mock(id=uuid.uuid4()) for i in range(2)]
+        task = self._task(str(metrics[0].id))
+        self.processor.index.list_metrics.side_effect = [metrics, []]
+        self.processor.store.find_uncompressed_splits.side_effect = [
+            [task], []]
+
+        self.processor._rescan_uncompressed_splits()
+        started = self.processor._rescan_started
+        self.assertEqual([task], self.processor._get_batch())
+        self.processor._rescan_uncompressed_splits()
+        self.assertEqual(2, self.processor.index.list_metrics.call_count)
+        self.assertEqual(
+            str(metrics[-1].id),
+            self.processor.index.list_metrics.call_args_list[1][1]['marker'])
+
+        self.processor.store.find_uncompressed_splits.assert_called_with(
+            metrics[-1], None)
+
+        # NOTE(jd) All the metrics have been seen, wait for the next rescan.
+        self.processor._rescan_uncompressed_splits()
+        self.assertEqual(2, self.processor.index.list_metrics.call_count)
+
+        # NOTE(jd) The next rescan only looks at the recent splits.
+        self.processor._rescan_timer = None
+        self.processor.index.list_metrics.side_effect = [metrics[:1]]
+        self.processor.store.find_uncompressed_splits.side_effect = [[]]
+        self.processor._rescan_uncompressed_splits()
+        self.processor.store.find_uncompressed_splits.assert_called_with(
+            metrics[0], self.processor._rescan_since)
+        self.assertEqual(
+            self.processor._rescan_since,
+            started - numpy.timedelta64(
+                self.conf.metricd.split_tasks_rescan_delay, 's'))
+
+    def test_rescan_write_full(self):
+        self.processor.store.WRITE_FULL = True
+        self.processor._rescan_uncompressed_splits()
+        self.processor.index.list_metrics.assert_not_called()
@@ -0,0 +1,81 @@
+# -*- encoding: utf-8 -*-
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+import datetime
+import uuid
+
+import mock
+import numpy
+
+from gnocchi import incoming
+from gnocchi import storage
+from gnocchi.tests import base
+
+
+def datetime64(*args):
+    return numpy.datetime64(datetime.datetime(*args))
+
+
+class TestGroupCommitIncoming(base.BaseTestCase):
+    def setUp(self):
+        super(TestGroupCommitIncoming, self).setUp()
+        self.driver = mock.Mock()
+        self.metric = mock.Mock(id=uuid.uuid4())
+        self.metric2 = mock.Mock(id=uuid.uuid4())
+
+    def test_group_commit(self):
+        buffered = incoming.GroupCommitIncoming(
+            self.driver, 60, 10000, wait=False)
+        buffered.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        buffered.add_measures_batch({
+            self.metric: [
+                storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42)],
+            self.metric2: [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 4)],
+        })
+        self.driver.add_measures_batch.assert_not_called()
+        buffered.stop()
+        self.driver.add_measures_batch.assert_called_once_with({
+            self.metric: [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+                storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42)],
+            self.metric2: [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 4)],
+        })
+        # NOTE(jd) Once stopped, measures are written right away.
+        buffered.add_measures(self.metric2, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 8),
+        ])
+        self.assertEqual(2, self.driver.add_measures_batch.call_count)
+
+    def test_group_commit_wait(self):
+        buffered = incoming.GroupCommitIncoming(self.driver, 60, 2)
+        self.addCleanup(buffered.stop)
+        measures = [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ]
+        # NOTE(jd) Enough measures to be written without waiting the delay.
+        buffered.add_measures(self.metric, measures)
+        self.driver.add_measures_batch.assert_called_once_with(
+            {self.metric: measures})
+        self.driver.add_measures_batch.side_effect = IOError("disk full")
+        self.assertRaises(IOError, buffered.add_measures, self.metric,
+                          measures)
+
+    def test_group_commit_proxy(self):
+        buffered = incoming.GroupCommitIncoming(self.driver, 60, 2)
+        self.assertEqual(self.driver.has_unprocessed,
+                         buffered.has_unprocessed)
@@ -13,16 +13,28 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import collections
 import datetime
+import functools
+import os
+import threading
+import time
 import uuid
 
+import fixtures
 import mock
 import numpy
 import six.moves
 
 from gnocchi import archive_policy
 from gnocchi import carbonara
+from gnocchi import cli
+from gnocchi.common import file as common_file
+from gnocchi import incoming
 from gnocchi import indexer
+from gnocchi.incoming import file as incoming_file
+from gnocchi.incoming import filelog as incoming_filelog
+from gnocchi.incoming import redis as incoming_redis
 from gnocchi import storage
 from gnocchi.storage import _carbonara
 from gnocchi.storage import ceph
@@ -30,6 +42,7 @@ from gnocchi.storage import file
 from gnocchi.storage import redis
 from gnocchi.storage import s3
 from gnocchi.storage import swift
+from gnocchi.storage import tiered
 from gnocchi.tests import base as tests_base
 from gnocchi.tests import utils as tests_utils
 from gnocchi import utils
@@ -39,6 +52,24 @@ def datetime64(*args):
     return numpy.datetime64(datetime.datetime(*args))
 
 
+class BufferedFileStorage(file.FileStorage):
+    """A file driver deleting splits on flush only, like Redis."""
+
+    def __init__(self, conf, coord=None):
+        super(BufferedFileStorage, self).__init__(conf, coord)
+        self.pending_deletes = collections.defaultdict(list)
+
+    def _delete_metric_measures(self, metric, key, aggregation, version=3):
+        self.pending_deletes[metric.id].append((key, aggregation, version))
+
+    def _flush_metric_measures(self, metric):
+        for key, aggregation, version in self.pending_deletes.pop(metric.id,
+                                                                  []):
+            super(BufferedFileStorage, self)._delete_metric_measures(
+                metric, key, aggregation, version)
+        super(BufferedFileStorage, self)._flush_metric_measures(metric)
+
+
 class TestStorageDriver(tests_base.TestCase):
     def setUp(self):
         super(TestStorageDriver, self).setUp()
@@ -210,6 +241,205 @@ class TestStorageDriver(tests_base.TestCase):
         self.assertEqual(2, report['summary']['metrics'])
         self.assertEqual(120, report['summary']['measures'])
 
+    def test_measures_reporting_after_processing(self):
+        m2, __ = self._create_metric('medium')
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.incoming.add_measures(m2, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing([str(self.metric.id)])
+        report = self.incoming.measures_report(False)
+        self.assertEqual({'metrics': 1, 'measures': 1}, report['summary'])
+        self.incoming.delete_unprocessed_measures_for_metric_id(m2.id)
+        report = self.incoming.measures_report(False)
+        self.assertEqual({'metrics': 0, 'measures': 0}, report['summary'])
+
+        if not isinstance(self.incoming, incoming_redis.RedisStorage):
+            return
+        self.incoming.add_measures(m2, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        # NOTE(jd) Drop the counters like an incoming created before them.
+        self.incoming._client.delete(self.incoming._counters_key())
+        self.incoming.upgrade(128)
+        report = self.incoming.measures_report(False)
+        self.assertEqual({'metrics': 1, 'measures': 1}, report['summary'])
+
+    def test_change_sack_size_online(self):
+        deleted, __ = self._create_metric()
+        for m in (self.metric, deleted):
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            ])
+        self.index.delete_metric(deleted.id)
+
+        self.incoming.set_storage_settings(16, 128)
+        self.assertEqual(16, self.incoming.NUM_SACKS)
+        draining, since = self.incoming.get_draining_group()
+        self.assertEqual(128, draining.NUM_SACKS)
+        self.assertEqual((None, None), draining.get_draining_group())
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.assertEqual({'metrics': 3, 'measures': 3},
+                         self.incoming.measures_report(False)['summary'])
+
+        processor = cli.MetricProcessor(0, self.conf)
+        processor.coord = self.storage.coord
+        processor.store = self.storage
+        processor.incoming = self.incoming
+        processor.index = self.index
+        self.assertEqual(2, processor._drain_sacks())
+        self.assertEqual({'metrics': 0, 'measures': 0},
+                         draining.measures_report(False)['summary'])
+        self.assertEqual({'metrics': 1, 'measures': 2},
+                         self.incoming.measures_report(False)['summary'])
+        # NOTE(jd) Processes may still write to the previous sacks for a
+        # while.
+        self.assertEqual(0, processor._drain_sacks())
+        self.assertIsNotNone(self.incoming.get_draining_group()[0])
+        with mock.patch.object(incoming.IncomingDriver,
+                               'SACKS_REFRESH_DELAY', 0):
+            self.assertEqual(0, processor._drain_sacks())
+        self.assertEqual((None, None), self.incoming.get_draining_group())
+        self.assertEqual(16, int(self.incoming.get_storage_sacks()))
+
+        self.trigger_processing()
+        self.assertEqual([
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 42),
+        ], self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(5, 'm')))
+
+    def test_change_sack_size_online_lock(self):
+        # NOTE(jd) A process that still uses the previous sacks.
+        stale = incoming.get_driver(self.conf)
+        self.assertEqual(128, stale.NUM_SACKS)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.incoming.set_storage_settings(16, 128)
+
+        processor = cli.MetricProcessor(0, self.conf)
+        processor.coord = self.storage.coord
+        processor.store = self.storage
+        processor.incoming = self.incoming
+        processor.index = self.index
+        other_coord = utils.get_coordinator_and_start(
+            self.conf.storage.coordination_url)
+        self.addCleanup(other_coord.stop)
+        lock = stale.get_sack_lock(other_coord,
+                                   stale.sack_for_metric(self.metric.id))
+        self.assertTrue(lock.acquire())
+        try:
+            self.assertEqual(0, processor._drain_sacks())
+        finally:
+            lock.release()
+        self.assertEqual(1, processor._drain_sacks())
+
+    def test_redis_incoming_sack_index(self):
+        if not isinstance(self.incoming, incoming_redis.RedisStorage):
+            self.skipTest("Only the redis incoming driver indexes sacks")
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        sack = self.incoming.sack_for_metric(self.metric.id)
+        index_key = self.incoming._sack_index_key(sack)
+        self.assertEqual({str(self.metric.id).encode()},
+                         self.incoming._client.smembers(index_key))
+
+        # NOTE(jd) Drop the index like an incoming created before it.
+        self.incoming._client.delete(index_key)
+        self.incoming._client.hdel(self.incoming.CFG_PREFIX,
+                                   self.incoming.CFG_SACK_INDEX)
+        self.assertEqual(
+            set(), self.incoming.list_metric_with_measures_to_process(sack))
+        self.incoming.upgrade(128)
+        self.assertEqual(
+            {str(self.metric.id)},
+            self.incoming.list_metric_with_measures_to_process(sack))
+
+        self.trigger_processing()
+        self.assertEqual(0, self.incoming._client.exists(index_key))
+
+    def test_redis_incoming_notifications(self):
+        if not isinstance(self.incoming, incoming_redis.RedisStorage):
+            self.skipTest("Only the redis incoming driver notifies sacks")
+        pubsub = self.incoming._client.pubsub(ignore_subscribe_messages=True)
+        self.addCleanup(pubsub.close)
+        pubsub.subscribe(self.incoming._notifications_channel())
+
+        def get_sacks():
+            sacks = []
+            for i in six.moves.range(50):
+                message = pubsub.get_message()
+                if message is None:
+                    if sacks:
+                        break
+                    time.sleep(0.01)
+                else:
+                    sacks.append(int(message['data']))
+            return sacks
+
+        sack = self.incoming.sack_for_metric(self.metric.id)
+        for i in six.moves.range(2):
+            self.incoming.add_measures(self.metric, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, i), 69),
+            ])
+        # NOTE(jd) Only the first measures of a metric are notified.
+        self.assertEqual([sack], get_sacks())
+        with self.incoming.process_measure_for_metric(self.metric):
+            self.incoming.add_measures(self.metric, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 3), 69),
+            ])
+        # NOTE(jd) Measures added while processing are notified again.
+        self.assertEqual([sack], get_sacks())
+
+    def test_redis_incoming_notifications_sacks_changed(self):
+        if not isinstance(self.incoming, incoming_redis.RedisStorage):
+            self.skipTest("Only the redis incoming driver notifies sacks")
+        self.incoming.SACKS_REFRESH_DELAY = 0.1
+        notified = six.moves.queue.Queue()
+
+        def listen():
+            sacks = self.incoming.iter_on_sacks_to_process()
+            for sack in sacks:
+                notified.put(sack)
+                if notified.qsize() == 2:
+                    break
+            sacks.close()
+
+        listener = threading.Thread(target=listen)
+        listener.daemon = True
+        listener.start()
+        self.addCleanup(listener.join, 10)
+
+        # NOTE(jd) Wait for the listener to be subscribed. Only the first
+        # measures of a metric are notified, so use a new one each time.
+        for i in six.moves.range(100):
+            m, __ = self._create_metric()
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            ])
+            try:
+                self.assertEqual(self.incoming.sack_for_metric(m.id),
+                                 notified.get(timeout=0.1))
+            except six.moves.queue.Empty:
+                pass
+            else:
+                break
+        num_sacks = self.incoming.NUM_SACKS
+        self.incoming.set_storage_settings(num_sacks * 2, num_sacks)
+        m2, __ = self._create_metric()
+        self.incoming.add_measures(m2, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.assertEqual(self.incoming.sack_for_metric(m2.id),
+                         notified.get(timeout=10))
+
     def test_add_measures_big(self):
         m, __ = self._create_metric('high')
         self.incoming.add_measures(m, [
@@ -245,6 +475,83 @@ class TestStorageDriver(tests_base.TestCase):
                 count += 1
         self.assertEqual(1, count)
 
+    def test_add_measures_flush_metric_measures(self):
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        calls = []
+        flush = self.storage._flush_metric_measures
+        store_unaggregated = self.storage._store_unaggregated_timeserie
+
+        def _flush(*args):
+            calls.append("flush")
+            return flush(*args)
+
+        def _store_unaggregated(*args):
+            calls.append("store")
+            return store_unaggregated(*args)
+
+        with mock.patch.object(self.storage, '_flush_metric_measures',
+                               side_effect=_flush), \
+            mock.patch.object(self.storage, '_store_unaggregated_timeserie',
+                              side_effect=_store_unaggregated):
+            self.trigger_processing()
+        # NOTE(jd) The splits must be stored before the unaggregated
+        # timeserie tells that they have been computed.
+        self.assertEqual(["flush", "store"], calls)
+        self.assertEqual([
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 42.0),
+        ], self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(5, 'm')))
+
+    def test_unserialize_incoming_measures(self):
+        first = self.incoming._encode_measures([
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69)])
+        second = self.incoming._encode_measures([
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime64(2014, 1, 1, 12, 9, 31), 4)])
+        measures = self.incoming._unserialize_measures(
+            [("first", first), ("empty", b""), ("second", second)])
+        self.assertEqual(
+            [datetime64(2014, 1, 1, 12, 0, 1),
+             datetime64(2014, 1, 1, 12, 7, 31),
+             datetime64(2014, 1, 1, 12, 9, 31)],
+            list(measures['timestamps']))
+        self.assertEqual([69, 42, 4], list(measures['values']))
+        self.assertEqual(0, len(self.incoming._unserialize_measures([])))
+        self.assertRaises(ValueError, self.incoming._unserialize_measures,
+                          [("first", first), ("corrupted", second[:-1])])
+
+    def test_process_new_measures_for_sack(self):
+        metric, __ = self._create_metric()
+        deleted, __ = self._create_metric()
+        for m in (self.metric, metric, deleted):
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+                storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+            ])
+        self.index.delete_metric(deleted.id)
+
+        sacks = set(self.incoming.sack_for_metric(m.id)
+                    for m in (self.metric, metric, deleted))
+        self.assertEqual(3, sum(
+            self.storage.process_new_measures_for_sack(
+                self.index, self.incoming, sack, sync=True)
+            for sack in sacks))
+
+        for m in (self.metric, metric):
+            self.assertFalse(self.incoming.has_unprocessed(m))
+            self.assertEqual([
+                (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+                (datetime64(2014, 1, 1, 12, 5),
+                 numpy.timedelta64(5, 'm'), 42.0),
+            ], self.storage.get_measures(
+                m, granularity=numpy.timedelta64(5, 'm')))
+        # NOTE(jd) The janitor deletes the measures of deleted metrics.
+        self.assertTrue(self.incoming.has_unprocessed(deleted))
+
     def test_add_measures_update_subset(self):
         m, m_sql = self._create_metric('medium')
         measures = [
@@ -311,6 +618,161 @@ class TestStorageDriver(tests_base.TestCase):
         }, self.storage._list_split_keys_for_metric(
             self.metric, "mean", numpy.timedelta64(5, 'm')))
 
+    def test_refresh_metric_locking(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        other_coord = utils.get_coordinator_and_start(
+            self.conf.storage.coordination_url)
+        self.addCleanup(other_coord.stop)
+        sack_lock = self.incoming.get_sack_lock(
+            other_coord, self.incoming.sack_for_metric(self.metric.id))
+        self.assertTrue(sack_lock.acquire())
+        try:
+            self.assertRaises(storage.SackLockTimeoutError,
+                              self.storage.refresh_metric, self.index,
+                              self.incoming, self.metric, False)
+            self.storage.metric_locking = True
+            self.storage.refresh_metric(self.index, self.incoming,
+                                        self.metric, False)
+        finally:
+            sack_lock.release()
+        self.assertEqual(1, len(self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(1, 'D'))))
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 2, 12, 0, 1), 42),
+        ])
+        metric_lock = other_coord.get_lock(
+            b"gnocchi-metric-%s-lock" % str(self.metric.id).encode('ascii'))
+        self.assertTrue(metric_lock.acquire())
+        try:
+            self.assertRaises(storage.SackLockTimeoutError,
+                              self.storage.refresh_metric, self.index,
+                              self.incoming, self.metric, False)
+            # A locked metric is skipped by metricd
+            self.trigger_processing()
+            self.assertEqual(1, len(self.storage.get_measures(
+                self.metric, granularity=numpy.timedelta64(1, 'D'))))
+        finally:
+            metric_lock.release()
+        self.trigger_processing()
+        self.assertEqual(2, len(self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(1, 'D'))))
+
+        stats = self.storage.lock_statistics.report()
+        self.assertEqual(1, stats["sack"]["busy"])
+        self.assertEqual(2, stats["metric"]["busy"])
+        self.assertEqual(2, stats["metric"]["acquired"])
+
+    def test_delete_old_measures_deferred(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+
+        self.storage.split_tasks = six.moves.queue.Queue()
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing()
+        self.assertTrue(self.storage.split_tasks.empty())
+
+        # One year later…
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2015, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing()
+
+        tasks = []
+        while not self.storage.split_tasks.empty():
+            tasks.append(self.storage.split_tasks.get())
+        # NOTE(jd) std is not computed with only one point, so there is
+        # nothing to do for it
+        self.assertEqual(
+            {(_carbonara.SplitTask.DELETE, str(self.metric.id), agg,
+              granularity)
+             for agg in self.metric.archive_policy.aggregation_methods
+             if agg != "std"
+             for granularity in (300.0, 3600.0)},
+            {(t.action, t.metric_id, t.aggregation,
+              utils.timespan_total_seconds(t.key.sampling))
+             for t in tasks})
+        # Nothing has been deleted yet
+        self.assertEqual(2, len(self.storage._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(5, 'm'))))
+
+        # Tasks queued twice are only run once
+        self.storage.process_split_tasks(self.index, tasks + tasks, sync=True)
+        self.assertEqual({
+            carbonara.SplitKey(numpy.datetime64(1419120000, 's'),
+                               numpy.timedelta64(5, 'm')),
+        }, self.storage._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(5, 'm')))
+
+        # Tasks of deleted metrics are ignored
+        self.index.delete_metric(self.metric.id)
+        self.storage.process_split_tasks(self.index, tasks, sync=True)
+
+    def test_find_uncompressed_splits(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)],
+                                          ["mean"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 2, 13, 7, 31), 42),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+        if self.storage.WRITE_FULL:
+            self.assertEqual(
+                [], self.storage.find_uncompressed_splits(self.metric))
+            self.storage.WRITE_FULL = False
+            self.addCleanup(delattr, self.storage, "WRITE_FULL")
+        self.assertEqual(
+            [], self.storage.find_uncompressed_splits(self.metric))
+
+        # NOTE(jd) Leave a split that cannot change anymore uncompressed,
+        # as if its compaction task had been lost.
+        key = carbonara.SplitKey(numpy.datetime64(1451736000, 's'),
+                                 numpy.timedelta64(1, 'm'))
+        split = self.storage._get_measures_and_unserialize(
+            self.metric, key, "mean")
+        offset, data = split.serialize(key, compressed=False)
+        self.storage._store_metric_measures(self.metric, key, "mean",
+                                            b"\0" * offset + data)
+        self.storage._flush_metric_measures(self.metric)
+        with mock.patch.object(self.storage, '_get_measures_header',
+                               wraps=self.storage._get_measures_header) as h:
+            tasks = self.storage.find_uncompressed_splits(self.metric)
+        self.assertEqual([_carbonara.SplitTask(
+            _carbonara.SplitTask.COMPACT, str(self.metric.id), "mean", key)],
+            tasks)
+        # NOTE(jd) Only the first byte of the splits is read.
+        self.assertTrue(h.called)
+        for call in h.call_args_list:
+            self.assertEqual(1, call[0][3])
+        self.assertEqual(tasks, self.storage.find_uncompressed_splits(
+            self.metric, since=key.key))
+        self.assertEqual([], self.storage.find_uncompressed_splits(
+            self.metric, since=next(key).key))
+
+        self.storage.process_split_tasks(self.index, tasks, sync=True)
+        self.assertEqual(
+            [], self.storage.find_uncompressed_splits(self.metric))
+        self.assertEqual([
+            (datetime64(2016, 1, 1, 12), numpy.timedelta64(1, 'm'), 69),
+            (datetime64(2016, 1, 2, 13, 7), numpy.timedelta64(1, 'm'), 42),
+            (datetime64(2016, 1, 6, 15, 12), numpy.timedelta64(1, 'm'), 44),
+        ], self.storage.get_measures(self.metric))
+
     def test_rewrite_measures(self):
         # Create an archive policy that spans on several splits. Each split
         # being 3600 points, let's go for 36k points so we have 10 splits.
@@ -431,6 +893,137 @@ class TestStorageDriver(tests_base.TestCase):
         ], self.storage.get_measures(self.metric,
                                      granularity=numpy.timedelta64(1, 'm')))
 
+    def test_split_cache(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 2, 13, 7, 31), 42),
+            storage.Measure(datetime64(2016, 1, 4, 14, 9, 31), 4),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+
+        self.conf.set_override('split_cache_size', 1, 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'split_cache_size', 'storage')
+        driver = storage.get_driver(self.conf)
+        self.addCleanup(driver.stop)
+        expected = self.storage.get_measures(self.metric)
+
+        self.assertEqual(expected, driver.get_measures(self.metric))
+        # The last split may still change, it must not be cached
+        self.assertEqual(2, len(driver.split_cache))
+        self.assertEqual(0, driver.split_cache.stats()['hits'])
+        self.assertEqual(2, driver.split_cache.stats()['misses'])
+
+        self.assertEqual(expected, driver.get_measures(self.metric))
+        self.assertEqual(2, driver.split_cache.stats()['hits'])
+        self.assertEqual(2, driver.split_cache.stats()['misses'])
+
+        driver.delete_metric(self.incoming, self.metric, sync=True)
+        self.assertEqual(0, len(driver.split_cache))
+        self.assertEqual(0, driver.split_cache.size)
+
+    def test_split_cache_rate_back_window(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60),
+                                                      (1000, 3600)],
+                                          ["mean", "rate:mean"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        # NOTE(jd) A 60s split has just started.
+        split_start = next(carbonara.SplitKey.from_timestamp_and_sampling(
+            datetime64(2016, 1, 5), numpy.timedelta64(1, 'm'))).key
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(split_start - numpy.timedelta64(2, 'h'), 69),
+            storage.Measure(split_start + numpy.timedelta64(1, 'm'), 42),
+        ])
+        self.trigger_processing()
+
+        self.conf.set_override('split_cache_size', 1, 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'split_cache_size', 'storage')
+        driver = storage.get_driver(self.conf)
+        self.addCleanup(driver.stop)
+        granularity = numpy.timedelta64(1, 'm')
+        self.assertEqual(
+            self.storage.get_measures(self.metric, granularity=granularity),
+            driver.get_measures(self.metric, granularity=granularity))
+
+        # NOTE(jd) The back window of the policy keeps one more block for
+        # rate:mean, so the previous split still accepts measures, for every
+        # aggregation method.
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(split_start - numpy.timedelta64(30, 'm'), 4),
+        ])
+        self.trigger_processing()
+        expected = self.storage.get_measures(self.metric,
+                                             granularity=granularity)
+        self.assertEqual(3, len(expected))
+        self.assertEqual(
+            expected,
+            driver.get_measures(self.metric, granularity=granularity))
+
+    def test_unaggregated_timeserie_cache(self):
+        if not isinstance(self.storage, _carbonara.CarbonaraBasedStorage):
+            self.skipTest("This driver is not based on Carbonara")
+
+        self.storage.unaggregated_timeserie_cache_size = 10
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing()
+        if not self.storage._unaggregated_timeserie_cache:
+            self.skipTest("This driver does not version unaggregated "
+                          "timeseries")
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        with mock.patch.object(self.storage, '_get_unaggregated_timeserie',
+                               side_effect=AssertionError) as get:
+            self.trigger_processing()
+        self.assertFalse(get.called)
+
+        # Another worker rewrites the timeserie, the cache must be ignored
+        other = storage.get_driver(self.conf)
+        self.addCleanup(other.stop)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 9, 31), 4),
+        ])
+        other.process_background_tasks(
+            self.index, self.incoming, [str(self.metric.id)], sync=True)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 12, 45), 44),
+        ])
+        with mock.patch.object(
+                self.storage, '_get_unaggregated_timeserie',
+                wraps=self.storage._get_unaggregated_timeserie) as get:
+            self.trigger_processing()
+        self.assertTrue(get.called)
+
+        self.assertEqual([
+            (datetime64(2014, 1, 1), numpy.timedelta64(1, 'D'), 39.75),
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(1, 'h'), 39.75),
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69.0),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 23.0),
+            (datetime64(2014, 1, 1, 12, 10), numpy.timedelta64(5, 'm'), 44.0),
+        ], self.storage.get_measures(self.metric))
+
     def test_rewrite_measures_oldest_mutable_timestamp_eq_next_key(self):
         """See LP#1655422"""
         # Create an archive policy that spans on several splits. Each split
@@ -718,6 +1311,564 @@ class TestStorageDriver(tests_base.TestCase):
         ])
         self.trigger_processing()
 
+    def test_tiered_storage(self):
+        if tests_base.swexc is None:
+            self.skipTest("Swift is not installed")
+        self.conf.set_override('tiered_hot_driver', 'file', 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'tiered_hot_driver', 'storage')
+        self.conf.set_override('tiered_cold_driver', 'swift', 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'tiered_cold_driver', 'storage')
+        self.conf.set_override('file_basepath',
+                               self.useFixture(fixtures.TempDir()).path,
+                               'storage')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'storage')
+        self.storage = tiered.TieredStorage(self.conf.storage,
+                                            self.storage.coord)
+        self.storage.upgrade()
+
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)],
+                                          ["mean", "max"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 2, 13, 7, 31), 42),
+            storage.Measure(datetime64(2016, 1, 4, 14, 9, 31), 4),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+        expected = [
+            (datetime64(2016, 1, 1, 12), numpy.timedelta64(1, 'm'), 69),
+            (datetime64(2016, 1, 2, 13, 7), numpy.timedelta64(1, 'm'), 42),
+            (datetime64(2016, 1, 4, 14, 9), numpy.timedelta64(1, 'm'), 4),
+            (datetime64(2016, 1, 6, 15, 12), numpy.timedelta64(1, 'm'), 44),
+        ]
+        self.assertEqual(expected, self.storage.get_measures(self.metric))
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage.cold._list_split_keys_for_metric,
+                          self.metric, "mean", numpy.timedelta64(1, 'm'))
+
+        # Only the last split can still be modified
+        self.assertEqual(4, self.storage.migrate_metric(self.incoming,
+                                                        self.metric))
+        self.assertEqual(0, self.storage.migrate_metric(self.incoming,
+                                                        self.metric))
+        self.assertEqual({
+            carbonara.SplitKey(numpy.datetime64(1451520000, 's'),
+                               numpy.timedelta64(1, 'm')),
+            carbonara.SplitKey(numpy.datetime64(1451736000, 's'),
+                               numpy.timedelta64(1, 'm')),
+        }, self.storage.cold._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+        self.assertEqual({
+            carbonara.SplitKey(numpy.datetime64(1451952000, 's'),
+                               numpy.timedelta64(1, 'm')),
+        }, self.storage.hot._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+        self.assertEqual(expected, self.storage.get_measures(self.metric))
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 10, 16, 18, 45), 45),
+        ])
+        self.trigger_processing()
+        self.assertEqual(expected + [
+            (datetime64(2016, 1, 10, 16, 18), numpy.timedelta64(1, 'm'), 45),
+        ], self.storage.get_measures(self.metric))
+        self.assertEqual(2, self.storage.migrate_metric(self.incoming,
+                                                        self.metric))
+        self.assertEqual(3, len(self.storage.cold._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm'))))
+
+        self.storage.delete_metric(self.incoming, self.metric, sync=True)
+        self.assertEqual([], self.storage.get_measures(self.metric))
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage.cold._list_split_keys_for_metric,
+                          self.metric, "mean", numpy.timedelta64(1, 'm'))
+
+    def test_s3_consistency_check(self):
+        if not isinstance(self.storage, s3.S3Storage):
+            self.skipTest("Only the S3 driver checks consistency")
+        key = carbonara.SplitKey(numpy.datetime64(1451520000, 's'),
+                                 numpy.timedelta64(1, 'm'))
+        name = self.storage._prefix(self.metric) + self.storage._object_name(
+            key, "mean")
+        client = self.storage.s3
+        for mode in ("head", "etag", "manifest"):
+            self.storage._consistency_check = mode
+            data = b"split-" + mode.encode()
+            with mock.patch.object(client, "put_object",
+                                   wraps=client.put_object) as put, \
+                    mock.patch.object(client, "head_object",
+                                      wraps=client.head_object) as head, \
+                    mock.patch.object(client, "get_object",
+                                      wraps=client.get_object) as get:
+                self.storage._store_metric_measures(self.metric, key, "mean",
+                                                    data)
+                self.storage._flush_metric_measures(self.metric)
+                self.assertEqual(data, self.storage._get_measures(
+                    self.metric, key, "mean"))
+            self.assertEqual(mode != "head",
+                             "ContentMD5" in put.call_args[1])
+            self.assertEqual(mode == "head", head.called)
+            if mode == "manifest":
+                self.assertEqual(self.storage._manifest[name],
+                                 get.call_args[1]["IfMatch"])
+            else:
+                self.assertNotIn("IfMatch", get.call_args[1])
+
+        # NOTE(jd) The manifest only knows the writes of this process.
+        other = s3.S3Storage(self.conf.storage, self.storage.coord)
+        self.addCleanup(other.stop)
+        other._consistency_check = "manifest"
+        with mock.patch.object(other.s3, "get_object",
+                               wraps=other.s3.get_object) as get:
+            self.assertEqual(b"split-manifest", other._get_measures(
+                self.metric, key, "mean"))
+        self.assertNotIn("IfMatch", get.call_args[1])
+
+    def test_tiered_storage_flushes_hot_tier(self):
+        if tests_base.swexc is None:
+            self.skipTest("Swift is not installed")
+        self.conf.set_override('tiered_hot_driver', 'file', 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'tiered_hot_driver', 'storage')
+        self.conf.set_override('tiered_cold_driver', 'swift', 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'tiered_cold_driver', 'storage')
+        self.conf.set_override('file_basepath',
+                               self.useFixture(fixtures.TempDir()).path,
+                               'storage')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'storage')
+        self.storage = tiered.TieredStorage(self.conf.storage,
+                                            self.storage.coord)
+        self.storage.hot = BufferedFileStorage(self.conf.storage,
+                                               self.storage.coord)
+        self.storage.upgrade()
+
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)], ["mean"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+
+        self.assertEqual(1, self.storage.migrate_metric(self.incoming,
+                                                        self.metric))
+        self.assertEqual({}, dict(self.storage.hot.pending_deletes))
+        self.assertEqual({
+            carbonara.SplitKey(numpy.datetime64(1451952000, 's'),
+                               numpy.timedelta64(1, 'm')),
+        }, self.storage.hot._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+
+    def test_file_segment_layout(self):
+        self.conf.set_override('file_layout', 'segment', 'storage')
+        self.addCleanup(self.conf.clear_override, 'file_layout', 'storage')
+        self.conf.set_override('file_basepath',
+                               self.useFixture(fixtures.TempDir()).path,
+                               'storage')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'storage')
+        self.storage = file.FileStorage(self.conf.storage,
+                                        self.storage.coord)
+        self.storage.SEGMENT_COMPACTION_MIN_SIZE = 0
+
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)],
+                                          ["mean"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 2, 13, 7, 31), 42),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+        segment = self.storage._build_segment_path(
+            self.metric, "mean", numpy.timedelta64(1, 'm'))
+        self.assertEqual(
+            [os.path.basename(segment)],
+            os.listdir(self.storage._build_metric_path(self.metric, "mean")))
+        self.assertEqual({
+            carbonara.SplitKey(numpy.datetime64(1451520000, 's'),
+                               numpy.timedelta64(1, 'm')),
+            carbonara.SplitKey(numpy.datetime64(1451736000, 's'),
+                               numpy.timedelta64(1, 'm')),
+            carbonara.SplitKey(numpy.datetime64(1451952000, 's'),
+                               numpy.timedelta64(1, 'm')),
+        }, self.storage._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+
+        # Rewrite the last split many times
+        for minute in six.moves.range(10):
+            self.incoming.add_measures(self.metric, [
+                storage.Measure(datetime64(2016, 1, 6, 16, minute), minute),
+            ])
+            self.trigger_processing()
+        with open(segment, 'rb') as f:
+            index, size, garbage = self.storage._read_segment_index(f)
+        self.assertEqual(3, len(index))
+        self.assertLessEqual(garbage, size / 2)
+        self.assertEqual([
+            (datetime64(2016, 1, 1, 12), numpy.timedelta64(1, 'm'), 69),
+            (datetime64(2016, 1, 2, 13, 7), numpy.timedelta64(1, 'm'), 42),
+            (datetime64(2016, 1, 6, 15, 12), numpy.timedelta64(1, 'm'), 44),
+        ] + [
+            (datetime64(2016, 1, 6, 16, minute), numpy.timedelta64(1, 'm'),
+             minute)
+            for minute in six.moves.range(10)
+        ], self.storage.get_measures(self.metric))
+
+        key = carbonara.SplitKey(numpy.datetime64(1451520000, 's'),
+                                 numpy.timedelta64(1, 'm'))
+        self.storage._delete_metric_measures(self.metric, key, "mean")
+        self.assertNotIn(key, self.storage._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+        self.assertRaises(storage.AggregationDoesNotExist,
+                          self.storage._get_measures,
+                          self.metric, key, "mean")
+
+        self.storage.delete_metric(self.incoming, self.metric, sync=True)
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage._get_measures,
+                          self.metric, key, "mean")
+
+    def test_file_segment_compaction_with_cached_index(self):
+        self.conf.set_override('file_layout', 'segment', 'storage')
+        self.addCleanup(self.conf.clear_override, 'file_layout', 'storage')
+        self.conf.set_override('file_basepath',
+                               self.useFixture(fixtures.TempDir()).path,
+                               'storage')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'storage')
+        self.storage = file.FileStorage(self.conf.storage,
+                                        self.storage.coord)
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, [(36000, 60)],
+                                          ["mean"])
+        self.index.create_archive_policy(ap)
+        self.metric = storage.Metric(uuid.uuid4(), ap)
+        self.index.create_metric(self.metric.id, str(uuid.uuid4()),
+                                 apname)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2016, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2016, 1, 2, 13, 7, 31), 42),
+            storage.Measure(datetime64(2016, 1, 6, 15, 12, 45), 44),
+        ])
+        self.trigger_processing()
+        segment = self.storage._build_segment_path(
+            self.metric, "mean", numpy.timedelta64(1, 'm'))
+        keys = sorted(self.storage._list_split_keys_for_metric(
+            self.metric, "mean", numpy.timedelta64(1, 'm')))
+        splits = [self.storage._get_measures(self.metric, key, "mean")
+                  for key in keys]
+        self.assertIn(segment, self.storage._segment_indexes)
+        with open(segment, 'rb') as f:
+            generation = self.storage._read_segment_generation(f)
+        self.assertIsNotNone(generation)
+
+        # NOTE(jd) Another process rewrites the first split until the segment
+        # file is compacted, moving the other splits.
+        other = file.FileStorage(self.conf.storage, self.storage.coord)
+        other.SEGMENT_COMPACTION_MIN_SIZE = 0
+        splits[0] += b"\0" * 64
+        for i in six.moves.range(5):
+            other._store_metric_measures(self.metric, keys[0], "mean",
+                                         splits[0])
+        with open(segment, 'rb') as f:
+            self.assertNotEqual(generation,
+                                other._read_segment_generation(f))
+
+        # NOTE(jd) The compacted file may reuse the inode of the previous one.
+        cached = self.storage._segment_indexes[segment]
+        self.storage._segment_indexes[segment] = (
+            os.stat(segment).st_ino,) + cached[1:]
+        self.assertEqual(splits, [
+            self.storage._get_measures(self.metric, key, "mean")
+            for key in keys])
+
+    def test_file_mapped_reads(self):
+        if not isinstance(self.storage, file.FileStorage) or six.PY2:
+            self.skipTest("Only the file driver maps files on Python 3")
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.trigger_processing()
+
+        data = self.storage._get_unaggregated_timeserie_buffer(self.metric)
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(
+            self.storage._get_unaggregated_timeserie(self.metric),
+            data.tobytes())
+        key = carbonara.SplitKey(numpy.datetime64(1387800000, 's'),
+                                 numpy.timedelta64(5, 'm'))
+        data = self.storage._get_measures_buffer(self.metric, key, "mean")
+        self.assertIsInstance(data, memoryview)
+        self.assertEqual(
+            self.storage._get_measures(self.metric, key, "mean"),
+            data.tobytes())
+        self.assertEqual([
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 42.0),
+        ], self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(5, 'm')))
+
+    def test_swift_deleted_by_another_process(self):
+        if not isinstance(self.storage, swift.SwiftStorage):
+            self.skipTest("Only for the swift driver")
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing()
+        key = carbonara.SplitKey(numpy.datetime64(1387800000, 's'),
+                                 numpy.timedelta64(5, 'm'))
+        self.assertRaises(storage.AggregationDoesNotExist,
+                          self.storage._get_measures,
+                          self.metric, key, "unknown")
+
+        other = swift.SwiftStorage(self.conf.storage, self.storage.coord)
+        self.addCleanup(other.stop)
+        other._delete_metric(self.metric)
+        self.assertRaises(storage.MetricDoesNotExist,
+                          self.storage._get_measures,
+                          self.metric, key, "mean")
+    def test_redis_split_index(self):
+        if not isinstance(self.storage, redis.RedisStorage):
+            self.skipTest("Only the redis driver indexes splits")
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+        self.trigger_processing()
+        granularity = numpy.timedelta64(5, 'm')
+        keys = self.storage._list_split_keys(self.metric, "mean", granularity)
+        self.assertEqual({"1387800000.0"}, keys)
+
+        # NOTE(jd) Drop the indexes like a storage created before them.
+        self.storage._client.delete(*[
+            self.storage._split_index_key(self.metric, aggregation,
+                                          d.granularity)
+            for aggregation in self.metric.archive_policy.aggregation_methods
+            for d in self.metric.archive_policy.definition])
+        self.assertEqual(set(), self.storage._list_split_keys(
+            self.metric, "mean", granularity))
+        self.storage.upgrade()
+        self.assertEqual(keys, self.storage._list_split_keys(
+            self.metric, "mean", granularity))
+
+        self.storage._delete_metric(self.metric)
+        self.assertEqual(0, self.storage._client.exists(
+            self.storage._split_index_key(self.metric, "mean", granularity)))
+
+    def test_filelog_incoming(self):
+        basepath = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('file_basepath', basepath, 'incoming')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'incoming')
+        self.conf.set_override('file_log_segment_size', 64, 'incoming')
+        self.addCleanup(self.conf.clear_override,
+                        'file_log_segment_size', 'incoming')
+        self.incoming = incoming_filelog.FileLogStorage(self.conf.incoming)
+        self.incoming.upgrade(1)
+        failing, __ = self._create_metric()
+        deleted, __ = self._create_metric()
+        for m in (self.metric, failing, deleted):
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            ])
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+            ])
+        sack_path = self.incoming._sack_path(0)
+        self.assertEqual(3, len(self.incoming._list_segments(0)))
+        self.assertEqual({'metrics': 3, 'measures': 6},
+                         self.incoming.measures_report(False)['summary'])
+
+        # NOTE(jd) Processed metric per metric.
+        self.trigger_processing()
+        self.assertFalse(self.incoming.has_unprocessed(self.metric))
+        self.incoming.delete_unprocessed_measures_for_metric_id(deleted.id)
+        self.assertFalse(self.incoming.has_unprocessed(deleted))
+        self.assertEqual({str(failing.id)},
+                         self.incoming.list_metric_with_measures_to_process(0))
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 9, 31), 4),
+        ])
+        real_process = self.storage._process_metric_measures
+
+        def process_metric_measures(metric, measures, first_timestamps):
+            if metric.id == failing.id:
+                raise ValueError("failing")
+            return real_process(metric, measures, first_timestamps)
+
+        with mock.patch.object(self.storage, '_process_metric_measures',
+                               side_effect=process_metric_measures):
+            self.assertEqual(2, self.storage.process_new_measures_for_sack(
+                self.index, self.incoming, 0))
+        self.assertEqual([
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 23),
+        ], self.storage.get_measures(
+            self.metric, granularity=numpy.timedelta64(5, 'm')))
+        # NOTE(jd) The measures not processed are appended again to the log,
+        # the segments consumed are deleted.
+        self.assertEqual({'metrics': 1, 'measures': 1},
+                         self.incoming.measures_report(False)['summary'])
+        self.assertEqual(1, len(self.incoming._list_segments(0)))
+
+        self.assertEqual(1, self.storage.process_new_measures_for_sack(
+            self.index, self.incoming, 0, sync=True))
+        self.assertEqual(2, len(self.storage.get_measures(
+            failing, granularity=numpy.timedelta64(5, 'm'))))
+        self.assertEqual(set(),
+                         self.incoming.list_metric_with_measures_to_process(0))
+        self.assertEqual([], self.incoming._list_segments(0))
+        self.assertEqual(
+            str(self.incoming._read_sack_log(0).end),
+            open(os.path.join(sack_path, "offset")).read())
+
+    def test_filelog_incoming_incremental_read(self):
+        basepath = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('file_basepath', basepath, 'incoming')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'incoming')
+        self.incoming = incoming_filelog.FileLogStorage(self.conf.incoming)
+        self.incoming.upgrade(1)
+        m2, __ = self._create_metric()
+        for m in (self.metric, m2):
+            self.incoming.add_measures(m, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            ])
+
+        with mock.patch.object(incoming_filelog._SackLog, 'add',
+                               autospec=True,
+                               side_effect=incoming_filelog._SackLog.add
+                               ) as add, mock.patch.object(
+                                   self.incoming, '_commit') as commit:
+            self.assertEqual(
+                {str(self.metric.id), str(m2.id)},
+                self.incoming.list_metric_with_measures_to_process(0))
+            self.assertEqual(2, add.call_count)
+            self.incoming.add_measures(self.metric, [
+                storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+            ])
+            self.assertTrue(self.incoming.has_unprocessed(self.metric))
+            self.assertEqual(3, add.call_count)
+            self.assertTrue(self.incoming.has_unprocessed(m2))
+            self.assertEqual(3, add.call_count)
+            # NOTE(jd) Listing never writes to the log.
+            commit.assert_not_called()
+
+        # NOTE(jd) Once all the metrics are processed or deleted, the
+        # segments are released.
+        with self.incoming.process_measure_for_metric(self.metric) as ms:
+            self.assertEqual(2, len(ms))
+        self.assertEqual(1, len(self.incoming._list_segments(0)))
+        self.incoming.delete_unprocessed_measures_for_metric_id(m2.id)
+        self.assertEqual([], self.incoming._list_segments(0))
+        self.assertEqual(set(),
+                         self.incoming.list_metric_with_measures_to_process(0))
+
+    def test_file_subdir_levels(self):
+        basepath = self.useFixture(fixtures.TempDir()).path
+        self.conf.set_override('file_basepath', basepath, 'storage')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'storage')
+        self.conf.set_override('file_basepath', basepath, 'incoming')
+        self.addCleanup(self.conf.clear_override, 'file_basepath', 'incoming')
+        self.storage = file.FileStorage(self.conf.storage,
+                                        self.storage.coord)
+        self.incoming = incoming_file.FileStorage(self.conf.incoming)
+        self.storage.upgrade()
+        self.incoming.upgrade(8)
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing()
+        self.assertTrue(os.path.isdir(
+            os.path.join(basepath, str(self.metric.id))))
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+        ])
+
+        self.conf.set_override('file_subdir_levels', 2, 'storage')
+        self.addCleanup(self.conf.clear_override,
+                        'file_subdir_levels', 'storage')
+        self.conf.set_override('file_subdir_levels', 2, 'incoming')
+        self.addCleanup(self.conf.clear_override,
+                        'file_subdir_levels', 'incoming')
+        self.storage = file.FileStorage(self.conf.storage,
+                                        self.storage.coord)
+        self.incoming = incoming_file.FileStorage(self.conf.incoming)
+        # NOTE(jd) The directories stay where they are until the upgrade.
+        self.assertEqual(0, self.storage.subdir_levels)
+        self.assertEqual(0, self.incoming.subdir_levels)
+        self.storage.upgrade()
+        self.incoming.upgrade(8)
+        metric_dir = self.storage._build_metric_dir(self.metric)
+        self.assertEqual(
+            os.path.join(basepath, *common_file.get_shards(
+                str(self.metric.id), 2) + [str(self.metric.id)]),
+            metric_dir)
+        self.assertTrue(os.path.isdir(metric_dir))
+        self.assertFalse(os.path.exists(
+            os.path.join(basepath, str(self.metric.id))))
+        self.assertEqual(
+            {str(self.metric.id)},
+            self.incoming.list_metric_with_measures_to_process(
+                self.incoming.sack_for_metric(self.metric.id)))
+
+        self.trigger_processing()
+        self.assertEqual([
+            (datetime64(2014, 1, 1), numpy.timedelta64(1, 'D'), 55.5),
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(1, 'h'), 55.5),
+            (datetime64(2014, 1, 1, 12), numpy.timedelta64(5, 'm'), 69),
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'), 42.0),
+        ], self.storage.get_measures(self.metric))
+        self.assertEqual(
+            set(), self.incoming.list_metric_with_measures_to_process(
+                self.incoming.sack_for_metric(self.metric.id)))
+
+        metric, __ = self._create_metric()
+        self.incoming.add_measures(metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+        ])
+        self.trigger_processing([str(metric.id)])
+        self.assertEqual(3, len(self.storage.get_measures(metric)))
+        self.storage.delete_metric(self.incoming, metric, sync=True)
+        self.assertFalse(os.path.exists(
+            self.storage._build_metric_dir(metric)))
+
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 10, 31), 4),
+        ])
+        self.conf.set_override('file_subdir_levels', 1, 'storage')
+        self.conf.set_override('file_subdir_levels', 1, 'incoming')
+        self.storage = file.FileStorage(self.conf.storage,
+                                        self.storage.coord)
+        self.incoming = incoming_file.FileStorage(self.conf.incoming)
+        self.assertEqual(2, self.storage.subdir_levels)
+        self.assertEqual(metric_dir,
+                         self.storage._build_metric_dir(self.metric))
+        self.storage.upgrade()
+        self.incoming.upgrade(8)
+        shards = common_file.get_shards(str(self.metric.id), 2)
+        self.assertEqual(
+            os.path.join(basepath, shards[0], str(self.metric.id)),
+            self.storage._build_metric_dir(self.metric))
+        self.assertFalse(os.path.exists(os.path.join(basepath, *shards)))
+        self.trigger_processing()
+        self.assertEqual(5, len(self.storage.get_measures(self.metric)))
+
     def test_updated_measures(self):
         self.incoming.add_measures(self.metric, [
             storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
@@ -844,6 +1995,55 @@ class TestStorageDriver(tests_base.TestCase):
                           self.metric,
                           granularity=numpy.timedelta64(42, 's'))
 
+    def test_get_latest_measures(self):
+        metric2, __ = self._create_metric()
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 0, 1), 69),
+            storage.Measure(datetime64(2014, 1, 1, 12, 7, 31), 42),
+            storage.Measure(datetime64(2014, 1, 1, 12, 9, 31), 4),
+        ])
+        self.trigger_processing()
+        self.incoming.add_measures(self.metric, [
+            storage.Measure(datetime64(2014, 1, 1, 12, 12, 45), 44),
+        ])
+        self.trigger_processing()
+
+        expected = {
+            self.metric: [
+                (datetime64(2014, 1, 1), numpy.timedelta64(1, 'D'), 39.75),
+                (datetime64(2014, 1, 1, 12), numpy.timedelta64(1, 'h'),
+                 39.75),
+                (datetime64(2014, 1, 1, 12, 10), numpy.timedelta64(5, 'm'),
+                 44.0),
+            ],
+            metric2: [],
+        }
+        self.assertEqual(expected, self.storage.get_latest_measures(
+            [self.metric, metric2]))
+        self.assertEqual({self.metric: [
+            (datetime64(2014, 1, 1, 12, 10), numpy.timedelta64(5, 'm'), 44.0),
+        ]}, self.storage.get_latest_measures(
+            [self.metric], 'max', numpy.timedelta64(5, 'm')))
+        # The last measure did not add any std point with 5m granularity
+        self.assertEqual({self.metric: [
+            (datetime64(2014, 1, 1, 12, 5), numpy.timedelta64(5, 'm'),
+             26.870057685088806),
+        ]}, self.storage.get_latest_measures(
+            [self.metric], 'std', numpy.timedelta64(5, 'm')))
+
+        # Without the latest measures stored, the last splits are read
+        with mock.patch.object(self.storage, '_get_latest_measures',
+                               return_value=None):
+            self.assertEqual(expected, self.storage.get_latest_measures(
+                [self.metric, metric2]))
+
+        self.assertRaises(storage.AggregationDoesNotExist,
+                          self.storage.get_latest_measures,
+                          [self.metric], 'last')
+        self.assertRaises(storage.GranularityDoesNotExist,
+                          self.storage.get_latest_measures,
+                          [self.metric], 'mean', numpy.timedelta64(42, 's'))
+
     def test_get_cross_metric_measures_unknown_metric(self):
         self.assertEqual([],
                          self.storage.get_cross_metric_measures(
@@ -1062,6 +2262,158 @@ class TestStorageDriver(tests_base.TestCase):
              numpy.timedelta64(5, 'm'), 22.0)
         ], values)
 
+    def _create_metrics_with_policy(self, definition, number):
+        apname = str(uuid.uuid4())
+        ap = archive_policy.ArchivePolicy(apname, 0, definition)
+        self.index.create_archive_policy(ap)
+        metrics = []
+        for i in six.moves.range(number):
+            metric = storage.Metric(uuid.uuid4(), ap)
+            self.index.create_metric(metric.id, str(uuid.uuid4()), apname)
+            metrics.append(metric)
+        return metrics
+
+    def _assert_cross_metric_measures_streaming(self, metrics, ranges):
+        for aggregation in ("mean", "sum", "min", "max", "count", "median",
+                            "last"):
+            for fill, needed_overlap in ((None, 0), (None, 50), (0, 100),
+                                         (-1, 100), ('null', 100)):
+                for from_, to in ranges:
+                    results = []
+                    for threshold in (0, 1):
+                        self.storage.cross_metric_streaming_threshold = (
+                            threshold)
+                        try:
+                            results.append(
+                                self.storage.get_cross_metric_measures(
+                                    metrics, from_, to,
+                                    reaggregation=aggregation,
+                                    needed_overlap=needed_overlap,
+                                    fill=fill))
+                        except storage.MetricUnaggregatable as e:
+                            results.append(e.reason)
+                    self.assertEqual(results[0], results[1],
+                                     (aggregation, fill, from_, to))
+
+    def test_get_cross_metric_measures_streaming(self):
+        metrics = self._create_metrics_with_policy([(36000, 60)], 3)
+        for i, metric in enumerate(metrics):
+            # Spread measures on several splits, with holes
+            self.incoming.add_measures(metric, [
+                storage.Measure(datetime64(2016, 1, day, 12, minute), value)
+                for day in (1, 2, 4, 6)
+                for minute, value in ((0, 1 + i), (1, 4 * i), (2, 7))
+                if not (day == 4 and minute == i)
+            ])
+        self.trigger_processing([str(m.id) for m in metrics])
+
+        self._assert_cross_metric_measures_streaming(metrics, (
+            (None, None),
+            (datetime64(2016, 1, 2), None),
+            (None, datetime64(2016, 1, 4, 12, 1)),
+            (datetime64(2016, 1, 2), datetime64(2016, 1, 6)),
+        ))
+
+    def test_get_cross_metric_measures_streaming_truncated(self):
+        # Only keep 100 points, the last ones being spread on 2 splits
+        metrics = self._create_metrics_with_policy([(100, 1)], 2)
+        start = datetime64(2016, 1, 1, 0, 58)
+        for i, metric in enumerate(metrics):
+            self.incoming.add_measures(metric, [
+                storage.Measure(start + numpy.timedelta64(j, 's'), i * j)
+                for j in six.moves.range(i, 150 + i)
+            ])
+        self.trigger_processing([str(m.id) for m in metrics])
+        self.assertEqual(2, len(self.storage._list_split_keys_for_metric(
+            metrics[0], "mean", numpy.timedelta64(1, 's'))))
+        self.assertEqual(100, len(self.storage._get_measures_timeserie(
+            metrics[0], "mean", numpy.timedelta64(1, 's'))))
+
+        self._assert_cross_metric_measures_streaming(metrics, (
+            (None, None),
+            (datetime64(2016, 1, 1, 0, 59), None),
+        ))
+
+    def test_group_rollup(self):
+        apname = str(uuid.uuid4())
+        self.index.create_archive_policy(archive_policy.ArchivePolicy(
+            apname, 0, [(36000, 60), (1000, 3600)]))
+        project_id = str(uuid.uuid4())
+        other_project_id = str(uuid.uuid4())
+        rollup = _carbonara.GroupRollup.parse(
+            "generic:cpu:mean:max:project_id")
+        self.storage.group_rollups = [rollup]
+        self.assertEqual(rollup, self.storage.get_group_rollup(
+            "generic", "cpu", ["project_id"], "mean", "max"))
+        self.assertIsNone(self.storage.get_group_rollup(
+            "generic", "cpu", ["project_id"], "mean"))
+
+        def _create_resource(project_id):
+            r = self.index.create_resource(
+                'generic', uuid.uuid4(), str(uuid.uuid4()),
+                project_id=project_id,
+                metrics={"cpu": {"archive_policy_name": apname}})
+            return r.get_metric("cpu")
+
+        metrics = [_create_resource(project_id) for i in six.moves.range(3)]
+        other = _create_resource(other_project_id)
+        for i, metric in enumerate(metrics + [other]):
+            self.incoming.add_measures(metric, [
+                storage.Measure(datetime64(2016, 1, day, 12, minute), value)
+                for day in (1, 2)
+                for minute, value in ((0, 1 + i), (1, 4 * i), (2, 7))
+                if not (day == 2 and minute == i)
+            ])
+        self.trigger_processing([str(m.id) for m in metrics + [other]])
+
+        def _assert_rollup(metrics):
+            for from_, to, needed_overlap in (
+                    (None, None, 100),
+                    (datetime64(2016, 1, 2), None, 100),
+                    (datetime64(2016, 1, 2), None, 50),
+                    (datetime64(2016, 1, 1), datetime64(2016, 1, 3), 0)):
+                results = []
+                for method in (
+                        functools.partial(
+                            self.storage.get_cross_metric_measures,
+                            aggregation="mean", reaggregation="max"),
+                        functools.partial(
+                            self.storage.get_group_rollup_measures,
+                            rollup, (project_id,))):
+                    try:
+                        results.append(method(
+                            metrics, from_, to,
+                            needed_overlap=needed_overlap))
+                    except storage.MetricUnaggregatable as e:
+                        results.append(e.reason)
+                self.assertEqual(results[0], results[1],
+                                 (from_, to, needed_overlap))
+
+        _assert_rollup(metrics)
+        self.assertEqual(
+            [(utils.datetime_utc(2016, 1, 1, 12, minute),
+              numpy.timedelta64(1, 'm'), value)
+             for minute, value in ((0, 3), (1, 8), (2, 7))],
+            self.storage.get_group_rollup_measures(
+                rollup, (project_id,), metrics,
+                datetime64(2016, 1, 1), datetime64(2016, 1, 2),
+                numpy.timedelta64(1, 'm'), needed_overlap=0))
+        self.assertIsNone(self.storage.get_group_rollup_measures(
+            rollup, (project_id,), metrics[:2]))
+
+        # A new member makes the rollup computed again entirely
+        metrics.append(_create_resource(project_id))
+        self.incoming.add_measures(metrics[-1], [
+            storage.Measure(datetime64(2016, 1, 2, 12, 1), 100)])
+        self.trigger_processing([str(metrics[-1].id)])
+        _assert_rollup(metrics)
+
+        # Later measures only update the end of the rollup
+        self.incoming.add_measures(metrics[0], [
+            storage.Measure(datetime64(2016, 1, 2, 12, 2), 42)])
+        self.trigger_processing([str(metrics[0].id)])
+        _assert_rollup(metrics)
+
     def test_search_value(self):
         metric2, __ = self._create_metric()
         self.incoming.add_measures(self.metric, [
@@ -1199,6 +2551,18 @@ class TestMeasureQuery(tests_base.TestCase):
         self.assertTrue(q(10))
         self.assertFalse(q(11))
 
+    def test_array(self):
+        q = storage.MeasureQuery({"or": [{"and": [{">": 4}, {"<": 10}]},
+                                         {"=": [{"/": 0}, 1]},
+                                         {"=": -1}]})
+        numpy.testing.assert_array_equal(
+            [False, True, True, False, True],
+            q(numpy.array([4, 5, 9.5, 10, -1])))
+
+    def test_empty_and(self):
+        q = storage.MeasureQuery({"and": []})
+        numpy.testing.assert_array_equal([True, True], q([1, 2]))
+
     def test_empty(self):
         q = storage.MeasureQuery({})
         self.assertFalse(q(5))
@@ -14,12 +14,14 @@
 # WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and limitations
 # under the License.
+import contextlib
 import datetime
 import distutils.util
 import errno
 import itertools
 import multiprocessing
 import os
+import threading
 import uuid
 
 import daiquiri
@@ -293,6 +295,68 @@ class StopWatch(object):
         return self
 
 
+@contextlib.contextmanager
+def nullcontext(enter_result=None):
+    """A context manager that does nothing, like Python 3.7 one."""
+    yield enter_result
+
+
+class LockStatistics(object):
+    """Count the locks taken by a process and time how long they are waited
+    for and held, per kind of lock.
+
+    Thread-safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def add(self, kind, acquired, wait, hold=0.0):
+        with self._lock:
+            stats = self._stats.setdefault(kind, {
+                "acquired": 0, "busy": 0,
+                "wait": 0.0, "max_wait": 0.0,
+                "hold": 0.0, "max_hold": 0.0,
+            })
+            stats["acquired" if acquired else "busy"] += 1
+            stats["wait"] += wait
+            stats["max_wait"] = max(stats["max_wait"], wait)
+            stats["hold"] += hold
+            stats["max_hold"] = max(stats["max_hold"], hold)
+
+    def report(self, reset=False):
+        """Return the statistics as a dict indexed by kind of lock.
+
+        :param reset: Start counting again from zero.
+        """
+        with self._lock:
+            stats = dict((kind, dict(s)) for kind, s in self._stats.items())
+            if reset:
+                self._stats = {}
+        return stats
+
+    @contextlib.contextmanager
+    def acquire(self, kind, lock, blocking=True):
+        """Acquire a lock and release it when leaving the context.
+
+        Yields whether the lock has been acquired.
+        """
+        with StopWatch() as sw:
+            acquired = lock.acquire(blocking=blocking)
+        wait = sw.elapsed()
+        if not acquired:
+            self.add(kind, False, wait)
+            yield False
+            return
+        sw = StopWatch().start()
+        try:
+            yield True
+        finally:
+            lock.release()
+            self.add(kind, True, wait, sw.elapsed())
+
+
 def get_driver_class(namespace, conf):
     """Return the storage driver class.
 
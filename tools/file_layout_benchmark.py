@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Measure the cost of creating, looking up and listing metric directories
+# with the flat and the sharded layouts of the file drivers, like:
+#
+#   $ python file_layout_benchmark.py --metrics 1000000 --levels 0 1 2
+#   levels  create (s)  lookup (us)  list (s)
+#        0       ...
+#
+# Use a path on the file system to benchmark, and drop the page cache
+# between runs (echo 3 > /proc/sys/vm/drop_caches) to measure cold lookups.
+#
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+import uuid
+
+from gnocchi.common import file as common_file
+from gnocchi import utils
+
+
+def benchmark(basepath, names, levels, lookups):
+    start = time.time()
+    for name in names:
+        path = common_file.get_path(basepath, name, levels)
+        if levels:
+            utils.ensure_paths([os.path.dirname(path)])
+        os.mkdir(path)
+    create = time.time() - start
+
+    sample = random.sample(names, min(lookups, len(names)))
+    start = time.time()
+    for name in sample:
+        os.stat(common_file.get_path(basepath, name, levels))
+    lookup = (time.time() - start) / len(sample)
+
+    start = time.time()
+    listed = common_file.list_names(basepath, levels)
+    listing = time.time() - start
+    assert len(listed) == len(names)
+    return create, lookup, listing
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the directory layouts of the file drivers.")
+    parser.add_argument("--metrics", type=int, default=1000000,
+                        help="Number of metric directories to create.")
+    parser.add_argument("--levels", type=int, nargs="+", default=[0, 1, 2],
+                        help="Levels of subdirectories to benchmark.")
+    parser.add_argument("--lookups", type=int, default=10000,
+                        help="Number of random lookups.")
+    parser.add_argument("--path", default=None,
+                        help="Directory where to run the benchmark.")
+    args = parser.parse_args()
+
+    names = [str(uuid.uuid4()) for i in range(args.metrics)]
+    print("%6s  %10s  %11s  %8s" % ("levels", "create (s)", "lookup (us)",
+                                    "list (s)"))
+    for levels in args.levels:
+        basepath = tempfile.mkdtemp(dir=args.path)
+        try:
+            create, lookup, listing = benchmark(
+                basepath, names, levels, args.lookups)
+        finally:
+            shutil.rmtree(basepath)
+        print("%6d  %10.2f  %11.2f  %8.2f" % (levels, create, lookup * 10e5,
+                                              listing))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Measure the cost of building the array of the pending measures of a metric
+# made of many objects, as after a gnocchi-metricd outage, like:
+#
+#   $ python measures_accumulation_benchmark.py --objects 1000 10000
+#   objects  append (s)  incoming (s)
+#      1000       ...
+#
+
+import argparse
+import time
+
+import numpy
+
+from gnocchi.carbonara import TIMESERIES_ARRAY_DTYPE
+from gnocchi import incoming
+
+
+def make_objects(objects, measures):
+    now = numpy.datetime64("2017-01-01T00:00:00", "ns")
+    data = numpy.empty(measures, dtype=TIMESERIES_ARRAY_DTYPE)
+    data['timestamps'] = now + numpy.arange(measures).astype(
+        'timedelta64[s]')
+    data['values'] = numpy.random.rand(measures)
+    return [("measure-%d" % i, data.tobytes()) for i in range(objects)]
+
+
+def append(objects):
+    measures = numpy.array([], dtype=TIMESERIES_ARRAY_DTYPE)
+    for measure_id, data in objects:
+        measures = numpy.append(
+            measures, numpy.frombuffer(data, dtype=TIMESERIES_ARRAY_DTYPE))
+    return measures
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the accumulation of pending measures.")
+    parser.add_argument("--objects", type=int, nargs="+",
+                        default=[100, 1000, 10000],
+                        help="Numbers of pending objects of the metric.")
+    parser.add_argument("--measures", type=int, default=10,
+                        help="Number of measures per object.")
+    args = parser.parse_args()
+
+    print("%7s  %10s  %12s" % ("objects", "append (s)", "incoming (s)"))
+    for nb_objects in args.objects:
+        objects = make_objects(nb_objects, args.measures)
+        start = time.time()
+        expected = append(objects)
+        appended = time.time() - start
+        start = time.time()
+        measures = incoming.IncomingDriver._unserialize_measures(objects)
+        accumulated = time.time() - start
+        assert numpy.array_equal(expected, measures)
+        print("%7d  %10.3f  %12.3f" % (nb_objects, appended, accumulated))
+
+
+if __name__ == '__main__':
+    main()